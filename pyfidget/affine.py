@@ -0,0 +1,240 @@
+from __future__ import division, print_function
+
+import math
+
+from pyfidget.operations import OPS
+from pyfidget.vm import IntervalFrame
+
+# affine arithmetic: every value is represented as
+#
+#   center + sum(coeffs[i] * e[symbols[i]]) + [-error, error]
+#
+# where every noise symbol e[k] is an unknown in [-1, 1]. the symbols 0, 1
+# and 2 stand for the position in the box along x, y and z, every nonlinear
+# op introduces a fresh symbol for its approximation error. since ops that
+# share an argument share its symbols, correlations between them survive,
+# which plain intervals lose.
+
+SYMBOL_X = 0
+SYMBOL_Y = 1
+SYMBOL_Z = 2
+FIRST_FRESH_SYMBOL = 3
+
+# forms with more terms than that get their smallest terms folded into the
+# error, to bound the cost per op
+MAX_TERMS = 24
+
+# relative slack that is added for the rounding errors of the float
+# computations of every op, a few ulps
+ROUNDING = 2.0 ** -50
+
+
+class AffineForm(object):
+    def __init__(self, center, symbols, coeffs, error):
+        self.center = center
+        self.symbols = symbols
+        self.coeffs = coeffs
+        self.error = error
+
+    def radius(self):
+        radius = self.error
+        for coeff in self.coeffs:
+            radius += abs(coeff)
+        return radius
+
+    def bounds(self):
+        radius = self.radius() * (1.0 + ROUNDING)
+        return self.center - radius, self.center + radius
+
+    def is_constant(self):
+        return not self.symbols and self.error == 0.0
+
+    def __repr__(self):
+        terms = " ".join(["%+g*e%d" % (coeff, symbol)
+                          for symbol, coeff in zip(self.symbols, self.coeffs)])
+        return "<AffineForm %g %s +-%g>" % (self.center, terms, self.error)
+
+
+def _finish(center, symbols, coeffs, error):
+    # fold the smallest terms into the error if there are too many, add the
+    # slack for rounding errors and give up if something overflowed
+    while len(symbols) > MAX_TERMS:
+        smallest = 0
+        for i in range(1, len(coeffs)):
+            if abs(coeffs[i]) < abs(coeffs[smallest]):
+                smallest = i
+        error += abs(coeffs[smallest])
+        del symbols[smallest]
+        del coeffs[smallest]
+    form = AffineForm(center, symbols, coeffs, error)
+    form.error += ROUNDING * (abs(center) + form.radius())
+    if math.isinf(form.error) or math.isnan(form.error) or math.isinf(center):
+        return None
+    return form
+
+def linear(a, factor_a, b, factor_b, constant=0.0):
+    """ factor_a * a + factor_b * b + constant, where b can be None. """
+    if b is None:
+        symbols = a.symbols[:]
+        coeffs = [factor_a * coeff for coeff in a.coeffs]
+        return _finish(factor_a * a.center + constant, symbols, coeffs, abs(factor_a) * a.error)
+    symbols = []
+    coeffs = []
+    i = j = 0
+    while i < len(a.symbols) or j < len(b.symbols):
+        if j == len(b.symbols) or (i < len(a.symbols) and a.symbols[i] < b.symbols[j]):
+            symbols.append(a.symbols[i])
+            coeffs.append(factor_a * a.coeffs[i])
+            i += 1
+        elif i == len(a.symbols) or b.symbols[j] < a.symbols[i]:
+            symbols.append(b.symbols[j])
+            coeffs.append(factor_b * b.coeffs[j])
+            j += 1
+        else:
+            coeff = factor_a * a.coeffs[i] + factor_b * b.coeffs[j]
+            if coeff != 0.0:
+                symbols.append(a.symbols[i])
+                coeffs.append(coeff)
+            i += 1
+            j += 1
+    return _finish(factor_a * a.center + factor_b * b.center + constant, symbols, coeffs,
+                   abs(factor_a) * a.error + abs(factor_b) * b.error)
+
+def _with_fresh_term(form, symbol, radius):
+    if radius == 0.0:
+        return form
+    form.symbols.append(symbol)
+    form.coeffs.append(radius)
+    return _finish(form.center, form.symbols, form.coeffs, form.error)
+
+def mul(a, b, symbol):
+    if a.is_constant():
+        return linear(b, a.center, None, 0.0)
+    if b.is_constant():
+        return linear(a, b.center, None, 0.0)
+    # (a0 + la + ea) * (b0 + lb + eb) = b0 * a + a0 * b - a0 * b0 + rest,
+    # with rest = (la + ea) * (lb + eb), so |rest| <= radius(a) * radius(b)
+    form = linear(a, b.center, b, a.center, -a.center * b.center)
+    if form is None:
+        return None
+    return _with_fresh_term(form, symbol, a.radius() * b.radius())
+
+def square(a, symbol):
+    if a.is_constant():
+        return AffineForm(a.center * a.center, [], [], 0.0)
+    # (a0 + la + ea) ** 2 = 2 * a0 * a - a0 ** 2 + (la + ea) ** 2 and the
+    # last term is in [0, radius(a) ** 2]
+    radius = a.radius()
+    half_square = radius * radius * 0.5
+    form = linear(a, 2.0 * a.center, None, 0.0, -a.center * a.center + half_square)
+    if form is None:
+        return None
+    return _with_fresh_term(form, symbol, half_square)
+
+def from_interval(minimum, maximum, symbol):
+    """ An affine form with a single fresh symbol that covers an interval.
+    It has no correlation with anything else. """
+    if math.isnan(minimum) or math.isnan(maximum) or math.isinf(minimum) or math.isinf(maximum):
+        return None
+    if minimum == maximum:
+        return AffineForm(minimum, [], [], 0.0)
+    center = minimum * 0.5 + maximum * 0.5
+    radius = max(maximum - center, center - minimum)
+    return _finish(center, [symbol], [radius], 0.0)
+
+
+class AffineFrame(IntervalFrame):
+    """ An IntervalFrame that additionally keeps an affine form for every
+    value. The optimizer asks the frame to refine the interval of every op it
+    is about to emit with refine(), which intersects it with the bounds of
+    the affine form, and then stores the form with commit(). """
+
+    def __init__(self, program):
+        IntervalFrame.__init__(self, program)
+        self.forms = None
+        self.pending = None
+        self.next_symbol = FIRST_FRESH_SYMBOL
+
+    def setup(self, length):
+        IntervalFrame.setup(self, length)
+        if self.forms is None or len(self.forms) < len(self.minvalues):
+            self.forms = [None] * len(self.minvalues)
+
+    def setxyz(self, minx, maxx, miny, maxy, minz, maxz):
+        IntervalFrame.setxyz(self, minx, maxx, miny, maxy, minz, maxz)
+        self.next_symbol = FIRST_FRESH_SYMBOL
+        self.pending = None
+
+    def make_constant(self, const, resindex):
+        IntervalFrame.make_constant(self, const, resindex)
+        self.forms[resindex] = AffineForm(const, [], [], 0.0)
+
+    def _fresh_symbol(self):
+        symbol = self.next_symbol
+        self.next_symbol = symbol + 1
+        return symbol
+
+    def _variable(self, symbol, minimum, maximum):
+        if math.isinf(minimum) or math.isinf(maximum):
+            return None
+        center = minimum * 0.5 + maximum * 0.5
+        return _finish(center, [symbol], [max(maximum - center, center - minimum)], 0.0)
+
+    def _affine(self, func, arg0, arg1, minimum, maximum):
+        if func == OPS.var_x:
+            return self._variable(SYMBOL_X, minimum, maximum)
+        if func == OPS.var_y:
+            return self._variable(SYMBOL_Y, minimum, maximum)
+        if func == OPS.var_z:
+            return self._variable(SYMBOL_Z, minimum, maximum)
+        form0 = self.forms[arg0]
+        if form0 is None:
+            return None
+        if func == OPS.neg:
+            return linear(form0, -1.0, None, 0.0)
+        if func == OPS.square:
+            return square(form0, self._fresh_symbol())
+        if func == OPS.abs:
+            if self.minvalues[arg0] >= 0.0:
+                return form0
+            if self.maxvalues[arg0] <= 0.0:
+                return linear(form0, -1.0, None, 0.0)
+            return None
+        if func == OPS.add or func == OPS.sub or func == OPS.mul:
+            form1 = self.forms[arg1]
+            if form1 is None:
+                return None
+            if func == OPS.add:
+                return linear(form0, 1.0, form1, 1.0)
+            if func == OPS.sub:
+                return linear(form0, 1.0, form1, -1.0)
+            return mul(form0, form1, self._fresh_symbol())
+        return None
+
+    def refine(self, func, arg0, arg1, minimum, maximum):
+        """ Compute the affine form of an op that the optimizer is about to
+        emit and return its interval, intersected with the one the optimizer
+        computed. """
+        if math.isnan(minimum) or math.isnan(maximum):
+            self.pending = None
+            return minimum, maximum
+        form = self._affine(func, arg0, arg1, minimum, maximum)
+        if form is None:
+            # start a new correlation from the interval
+            form = from_interval(minimum, maximum, self._fresh_symbol())
+            self.pending = form
+            return minimum, maximum
+        self.pending = form
+        affine_minimum, affine_maximum = form.bounds()
+        if affine_minimum < minimum:
+            affine_minimum = minimum
+        if affine_maximum > maximum:
+            affine_maximum = maximum
+        if affine_minimum > affine_maximum:
+            # the bounds don't overlap, can only happen through rounding
+            return minimum, maximum
+        return affine_minimum, affine_maximum
+
+    def commit(self, resindex):
+        self.forms[resindex] = self.pending
+        self.pending = None
@@ -0,0 +1,308 @@
+from __future__ import division, print_function
+
+# numpy-based evaluation of whole tiles at once. this is only ever used
+# untranslated, the RPython build uses the frames in vm.py
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyfidget.operations import OPS
+
+
+class NumpyFrame(object):
+    """ Evaluates a program over arrays of coordinates, one op at a time. x, y
+    and z can be arrays of any shapes that broadcast against each other. """
+
+    def __init__(self, program):
+        self.program = program
+
+    def run_arrays(self, x, y, z):
+        program = self.program
+        num_ops = program.num_operations()
+        slots = program.get_slots()
+        values = [None] * program.size_storage()
+        with numpy.errstate(all='ignore'):
+            for op in range(num_ops):
+                func, arg0, arg1 = program.get_func_and_args(op)
+                func = OPS.mask(func)
+                if func == OPS.const:
+                    res = program.get_const(arg0)
+                elif func == OPS.var_x:
+                    res = x
+                elif func == OPS.var_y:
+                    res = y
+                elif func == OPS.var_z:
+                    res = z
+                elif func == OPS.add:
+                    res = numpy.add(values[slots[arg0]], values[slots[arg1]])
+                elif func == OPS.sub:
+                    res = numpy.subtract(values[slots[arg0]], values[slots[arg1]])
+                elif func == OPS.mul:
+                    res = numpy.multiply(values[slots[arg0]], values[slots[arg1]])
+                elif func == OPS.max:
+                    res = numpy.maximum(values[slots[arg0]], values[slots[arg1]])
+                elif func == OPS.min:
+                    res = numpy.minimum(values[slots[arg0]], values[slots[arg1]])
+                elif func == OPS.square:
+                    res = numpy.square(values[slots[arg0]])
+                elif func == OPS.sqrt:
+                    res = numpy.sqrt(values[slots[arg0]])
+                elif func == OPS.exp:
+                    res = numpy.exp(values[slots[arg0]])
+                elif func == OPS.neg:
+                    res = numpy.negative(values[slots[arg0]])
+                elif func == OPS.abs:
+                    res = numpy.absolute(values[slots[arg0]])
+                elif func == OPS.hypot2:
+                    val0 = values[slots[arg0]]
+                    val1 = values[slots[arg1]]
+                    res = numpy.sqrt(numpy.add(numpy.multiply(val0, val0), numpy.multiply(val1, val1)))
+                elif func == OPS.sub_square:
+                    res = numpy.square(numpy.subtract(values[slots[arg0]], values[slots[arg1]]))
+                else:
+                    raise ValueError("Invalid operation: %s" % op)
+                values[slots[op]] = res
+        return values[slots[num_ops - 1]]
+
+
+def square_bounds(min0, max0):
+    """ The bounds of the squares of the intervals [min0, max0], like
+    IntervalFrame._square. """
+    min2 = min0 * min0
+    max2 = max0 * max0
+    minimum = numpy.where(min0 >= 0, min2, numpy.where(max0 <= 0, max2, 0.0))
+    maximum = numpy.where(min0 >= 0, max2, numpy.where(max0 <= 0, min2, numpy.maximum(min2, max2)))
+    return minimum, maximum
+
+def fragment_coordinates(width, height, minx, maxx, miny, maxy, startx, stopx, starty, stopy):
+    """ Return the x coordinates of a tile as a row vector and the y
+    coordinates as a column vector. The values are bit-identical to the ones
+    that render_image_naive_fragment computes. """
+    dx = (maxx - minx) / (width - 1)
+    steps = numpy.empty(stopx - startx)
+    steps.fill(dx)
+    steps[0] = minx + dx * startx
+    xs = numpy.cumsum(steps).reshape((1, stopx - startx))
+    rows = numpy.arange(starty, stopy, dtype=numpy.float64)
+    ys = (miny + (maxy - miny) * rows / (height - 1)).reshape((stopy - starty, 1))
+    return xs, ys
+
+def render_image_numpy_fragment(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy):
+    xs, ys = fragment_coordinates(width, height, minx, maxx, miny, maxy, startx, stopx, starty, stopy)
+    res = frame.run_arrays(xs, ys, 0.0)
+    res = numpy.broadcast_to(res, (stopy - starty, stopx - startx))
+    pixels = (res <= 0.0).astype(numpy.uint8)
+    for row_index in range(starty, stopy):
+        index = row_index * width
+        result[index + startx:index + stopx] = list(pixels[row_index - starty].tobytes())
+
+def render_image_numpy(program, width, height, minx, maxx, miny, maxy):
+    result = ['\x00'] * (width * height)
+    render_image_numpy_fragment(NumpyFrame(program), width, height, minx, maxx, miny, maxy, result, 0, width, 0, height)
+    return result
+
+
+class NumpyIntervalFrame(object):
+    """ Interval evaluation of one program for many boxes at once. The
+    transfer functions are the ones of IntervalFrame, applied to arrays of
+    bounds; minvalues and maxvalues have the shape (slots, boxes), see
+    ProgramBuilder.get_slots, or (ops, boxes) if run_intervals is asked to
+    keep the intervals of all the ops. """
+
+    def __init__(self, program):
+        self.program = program
+        self.minvalues = self.maxvalues = None
+
+    def run_intervals(self, minx, maxx, miny, maxy, minz, maxz, all_ops=False):
+        program = self.program
+        num_ops = program.num_operations()
+        num_boxes = len(minx)
+        if all_ops:
+            slots = range(num_ops)
+            size = num_ops
+        else:
+            slots = program.get_slots()
+            size = program.size_storage()
+        minvalues = self.minvalues = numpy.empty((size, num_boxes))
+        maxvalues = self.maxvalues = numpy.empty((size, num_boxes))
+        with numpy.errstate(all='ignore'):
+            for op in range(num_ops):
+                func, arg0, arg1 = program.get_func_and_args(op)
+                func = OPS.mask(func)
+                if func == OPS.const:
+                    minvalues[slots[op]] = maxvalues[slots[op]] = program.get_const(arg0)
+                    continue
+                res = slots[op]
+                if func == OPS.var_x:
+                    minvalues[res] = minx
+                    maxvalues[res] = maxx
+                    continue
+                if func == OPS.var_y:
+                    minvalues[res] = miny
+                    maxvalues[res] = maxy
+                    continue
+                if func == OPS.var_z:
+                    minvalues[res] = minz
+                    maxvalues[res] = maxz
+                    continue
+                min0 = minvalues[slots[arg0]]
+                max0 = maxvalues[slots[arg0]]
+                min1 = minvalues[slots[arg1]]
+                max1 = maxvalues[slots[arg1]]
+                # the cases where the op can produce nan, see IntervalFrame
+                nan = numpy.zeros(num_boxes, dtype=bool)
+                if func == OPS.add:
+                    minimum, maximum = min0 + min1, max0 + max1
+                    nan = ((min0 == -numpy.inf) & (max1 == numpy.inf)) | ((max0 == numpy.inf) & (min1 == -numpy.inf))
+                elif func == OPS.sub:
+                    minimum, maximum = min0 - max1, max0 - min1
+                    nan = ((max0 == numpy.inf) & (max1 == numpy.inf)) | ((min0 == -numpy.inf) & (min1 == -numpy.inf))
+                elif func == OPS.mul:
+                    products = numpy.array([min0 * min1, min0 * max1, max0 * min1, max0 * max1])
+                    minimum, maximum = products.min(axis=0), products.max(axis=0)
+                    nan = (((min0 <= 0) & (max0 >= 0) & (numpy.isinf(min1) | numpy.isinf(max1))) |
+                           ((min1 <= 0) & (max1 >= 0) & (numpy.isinf(min0) | numpy.isinf(max0))))
+                elif func == OPS.max:
+                    minimum, maximum = numpy.maximum(min0, min1), numpy.maximum(max0, max1)
+                elif func == OPS.min:
+                    minimum, maximum = numpy.minimum(min0, min1), numpy.minimum(max0, max1)
+                elif func == OPS.square:
+                    minimum, maximum = square_bounds(min0, max0)
+                elif func == OPS.sqrt:
+                    minimum = numpy.where(max0 >= 0, numpy.sqrt(numpy.maximum(min0, 0.0)), numpy.nan)
+                    maximum = numpy.where(max0 >= 0, numpy.sqrt(max0), numpy.nan)
+                elif func == OPS.exp:
+                    minimum, maximum = numpy.exp(min0), numpy.exp(max0)
+                elif func == OPS.neg:
+                    minimum, maximum = -max0, -min0
+                elif func == OPS.abs:
+                    minimum = numpy.where(max0 < 0, -max0, numpy.where(min0 >= 0, min0, 0.0))
+                    maximum = numpy.where(max0 < 0, -min0, numpy.where(min0 >= 0, max0, numpy.maximum(-min0, max0)))
+                else:
+                    raise ValueError("Invalid operation: %s" % op)
+                # like IntervalFrame._set, a nan bound makes the value unknown
+                unknown = (nan | numpy.isnan(min0) | numpy.isnan(max0) | numpy.isnan(min1) | numpy.isnan(max1) |
+                           numpy.isnan(minimum) | numpy.isnan(maximum))
+                minvalues[res] = numpy.where(unknown, numpy.nan, minimum)
+                maxvalues[res] = numpy.where(unknown, numpy.nan, maximum)
+        return minvalues[slots[num_ops - 1]], maxvalues[slots[num_ops - 1]]
+
+
+def tile_bounds(width, height, minx, maxx, miny, maxy, tiles):
+    """ The coordinate boxes of a list of (startx, stopx, starty, stopy) tiles,
+    as four arrays. """
+    tiles = numpy.array(tiles, dtype=numpy.float64).reshape((len(tiles), 4))
+    a = minx + (maxx - minx) * tiles[:, 0] / (width - 1)
+    b = minx + (maxx - minx) * (tiles[:, 1] - 1) / (width - 1)
+    c = miny + (maxy - miny) * tiles[:, 2] / (height - 1)
+    d = miny + (maxy - miny) * (tiles[:, 3] - 1) / (height - 1)
+    return a, b, c, d
+
+def count_choices(program, minvalues, maxvalues):
+    """ For the intervals of all the ops of program in a number of boxes, the
+    number of min and max ops per box whose intervals decide which argument
+    is the result, i.e. that specializing program for the box can drop. """
+    counts = numpy.zeros(minvalues.shape[1], dtype=int)
+    for op in range(program.num_operations()):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        func = OPS.mask(func)
+        if func == OPS.min:
+            counts += (maxvalues[arg0] < minvalues[arg1]) | (maxvalues[arg1] < minvalues[arg0])
+        elif func == OPS.max:
+            counts += (minvalues[arg0] > maxvalues[arg1]) | (minvalues[arg1] > maxvalues[arg0])
+    return counts
+
+# the most tiles that render_image_octree_optimize_bfs interval-checks in one
+# pass. the intervals of all the ops are kept for every tile of a pass
+BATCH_SIZE = 256
+
+def render_image_octree_optimize_bfs(program, width, height, minx, maxx, miny, maxy, context=None):
+    """ Like render_image_octree_optimize, but walks the quadtree breadth-first
+    with an explicit work list instead of recursing. All the tiles of a level
+    that share a program are interval-checked in one vectorized pass, and the
+    optimizer gets the intervals of that pass instead of computing them again.
+    A tile where the intervals decide no min or max keeps the program of its
+    parent, so its children are checked together with the ones of all the
+    other such tiles. """
+    from pyfidget.context import RenderContext
+    from pyfidget.vm import split_tile
+    if context is None:
+        context = RenderContext()
+    result = ['\x00'] * (width * height)
+    root = program
+    # the programs of a level, the tiles that use them and how many
+    # references to them the level owns: one per opt_program result. with a
+    # tape cache, the same program object can be the result for several
+    # tiles, and every result has to be deleted
+    level = [(root, split_tile(0, width, 0, height, context), 0)]
+    while level:
+        next_level = []
+        programs_next_level = {}
+        for program, tiles, _ in level:
+            for start in range(0, len(tiles), BATCH_SIZE):
+                _render_bfs_batch(program, tiles[start:start + BATCH_SIZE], width, height, minx, maxx, miny, maxy,
+                                  result, next_level, programs_next_level, context)
+        for program, tiles, references in level:
+            key = id(program)
+            if key in programs_next_level:
+                # the program is still used by the next level
+                index = programs_next_level[key]
+                _, newtiles, newreferences = next_level[index]
+                next_level[index] = (program, newtiles, newreferences + references)
+                continue
+            for i in range(references):
+                program.delete()
+        level = next_level
+    return result
+
+def _add_bfs_tiles(next_level, programs_next_level, program, tiles, references):
+    key = id(program)
+    if key not in programs_next_level:
+        programs_next_level[key] = len(next_level)
+        next_level.append((program, [], 0))
+    index = programs_next_level[key]
+    _, newtiles, newreferences = next_level[index]
+    newtiles.extend(tiles)
+    next_level[index] = (program, newtiles, newreferences + references)
+
+def _render_bfs_batch(program, tiles, width, height, minx, maxx, miny, maxy, result, next_level, programs_next_level, context):
+    from pyfidget.optimize import opt_program
+    from pyfidget.vm import render_directly, split_tile, _fill_black, render_image_leaf_fragment
+    a, b, c, d = tile_bounds(width, height, minx, maxx, miny, maxy, tiles)
+    zeros = numpy.zeros(len(tiles))
+    frame = NumpyIntervalFrame(program)
+    minimum, maximum = frame.run_intervals(a, b, c, d, zeros, zeros, all_ops=True)
+    choices = count_choices(program, frame.minvalues, frame.maxvalues)
+    cost_model = context.cost_model
+    for i, (startx, stopx, starty, stopy) in enumerate(tiles):
+        if maximum[i] <= 0:
+            # completely inside
+            _fill_black(width, height, result, startx, stopx, starty, stopy)
+            continue
+        elif minimum[i] > 0:
+            # completely outside, no need to change color
+            continue
+        direct = render_directly(program, startx, stopx, starty, stopy, context)
+        if not direct:
+            pixels = (stopx - startx) * (stopy - starty)
+            shrink = choices[i] / program.num_operations()
+            if choices[i] == 0 or (cost_model is not None and not cost_model.should_specialize(shrink, pixels)):
+                context.stats.specializations_skipped += 1
+                _add_bfs_tiles(next_level, programs_next_level, program,
+                               split_tile(startx, stopx, starty, stopy, context), 0)
+                continue
+        newprogram, tile_minimum, tile_maximum = opt_program(
+                program, a[i], b[i], c[i], d[i], 0.0, 0.0, for_direct=direct, context=context,
+                minbounds=frame.minvalues[:, i].tolist(), maxbounds=frame.maxvalues[:, i].tolist())
+        if newprogram is None:
+            if tile_maximum <= 0:
+                _fill_black(width, height, result, startx, stopx, starty, stopy)
+            continue
+        if direct:
+            render_image_leaf_fragment(newprogram, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, context)
+            newprogram.delete()
+            continue
+        _add_bfs_tiles(next_level, programs_next_level, newprogram,
+                       split_tile(startx, stopx, starty, stopy, context), 1)
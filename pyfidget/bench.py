@@ -0,0 +1,110 @@
+from __future__ import division, print_function
+
+# count how many tiles of the quadtree every level manages to resolve, to
+# compare how precise the different abstract domains are. only usable
+# untranslated
+
+import sys
+import time
+
+from pyfidget.context import RenderContext
+from pyfidget.gradient import lipschitz_sign
+from pyfidget.optimize import opt_program
+from pyfidget.vm import render_directly, split_tile
+
+
+class LevelCounts(object):
+    def __init__(self):
+        self.inside = 0
+        self.outside = 0
+        self.subdivided = 0
+        self.leaves = 0
+        self.leaf_pixels = 0
+
+    def resolved(self):
+        return self.inside + self.outside
+
+
+def count_tiles(program, width, height, minx, maxx, miny, maxy, context=None):
+    """ Walk the quadtree like render_image_octree_optimize, without
+    rendering anything. Return a list of LevelCounts, one per level. """
+    if context is None:
+        context = RenderContext()
+    levels = []
+    _count_tiles_rec(program, width, height, minx, maxx, miny, maxy, 0, width, 0, height, 0, context, levels)
+    return levels
+
+def _count_tiles_rec(program, width, height, minx, maxx, miny, maxy, startx, stopx, starty, stopy, level, context, levels):
+    while len(levels) <= level:
+        levels.append(LevelCounts())
+    counts = levels[level]
+    if level:
+        a = minx + (maxx - minx) * startx / (width - 1)
+        b = minx + (maxx - minx) * (stopx - 1) / (width - 1)
+        c = miny + (maxy - miny) * starty / (height - 1)
+        d = miny + (maxy - miny) * (stopy - 1) / (height - 1)
+        direct = render_directly(program, startx, stopx, starty, stopy, context)
+        newprogram, minimum, maximum = opt_program(program, a, b, c, d, 0.0, 0.0, for_direct=direct, context=context)
+        if newprogram is None:
+            if maximum <= 0:
+                counts.inside += 1
+            else:
+                counts.outside += 1
+            return
+        if context.lipschitz:
+            sign = lipschitz_sign(newprogram, a, b, c, d, context)
+            if sign != 0:
+                if sign < 0:
+                    counts.inside += 1
+                else:
+                    counts.outside += 1
+                newprogram.delete()
+                return
+        if direct:
+            counts.leaves += 1
+            counts.leaf_pixels += (stopx - startx) * (stopy - starty)
+            newprogram.delete()
+            return
+    else:
+        newprogram = program
+    counts.subdivided += 1
+    for new_startx, new_stopx, new_starty, new_stopy in split_tile(startx, stopx, starty, stopy, context):
+        _count_tiles_rec(newprogram, width, height, minx, maxx, miny, maxy, new_startx, new_stopx, new_starty, new_stopy, level + 1, context, levels)
+    if level:
+        newprogram.delete()
+
+def print_counts(name, levels, duration):
+    print(name, "(%.2fs)" % duration)
+    print("  level  resolved    inside   outside  subdivided  leaves  leaf pixels")
+    for level, counts in enumerate(levels):
+        print("  %5d  %8d  %8d  %8d  %10d  %6d  %11d" % (
+            level, counts.resolved(), counts.inside, counts.outside,
+            counts.subdivided, counts.leaves, counts.leaf_pixels))
+    print("  total leaf pixels: %d" % sum([counts.leaf_pixels for counts in levels]))
+
+
+def main(argv):
+    from pyfidget.tape import load_program
+    if len(argv) < 2:
+        print("Usage: %s <input.vm> [length]" % argv[0])
+        return 1
+    program = load_program(argv[1])
+    length = 1024
+    if len(argv) > 2:
+        length = int(argv[2])
+    for name, affine, lipschitz, choice_tape in [("intervals", False, False, False),
+                                                 ("affine", True, False, False),
+                                                 ("intervals + lipschitz", False, True, False),
+                                                 ("choice tape", False, False, True)]:
+        context = RenderContext()
+        context.affine = affine
+        context.lipschitz = lipschitz
+        context.choice_tape = choice_tape
+        t1 = time.time()
+        levels = count_tiles(program, length, length, -1., 1., -1., 1., context)
+        t2 = time.time()
+        print_counts(name, levels, t2 - t1)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
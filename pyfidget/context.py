@@ -0,0 +1,154 @@
+from __future__ import print_function
+
+from pyfidget.operations import OPS, opnames
+
+# all the mutable state of a render lives in a RenderContext. renders that
+# use different contexts can run concurrently in one process.
+
+class Stats(object):
+    total_ops = 0
+    dedup_const_worked = 0
+    cse_worked = 0
+    constfold = 0
+    abs_pos = 0
+    abs_neg = 0
+    abs_of_neg = 0
+    neg_neg = 0
+    square_of_neg = 0
+    add0 = 0
+    sub_self = 0
+    zero_sub = 0
+    sub_zero = 0
+    min_range = 0
+    min_self = 0
+    min_min_self = 0
+    max_range = 0
+    max_self = 0
+    max_max_self = 0
+    mul_self = 0
+    mul0 = 0
+    mul1 = 0
+    mul_neg1 = 0
+
+    backwards_shortening = 0
+    demand_rewrites = 0
+    min_max_flattened = 0
+    chain_pruned = 0
+    ops_fused = 0
+    tapes_scheduled = 0
+    slots_saved = 0
+
+    lipschitz_resolved = 0
+    axis_intervals_reused = 0
+    batched_intervals_reused = 0
+    choices_sliced = 0
+    specializations_skipped = 0
+    tape_cache_hits = 0
+    tape_cache_misses = 0
+
+    ops_executed = 0
+    ops_skipped = 0
+    ops_optimized = 0
+    ops_optimized_checked = 0
+    ops_optimized_skipped = 0
+
+    def __init__(self):
+        self.ops = [0] * len(opnames)
+
+    def print_stats(self):
+        print('total_ops', self.total_ops)
+        print('dedup_const_worked', self.dedup_const_worked)
+        print('cse_worked', self.cse_worked)
+        print('constfold', self.constfold)
+        if self.ops[ord(OPS.abs)]:
+            print('abs_pos', self.abs_pos)
+            print('abs_neg', self.abs_neg)
+            print('abs_of_neg', self.abs_of_neg)
+        print('neg_neg', self.neg_neg)
+        print('square_of_neg', self.square_of_neg)
+        print('add0', self.add0)
+        print('sub_self', self.sub_self)
+        print('zero_sub', self.zero_sub)
+        print('sub_zero', self.sub_zero)
+        print('min_range', self.min_range)
+        print('min_self', self.min_self)
+        print('min_min_self', self.min_min_self)
+        print('max_range', self.max_range)
+        print('max_self', self.max_self)
+        print('max_max_self', self.max_max_self)
+        print('mul_self', self.mul_self)
+        print('mul0', self.mul0)
+        print('mu1', self.mul1)
+        print('mul_neg1', self.mul_neg1)
+        print()
+        print('backwards_shortening', self.backwards_shortening)
+        print('demand_rewrites', self.demand_rewrites)
+        print('min_max_flattened', self.min_max_flattened)
+        print('chain_pruned', self.chain_pruned)
+        print('ops_fused', self.ops_fused)
+        print('tapes_scheduled', self.tapes_scheduled)
+        print('slots_saved', self.slots_saved)
+        print('lipschitz_resolved', self.lipschitz_resolved)
+        print('axis_intervals_reused', self.axis_intervals_reused)
+        print('batched_intervals_reused', self.batched_intervals_reused)
+        print('choices_sliced', self.choices_sliced)
+        print('specializations_skipped', self.specializations_skipped)
+        print('tape_cache_hits', self.tape_cache_hits)
+        print('tape_cache_misses', self.tape_cache_misses)
+        if self.tape_cache_hits or self.tape_cache_misses:
+            print('tape_cache_hit_rate', float(self.tape_cache_hits) / (self.tape_cache_hits + self.tape_cache_misses))
+        print()
+
+        for index, value in enumerate(self.ops):
+            print(OPS.char_to_name(chr(index)), value)
+
+        print()
+        print('ops_executed', self.ops_executed)
+        print('ops_skipped', self.ops_skipped)
+        print('ops_optimized', self.ops_optimized)
+        print('ops_optimized_checked', self.ops_optimized_checked)
+        print('ops_optimized_skipped', self.ops_optimized_skipped)
+
+
+class RenderContext(object):
+    """ Owns the freelists of programs, frames and optimizers and the stats
+    of one render. Every object allocated from a context with new() goes back
+    to the same context when it is deleted. """
+
+    def __init__(self):
+        self.unused_frame = None
+        self.unused_lane_frame = None
+        self.unused_program = None
+        self.unused_compact_program = None
+        self.unused_optimizer = None
+        self.unused_slicer = None
+        # the IntervalFrame for the tiles that are not specialized
+        self.interval_frame = None
+        # the gradient.GradientFrame of gradient.lipschitz_sign
+        self.gradient_frame = None
+        self.stats = Stats()
+        # use the affine arithmetic domain of pyfidget.affine instead of
+        # plain intervals when specializing programs
+        self.affine = False
+        # try to resolve the tiles that intervals can't resolve with a
+        # Lipschitz bound from pyfidget.gradient
+        self.lipschitz = False
+        # specialize programs with the cheaper ChoiceSlicer of
+        # pyfidget.optimize instead of the Optimizer
+        self.choice_tape = False
+        # a pyfidget.costmodel.CostModel that decides when specializing a
+        # tile again is not worth it and when to stop subdividing. None means
+        # always specialize and subdivide down to vm.LIMIT. if adaptive is
+        # set, render_image_octree_optimize measures one
+        self.cost_model = None
+        self.adaptive = False
+        # split tiles that are much longer along one axis only along that
+        # axis, see vm.split_tile
+        self.kd_split = False
+        # a pyfidget.tapecache.TapeCache that makes tiles with equal
+        # specialized programs share them, or None
+        self.tape_cache = None
+        # before evaluating a tile pixel by pixel, move the ops that decide
+        # its sign most often to the front of its program, see
+        # pyfidget.schedule
+        self.schedule = False
@@ -0,0 +1,160 @@
+from __future__ import division, print_function
+
+import sys
+import time
+
+# decides whether specializing the program of a tile again is worth it. the
+# optimizer costs time per op of the program it gets, the evaluator costs time
+# per op and pixel. specializing a tile with a program of n ops costs about
+#
+#   optimize_cost * n
+#
+# and if it shrinks the program by the fraction shrink, it saves up to
+#
+#   evaluate_cost * shrink * n * pixels
+#
+# in the pixels of the tile. so it pays off if shrink is at least
+# optimize_cost / (evaluate_cost * pixels). the shrink of the child is not
+# known before specializing it, so the one of its parent is used instead.
+#
+# the same costs decide whether a tile is evaluated directly, for
+#
+#   evaluate_cost * n * pixels
+#
+# or subdivided. the children cost tile_cost + optimize_cost * n each (there
+# are four, or two for kd splits), and the fraction ambiguous_fraction of the
+# pixels still has to be evaluated directly afterwards. tile_cost is what a
+# tile costs no matter how long its program is: setting up the frames, the
+# recursion, writing the result. because of it, a short program is evaluated
+# directly in bigger tiles than a long one.
+
+# the fraction of the pixels of a subdivided tile that are in children that
+# intervals can't resolve, if nothing better is known
+AMBIGUOUS_FRACTION = 0.5
+
+
+class CostModel(object):
+    def __init__(self, optimize_cost, evaluate_cost, ambiguous_fraction=AMBIGUOUS_FRACTION, tile_cost=0.0):
+        # seconds per op of the input program of the optimizer
+        self.optimize_cost = optimize_cost
+        # seconds per op and pixel of the leaf renderer
+        self.evaluate_cost = evaluate_cost
+        self.ambiguous_fraction = ambiguous_fraction
+        # seconds per tile, independent of the program
+        self.tile_cost = tile_cost
+
+    def min_shrink(self, pixels):
+        """ The smallest shrink of the program for which specializing a tile
+        with that many pixels pays off. """
+        return self.optimize_cost / (self.evaluate_cost * pixels)
+
+    def should_specialize(self, shrink, pixels):
+        return shrink >= self.min_shrink(pixels)
+
+    def should_subdivide(self, num_ops, pixels, num_children=4):
+        """ Whether subdividing a tile with that many pixels and a program
+        with num_ops ops into num_children tiles is cheaper than evaluating
+        it directly. """
+        direct = self.evaluate_cost * num_ops * pixels
+        per_child = self.tile_cost + self.optimize_cost * num_ops
+        subdivide = num_children * per_child + self.ambiguous_fraction * direct
+        return subdivide < direct
+
+    def __repr__(self):
+        return "<CostModel optimize %g s/op, evaluate %g s/op/pixel, tile %g s>" % (
+            self.optimize_cost, self.evaluate_cost, self.tile_cost)
+
+
+# a profile is a text file with one "name value" line per cost, so that a
+# calibration can be reused for later renders with the same backend
+
+PROFILE_NAMES = ["optimize_cost", "evaluate_cost", "ambiguous_fraction", "tile_cost"]
+
+def save_profile(model, filename):
+    with open(filename, "w") as f:
+        f.write("optimize_cost %s\n" % repr(model.optimize_cost))
+        f.write("evaluate_cost %s\n" % repr(model.evaluate_cost))
+        f.write("ambiguous_fraction %s\n" % repr(model.ambiguous_fraction))
+        f.write("tile_cost %s\n" % repr(model.tile_cost))
+
+def load_profile(filename):
+    """ Read a CostModel that save_profile wrote. Raises ValueError if the
+    file is not a profile. """
+    values = {}
+    with open(filename) as f:
+        for line in f.read().split("\n"):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            words = line.split(" ")
+            if len(words) != 2 or words[0] not in PROFILE_NAMES:
+                raise ValueError("invalid line in profile: %s" % line)
+            values[words[0]] = float(words[1])
+    for name in PROFILE_NAMES:
+        if name not in values:
+            raise ValueError("missing in profile: %s" % name)
+    return CostModel(values["optimize_cost"], values["evaluate_cost"],
+                     values["ambiguous_fraction"], values["tile_cost"])
+
+
+# the size of the tile that calibrate renders, and how often it repeats the
+# measurements
+CALIBRATION_SIZE = 16
+CALIBRATION_ROUNDS = 3
+
+def calibrate(program, minx, maxx, miny, maxy):
+    """ Measure the cost per op of the optimizer and of the leaf renderer
+    for program in the given box and return a CostModel. The cost per tile
+    is measured by optimizing and rendering a program with a single op. """
+    from pyfidget.context import RenderContext
+    from pyfidget.optimize import opt_program
+    from pyfidget.parse import parse
+    from pyfidget.vm import render_image_leaf_fragment
+    # measure with a context of its own, to not count into the stats of the
+    # render
+    context = RenderContext()
+    num_ops = program.num_operations()
+    size = CALIBRATION_SIZE
+    result = ['\x00'] * (size * size)
+    single = parse("_0 var-x")
+    optimize_time = evaluate_time = tile_time = 0.0
+    for i in range(CALIBRATION_ROUNDS):
+        t1 = time.time()
+        newprogram, _, _ = opt_program(program, minx, maxx, miny, maxy, 0.0, 0.0, context=context)
+        t2 = time.time()
+        if newprogram is not None:
+            newprogram.delete()
+        render_image_leaf_fragment(program, size, size, minx, maxx, miny, maxy, result, 0, size, 0, size, context)
+        t3 = time.time()
+        newprogram, _, _ = opt_program(single, minx, maxx, miny, maxy, 0.0, 0.0, context=context)
+        if newprogram is not None:
+            newprogram.delete()
+        render_image_leaf_fragment(single, 2, 2, minx, maxx, miny, maxy, result, 0, 1, 0, 1, context)
+        t4 = time.time()
+        optimize_time += t2 - t1
+        evaluate_time += t3 - t2
+        tile_time += t4 - t3
+    # the clock can be too coarse for small programs
+    optimize_cost = max_float(optimize_time, 1e-9) / (CALIBRATION_ROUNDS * num_ops)
+    evaluate_cost = max_float(evaluate_time, 1e-9) / (CALIBRATION_ROUNDS * num_ops * size * size)
+    tile_cost = tile_time / CALIBRATION_ROUNDS
+    return CostModel(optimize_cost, evaluate_cost, tile_cost=tile_cost)
+
+def max_float(a, b):
+    if a > b:
+        return a
+    return b
+
+
+def main(argv):
+    from pyfidget.tape import load_program
+    if len(argv) != 3:
+        print("Usage: %s <input.vm> <output profile>" % argv[0])
+        return 1
+    model = calibrate(load_program(argv[1]), -1.0, 1.0, -1.0, 1.0)
+    print(model)
+    save_profile(model, argv[2])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,195 @@
+from __future__ import division, print_function
+
+import math
+
+from pyfidget.operations import OPS
+from pyfidget.vm import IntervalFrame, DirectFrame, min, max, exp_or_inf
+
+# forward-mode automatic differentiation over intervals: next to the interval
+# of every value, GradientFrame keeps intervals for its partial derivatives
+# along x, y and z. that gives a Lipschitz bound for a whole tile, so a tile
+# whose center is far enough away from the surface can be resolved even if
+# the plain interval of the function still contains 0.
+
+NUM_AXES = 3
+
+# relative slack for the rounding errors of the value at the center and the
+# gradient bounds
+LIPSCHITZ_SLACK = 1e-9
+
+
+class GradientFrame(IntervalFrame):
+    """ An IntervalFrame that also computes bounds of the gradient. The
+    bounds of the partial derivative of op along axis i are
+    mingrads[op * NUM_AXES + i] and maxgrads[op * NUM_AXES + i]. """
+
+    def __init__(self, program):
+        IntervalFrame.__init__(self, program)
+        self.mingrads = self.maxgrads = None
+
+    def setup(self, length):
+        IntervalFrame.setup(self, length)
+        if self.mingrads and len(self.mingrads) >= length * NUM_AXES:
+            return
+        self.mingrads = [0.0] * (length * NUM_AXES)
+        self.maxgrads = [0.0] * (length * NUM_AXES)
+
+    def run_gradients(self, minx, maxx, miny, maxy, minz, maxz):
+        """ Compute the intervals and the gradient bounds of all ops, return
+        the interval of the result. """
+        program = self.program
+        num_ops = program.num_operations()
+        self.setup(num_ops)
+        self.setxyz(minx, maxx, miny, maxy, minz, maxz)
+        for op in range(num_ops):
+            func, arg0, arg1 = program.get_func_and_args(op)
+            func = OPS.mask(func)
+            self._run_masked_op(func, arg0, arg1, op)
+            for axis in range(NUM_AXES):
+                self._gradient(func, arg0, arg1, op, axis)
+        return self.minvalues[num_ops - 1], self.maxvalues[num_ops - 1]
+
+    def _run_masked_op(self, func, arg0, arg1, op):
+        if func == OPS.const:
+            self.make_constant(self.program.get_const(arg0), op)
+        elif func == OPS.var_x:
+            self.get_x(op)
+        elif func == OPS.var_y:
+            self.get_y(op)
+        elif func == OPS.var_z:
+            self.get_z(op)
+        elif func == OPS.add:
+            self.add(arg0, arg1, op)
+        elif func == OPS.sub:
+            self.sub(arg0, arg1, op)
+        elif func == OPS.mul:
+            self.mul(arg0, arg1, op)
+        elif func == OPS.max:
+            self.max(arg0, arg1, op)
+        elif func == OPS.min:
+            self.min(arg0, arg1, op)
+        elif func == OPS.square:
+            self.square(arg0, op)
+        elif func == OPS.sqrt:
+            self.sqrt(arg0, op)
+        elif func == OPS.exp:
+            self.exp(arg0, op)
+        elif func == OPS.neg:
+            self.neg(arg0, op)
+        elif func == OPS.abs:
+            self.abs(arg0, op)
+        else:
+            raise ValueError("Invalid operation: %s" % op)
+
+    def _set_gradient(self, index, minimum, maximum):
+        if math.isinf(minimum) or math.isinf(maximum):
+            minimum = maximum = float('nan')
+        self.mingrads[index] = minimum
+        self.maxgrads[index] = maximum
+
+    def _gradient(self, func, arg0, arg1, op, axis):
+        index = op * NUM_AXES + axis
+        if func == OPS.const:
+            self._set_gradient(index, 0.0, 0.0)
+            return
+        if func == OPS.var_x or func == OPS.var_y or func == OPS.var_z:
+            if ((func == OPS.var_x and axis == 0) or (func == OPS.var_y and axis == 1) or
+                    (func == OPS.var_z and axis == 2)):
+                self._set_gradient(index, 1.0, 1.0)
+            else:
+                self._set_gradient(index, 0.0, 0.0)
+            return
+        index0 = arg0 * NUM_AXES + axis
+        dmin0 = self.mingrads[index0]
+        dmax0 = self.maxgrads[index0]
+        min0 = self.minvalues[arg0]
+        max0 = self.maxvalues[arg0]
+        # min, max, min4 and max4 don't propagate nans, so check explicitly
+        unknown = (math.isnan(dmin0) or math.isnan(dmax0) or
+                   math.isnan(min0) or math.isnan(max0))
+        if func == OPS.neg:
+            minimum, maximum = -dmax0, -dmin0
+        elif func == OPS.square:
+            # 2 * a * a'
+            minimum, maximum = self._mul(2.0 * min0, 2.0 * max0, dmin0, dmax0)
+        elif func == OPS.sqrt:
+            # a' / (2 * sqrt(a)), unbounded if a can get close to 0
+            if not min0 > 0.0:
+                minimum = maximum = float('nan')
+            else:
+                minimum, maximum = self._mul(dmin0, dmax0, 0.5 / math.sqrt(max0), 0.5 / math.sqrt(min0))
+        elif func == OPS.exp:
+            minimum, maximum = self._mul(dmin0, dmax0, exp_or_inf(min0), exp_or_inf(max0))
+        elif func == OPS.abs:
+            if min0 >= 0.0:
+                minimum, maximum = dmin0, dmax0
+            elif max0 <= 0.0:
+                minimum, maximum = -dmax0, -dmin0
+            else:
+                minimum, maximum = min(dmin0, -dmax0), max(dmax0, -dmin0)
+        else:
+            index1 = arg1 * NUM_AXES + axis
+            dmin1 = self.mingrads[index1]
+            dmax1 = self.maxgrads[index1]
+            min1 = self.minvalues[arg1]
+            max1 = self.maxvalues[arg1]
+            unknown = unknown or (math.isnan(dmin1) or math.isnan(dmax1) or
+                                  math.isnan(min1) or math.isnan(max1))
+            if func == OPS.add:
+                minimum, maximum = dmin0 + dmin1, dmax0 + dmax1
+            elif func == OPS.sub:
+                minimum, maximum = dmin0 - dmax1, dmax0 - dmin1
+            elif func == OPS.mul:
+                # a' * b + a * b'
+                min2, max2 = self._mul(dmin0, dmax0, min1, max1)
+                min3, max3 = self._mul(min0, max0, dmin1, dmax1)
+                minimum, maximum = min2 + min3, max2 + max3
+            elif func == OPS.min or func == OPS.max:
+                if (func == OPS.min and max0 < min1) or (func == OPS.max and min0 > max1):
+                    minimum, maximum = dmin0, dmax0
+                elif (func == OPS.min and max1 < min0) or (func == OPS.max and min1 > max0):
+                    minimum, maximum = dmin1, dmax1
+                else:
+                    minimum, maximum = min(dmin0, dmin1), max(dmax0, dmax1)
+            else:
+                raise ValueError("Invalid operation: %s" % op)
+        if unknown:
+            minimum = maximum = float('nan')
+        self._set_gradient(index, minimum, maximum)
+
+    def gradient_bound(self, op, axis):
+        """ The largest absolute value of the partial derivative of op along
+        axis, nan if it is not known. """
+        index = op * NUM_AXES + axis
+        return max(abs(self.mingrads[index]), abs(self.maxgrads[index]))
+
+
+def lipschitz_sign(program, a, b, c, d, context):
+    """ Try to prove that program has the same sign everywhere in the tile
+    [a, b] x [c, d] (with z = 0) from its value at the center and a bound of
+    its gradient over the tile. Return -1 if it is <= 0 everywhere, 1 if it
+    is > 0 everywhere and 0 if that can't be shown. """
+    frame = context.gradient_frame
+    if frame is None:
+        frame = context.gradient_frame = GradientFrame(program)
+    frame.reset(program)
+    minimum, maximum = frame.run_gradients(a, b, c, d, 0.0, 0.0)
+    result = program.num_operations() - 1
+    gx = frame.gradient_bound(result, 0)
+    gy = frame.gradient_bound(result, 1)
+    bound = gx * (b - a) * 0.5 + gy * (d - c) * 0.5
+    if math.isnan(bound) or math.isinf(bound):
+        return 0
+    direct = DirectFrame.new(context, program)
+    value = direct.run_floats(a * 0.5 + b * 0.5, c * 0.5 + d * 0.5, 0.0)
+    direct.delete()
+    if math.isnan(value):
+        return 0
+    bound += LIPSCHITZ_SLACK * (abs(value) + bound)
+    if value > bound:
+        context.stats.lipschitz_resolved += 1
+        return 1
+    if value < -bound:
+        context.stats.lipschitz_resolved += 1
+        return -1
+    return 0
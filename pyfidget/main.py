@@ -1,8 +1,11 @@
 import time
 from pyfidget.vm import render_image_naive, render_image_octree, write_ppm, DirectFrame, IntervalFrame, \
         render_image_octree_optimize, render_image_octree_optimize_graphviz
-from pyfidget.parse import parse
-from pyfidget.optimize import stats
+from pyfidget.tape import load_program
+from pyfidget.parse import ParseError
+from pyfidget.context import RenderContext
+from pyfidget.optimize import value_numbering, flatten_min_max, allocate_slots
+from pyfidget.costmodel import load_profile
 
 from rpython.rlib import jit
 from rpython.rlib.objectmodel import we_are_translated
@@ -19,13 +22,29 @@ def main(argv):
             del argv[i:i+2]
             jit.set_user_param(None, jitarg)
             break
+    profile = None
+    for i in range(len(argv)):
+        if argv[i] == "--profile":
+            if len(argv) == i + 1:
+                print("missing argument after --profile")
+                return 2
+            profile = argv[i + 1]
+            del argv[i:i+2]
+            break
 
     if len(argv) < 3:
-        print("Usage: %s <input.vm> <output.ppm> [length]" % argv[0])
+        print("Usage: %s [--profile <cost profile>] <input.vm, input.tape or - for stdin> <output.ppm> [length]" % argv[0])
         return 1
-    with open(argv[1]) as f:
-        code = f.read()
-    operations = parse(code)
+    context = RenderContext()
+    if profile is not None:
+        context.cost_model = load_profile(profile)
+    try:
+        program = load_program(argv[1])
+    except ParseError as e:
+        print("%s: %s" % (argv[1], e.format()))
+        return 1
+    operations = flatten_min_max(value_numbering(program, context), context)
+    allocate_slots(operations)
     phase = 0
     if len(argv) > 3:
         length = int(argv[3])
@@ -33,8 +52,8 @@ def main(argv):
             phase = int(argv[4])
     else:
         length = 1024
-    preallocated_frame = DirectFrame.new(operations)
-    preallocated_frame.setup(operations.num_operations())
+    preallocated_frame = DirectFrame.new(context, operations)
+    preallocated_frame.setup(operations.size_storage())
     preallocated_frame.delete()
     t1 = time.time()
     args = -1., 1., -1., 1.
@@ -42,7 +61,7 @@ def main(argv):
         args = NonConstant(-1.), NonConstant(1.), NonConstant(-1.), NonConstant(1.)
     data = None
     if phase == 0 or phase == 1:
-        frame = DirectFrame.new(operations)
+        frame = DirectFrame.new(context, operations)
         data = render_image_naive(frame, length, length, *args)
         frame.delete()
         t2 = time.time()
@@ -55,22 +74,29 @@ def main(argv):
         print("time, octree: %s" % (t2 - t1))
     if phase == 0 or phase == 3:
         t1 = time.time()
-        data = render_image_octree_optimize(operations, length, length, *args)
+        data = render_image_octree_optimize(operations, length, length, *args, context=context)
         t2 = time.time()
         print("time, octree with optimizer: %s" % (t2 - t1))
     if phase == 4:
         t1 = time.time()
         for i in range(100):
-            data = render_image_octree_optimize(operations, length, length, *args)
+            data = render_image_octree_optimize(operations, length, length, *args, context=context)
         t2 = time.time()
         print("time, octree with optimizer, 500 times, average: %s" % ((t2 - t1) / 500.))
         return 0
+    if phase == 6:
+        t1 = time.time()
+        context.adaptive = True
+        data = render_image_octree_optimize(operations, length, length, *args, context=context)
+        t2 = time.time()
+        print("time, octree with adaptive optimizer: %s" % (t2 - t1))
+        print("%s tiles not specialized" % context.stats.specializations_skipped)
     if phase == 5:
         frame = IntervalFrame(operations)
-        output = render_image_octree_optimize_graphviz(frame, length, length, *args)
+        output = render_image_octree_optimize_graphviz(frame, length, length, *args, context=context)
         with open(argv[2], 'w') as f:
             f.write('\n'.join(output))
-        stats.print_stats()
+        context.stats.print_stats()
         return 0
 
     if data is not None:
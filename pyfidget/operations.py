@@ -19,6 +19,9 @@ class Opnums(object):
     def is_symmetric(self, char):
         return is_symmetric[self.mask_to_int(char)]
 
+    def is_fused(self, char):
+        return is_fused[self.mask_to_int(char)]
+
     def mask_to_int(self, char):
         return ord(char) & 0x3f
 
@@ -39,12 +42,14 @@ opname_to_char = {}
 opnames = []
 numargs = []
 is_symmetric = []
+is_fused = []
 
-def add_op(name, num_args, symmetric=False):
+def add_op(name, num_args, symmetric=False, fused=False):
     opname_to_char[name] = chr(len(opname_to_char))
     opnames.append(name)
     numargs.append(num_args)
     is_symmetric.append(symmetric)
+    is_fused.append(fused)
 
 add_op('var-x', 0)
 add_op('var-y', 0)
@@ -60,6 +65,12 @@ add_op('sub', 2)
 add_op('mul', 2, symmetric=True)
 add_op('max', 2, symmetric=True)
 add_op('min', 2, symmetric=True)
+# fused ops, see optimize.fuse_ops. only the leaf renderer makes and runs
+# them, they never appear in a program or a tape file.
+# sqrt(a * a + b * b)
+add_op('hypot2', 2, symmetric=True, fused=True)
+# (a - b) * (a - b)
+add_op('sub-square', 2, symmetric=True, fused=True)
 
 OPS = Opnums()
 for name, char in opname_to_char.iteritems():
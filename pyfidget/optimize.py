@@ -3,10 +3,13 @@ import math
 import sys
 
 from rpython.rlib import jit, objectmodel
+from rpython.rlib.rfloat import copysign
 from rpython.tool.udir import udir
 
 from pyfidget.operations import OPS
-from pyfidget.vm import ProgramBuilder, IntervalFrame
+from pyfidget.vm import ProgramBuilder, IntervalFrame, SlotAllocator, AXIS_X, AXIS_Y, any_nan, INF
+from pyfidget.context import RenderContext
+from pyfidget.affine import AffineFrame
 
 from dotviewer.graphpage import GraphPage as BaseGraphPage
 
@@ -82,18 +85,32 @@ def graph(res, d=None):
         f.write(dot)
     GraphPage(dot, {"_%x" % op: res.op_to_str(op) for op in res}).display()
 
-def optimize(program, a, b, c, d, e, f, for_direct=True):
+def optimize(program, a, b, c, d, e, f, for_direct=True, context=None, minbounds=None, maxbounds=None):
+    """ Specialize program for the box. minbounds and maxbounds can be the
+    intervals of all the ops of program in the box, if the caller computed
+    them already, e.g. with batch.NumpyIntervalFrame. """
     for_direct = True
-    opt = Optimizer.new(program)
-    result = opt.optimize(a, b, c, d, e, f)
+    if context is None:
+        context = RenderContext()
+    if context.choice_tape:
+        res, minimum, maximum = slice_program(program, a, b, c, d, e, f, for_direct, context)
+    else:
+        res, minimum, maximum = _optimize(program, a, b, c, d, e, f, for_direct, context, minbounds, maxbounds)
+    if res is not None and context.tape_cache is not None:
+        res = context.tape_cache.share(res, context.stats)
+    return res, minimum, maximum
+
+def _optimize(program, a, b, c, d, e, f, for_direct, context, minbounds=None, maxbounds=None):
+    opt = Optimizer.new(context, program)
+    result = opt.optimize(a, b, c, d, e, f, minbounds, maxbounds)
     resultops = opt.resultops
     minimum = opt.intervalframe.minvalues[result]
     maximum = opt.intervalframe.maxvalues[result]
-    if (isfinite(minimum) and isfinite(maximum)) and (minimum > 0.0 or maximum <= 0):
+    if not math.isnan(minimum) and not math.isnan(maximum) and (minimum > 0.0 or maximum <= 0):
         opt.delete()
         resultops.delete()
         return None, minimum, maximum
-    result = work_backwards(resultops, result, opt.intervalframe.minvalues, opt.intervalframe.maxvalues, for_direct=for_direct)
+    result = opt.work_backwards(result, for_direct)
     res = opt.dce(result)
     #if not objectmodel.we_are_translated() and for_direct:
     #    print(res.num_operations(), "NUMOPS")
@@ -109,6 +126,19 @@ def optimize(program, a, b, c, d, e, f, for_direct=True):
 
 opt_program = optimize
 
+def slice_program(program, a, b, c, d, e, f, for_direct=True, context=None):
+    """ Like optimize, but specialize program with a ChoiceSlicer. """
+    if context is None:
+        context = RenderContext()
+    slicer = ChoiceSlicer.new(context)
+    minimum, maximum = slicer.run_choices(program, a, b, c, d, e, f)
+    if not math.isnan(minimum) and not math.isnan(maximum) and (minimum > 0.0 or maximum <= 0):
+        slicer.delete()
+        return None, minimum, maximum
+    res = slicer.slice(program, for_direct)
+    slicer.delete()
+    return res, minimum, maximum
+
 def symmetric(func):
     name = func.func_name[len('opt_'):]
     underscore_name = "_" + name
@@ -126,125 +156,105 @@ def symmetric(func):
 
 WINDOW_SIZE = 100
 
-class Stats(object):
-    total_ops = 0
-    dedup_const_worked = 0
-    cse_worked = 0
-    constfold = 0
-    abs_pos = 0
-    abs_neg = 0
-    abs_of_neg = 0
-    neg_neg = 0
-    square_of_neg = 0
-    add0 = 0
-    sub_self = 0
-    zero_sub = 0
-    sub_zero = 0
-    min_range = 0
-    min_self = 0
-    min_min_self = 0
-    max_range = 0
-    max_self = 0
-    max_max_self = 0
-    mul_self = 0
-    mul0 = 0
-    mul1 = 0
-    mul_neg1 = 0
-
-    backwards_shortening = 0
-
-    ops_executed = 0
-    ops_skipped = 0
-    ops_optimized = 0
-    ops_optimized_checked = 0
-    ops_optimized_skipped = 0
-
-    ops = [0] * 14
-
-    def print_stats(self):
-        print('total_ops', self.total_ops)
-        print('dedup_const_worked', self.dedup_const_worked)
-        print('cse_worked', self.cse_worked)
-        print('constfold', self.constfold)
-        if self.ops[ord(OPS.abs)]:
-            print('abs_pos', self.abs_pos)
-            print('abs_neg', self.abs_neg)
-            print('abs_of_neg', self.abs_of_neg)
-        print('neg_neg', self.neg_neg)
-        print('square_of_neg', self.square_of_neg)
-        print('add0', self.add0)
-        print('sub_self', self.sub_self)
-        print('zero_sub', self.zero_sub)
-        print('sub_zero', self.sub_zero)
-        print('min_range', self.min_range)
-        print('min_self', self.min_self)
-        print('min_min_self', self.min_min_self)
-        print('max_range', self.max_range)
-        print('max_self', self.max_self)
-        print('max_max_self', self.max_max_self)
-        print('mul_self', self.mul_self)
-        print('mul0', self.mul0)
-        print('mu1', self.mul1)
-        print('mul_neg1', self.mul_neg1)
-        print()
-        print('backwards_shortening', self.backwards_shortening)
-        print()
-
-        for index, value in enumerate(self.ops):
-            print(OPS.char_to_name(chr(index)), value)
-
-        print()
-        print('ops_executed', self.ops_executed)
-        print('ops_skipped', self.ops_skipped)
-        print('ops_optimized', self.ops_optimized)
-        print('ops_optimized_checked', self.ops_optimized_checked)
-        print('ops_optimized_skipped', self.ops_optimized_skipped)
-
-
-stats = Stats()
-
-
-class MemManager(object):
-    unused_optimizer = None
-
-mem_manager = MemManager()
+# how many x ranges and y ranges AxisIntervals keeps per program
+AXIS_INTERVAL_ENTRIES = 2
+
+class AxisIntervalEntry(object):
+    def __init__(self, num_ops):
+        self.minimum = self.maximum = float('nan')
+        self.known = [False] * num_ops
+        self.minvalues = [0.0] * num_ops
+        self.maxvalues = [0.0] * num_ops
+
+    def clear(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        for i in range(len(self.known)):
+            self.known[i] = False
+
+class AxisIntervals(object):
+    """ The intervals that the optimizer computed for the ops of a program
+    that only depend on x or only on y, for the last few x and y ranges that
+    the program was specialized for. Of the four children of a tile, two
+    share their x range and two their y range, so every such interval only
+    has to be computed twice instead of four times. Only ops that the
+    optimizer emitted unchanged get an entry: all the rewrites of an op only
+    depend on its arguments, so they happen the same way for every range. """
+
+    def __init__(self, num_ops):
+        self.x_entries = [AxisIntervalEntry(num_ops) for i in range(AXIS_INTERVAL_ENTRIES)]
+        self.y_entries = [AxisIntervalEntry(num_ops) for i in range(AXIS_INTERVAL_ENTRIES)]
+        self.next_x = 0
+        self.next_y = 0
+
+    def x_entry(self, minimum, maximum):
+        for entry in self.x_entries:
+            if entry.minimum == minimum and entry.maximum == maximum:
+                return entry
+        entry = self.x_entries[self.next_x]
+        self.next_x = (self.next_x + 1) % AXIS_INTERVAL_ENTRIES
+        entry.clear(minimum, maximum)
+        return entry
 
+    def y_entry(self, minimum, maximum):
+        for entry in self.y_entries:
+            if entry.minimum == minimum and entry.maximum == maximum:
+                return entry
+        entry = self.y_entries[self.next_y]
+        self.next_y = (self.next_y + 1) % AXIS_INTERVAL_ENTRIES
+        entry.clear(minimum, maximum)
+        return entry
 
 class Optimizer(object):
-    def __init__(self, program):
+    def __init__(self, program, context=None):
+        if context is None:
+            context = RenderContext()
+        self.context = context
+        self.stats = context.stats
         self.program = program
         num_operations = program.num_operations()
-        self.resultops = ProgramBuilder.new(num_operations)
-        self.intervalframe = IntervalFrame(self.program)
+        self.resultops = program.new_builder(context, num_operations)
+        if context.affine:
+            self.intervalframe = AffineFrame(self.program)
+        else:
+            self.intervalframe = IntervalFrame(self.program)
         # old index -> new index
         self.opreplacements = [0] * num_operations
+        # the demands of work_backwards
+        self.demands = [0] * num_operations
+        # the operands of the chain that _optimize_chain works on
+        self.operands = []
+        self.slot_allocator = SlotAllocator()
         self.index = 0
+        # the interval that opt_default got last, before refining it
+        self.last_minimum = self.last_maximum = 0.0
         #self.seen_consts = {}
         self.next = None
 
     def _reset(self, program):
         num_operations = program.num_operations()
-        self.resultops = ProgramBuilder.new(num_operations)
+        self.resultops = program.new_builder(self.context, num_operations)
         self.intervalframe.reset(program)
         self.index = 0
         if len(self.opreplacements) < num_operations:
             self.opreplacements = [0] * num_operations
+            self.demands = [0] * num_operations
         self.program = program
 
     @staticmethod
-    def new(program):
-        if mem_manager.unused_optimizer is not None:
-            res = mem_manager.unused_optimizer
-            mem_manager.unused_optimizer = res.next
+    def new(context, program):
+        if context.unused_optimizer is not None:
+            res = context.unused_optimizer
+            context.unused_optimizer = res.next
             res.next = None
             res._reset(program)
             return res
-        return Optimizer(program)
+        return Optimizer(program, context)
 
     def delete(self):
         self.program = None
-        self.next = mem_manager.unused_optimizer
-        mem_manager.unused_optimizer = self
+        self.next = self.context.unused_optimizer
+        self.context.unused_optimizer = self
 
     def get_replacement(self, op):
         return self.opreplacements[op]
@@ -254,48 +264,208 @@ class Optimizer(object):
 
     def newconst(self, value):
         #if value in self.seen_consts:
-        #    stats.dedup_const_worked += 1
+        #    self.stats.dedup_const_worked += 1
         #    return self.seen_consts[value]
         const = self.resultops.add_const(value)
-        self.intervalframe.minvalues[const] = value
-        self.intervalframe.maxvalues[const] = value
+        self.intervalframe.make_constant(value, const)
         #self.seen_consts[value] = const
         return const
 
-    def optimize(self, a, b, c, d, e, f):
+    def optimize(self, a, b, c, d, e, f, minbounds=None, maxbounds=None):
         program = self.program
         self.intervalframe.setup(self.program.num_operations())
         self.intervalframe.setxyz(a, b, c, d, e, f)
         numops = program.num_operations()
-        stats.ops_optimized += numops
-        for index in range(numops):
-            stats.total_ops += 1
-            func = program.get_func(index)
-            newop = self._optimize_op(index)
+        self.stats.ops_optimized += numops
+        axes = program.get_axes()
+        # the intervals are stored on the program, so they are only shared for
+        # programs of this context. the input program of a render can be
+        # specialized by several renders at once
+        x_entry = y_entry = None
+        if minbounds is None and program.context is self.context:
+            axis_intervals = program.axis_intervals
+            if axis_intervals is None:
+                axis_intervals = program.axis_intervals = AxisIntervals(numops)
+            x_entry = axis_intervals.x_entry(a, b)
+            y_entry = axis_intervals.y_entry(c, d)
+        chains = program.get_chains()
+        index = 0
+        while index < numops:
+            self.stats.total_ops += 1
+            end = chains[index]
+            if end > index:
+                newop = self._optimize_chain(index, end)
+                self.stats.total_ops += end - index
+                # the ops of the chain are only used by the next one
+                while index < end:
+                    self.opreplacements[index] = newop
+                    index += 1
+                func = program.get_func(index)
+            elif minbounds is not None:
+                assert maxbounds is not None
+                func = program.get_func(index)
+                newop = self._optimize_op_bounded(index, minbounds[index], maxbounds[index])
+            else:
+                func = program.get_func(index)
+                if axes[index] == AXIS_X:
+                    entry = x_entry
+                elif axes[index] == AXIS_Y:
+                    entry = y_entry
+                else:
+                    entry = None
+                if entry is not None and entry.known[index]:
+                    newop = self._optimize_op_cached(index, entry)
+                else:
+                    num_resultops = self.resultops.num_operations()
+                    newop = self._optimize_op(index)
+                    if entry is not None and newop == num_resultops and self._is_unchanged(index, newop):
+                        entry.known[index] = True
+                        entry.minvalues[index] = self.last_minimum
+                        entry.maxvalues[index] = self.last_maximum
             if OPS.should_return_if_pos(func):
-                stats.ops_optimized_checked += 1
+                self.stats.ops_optimized_checked += 1
                 if self.intervalframe.minvalues[newop] > 0:
-                    stats.ops_optimized_skipped += numops - index - 1
+                    self.stats.ops_optimized_skipped += numops - index - 1
                     return newop
             if OPS.should_return_if_neg(func):
-                stats.ops_optimized_checked += 1
+                self.stats.ops_optimized_checked += 1
                 if self.intervalframe.maxvalues[newop] <= 0.0:
-                    stats.ops_optimized_skipped += numops - index - 1
+                    self.stats.ops_optimized_skipped += numops - index - 1
                     return newop
             self.opreplacements[index] = newop
+            index += 1
         return self.opreplacements[numops - 1]
 
     def get_func(self, index):
         return OPS.mask(self.resultops.get_func(index))
 
+    def _is_unchanged(self, op, newop):
+        # whether the optimizer emitted op as newop with the same func and
+        # the replacements of the same args
+        func, arg0, arg1 = self.program.get_func_and_args(op)
+        func = OPS.mask(func)
+        newfunc, newarg0, newarg1 = self.resultops.get_func_and_args(newop)
+        if func == OPS.const or newfunc != func:
+            return False
+        numargs = OPS.num_args(func)
+        if numargs == 0:
+            return True
+        if newarg0 != self.get_replacement(arg0):
+            return False
+        if numargs == 1:
+            return newarg1 == 0
+        return newarg1 == self.get_replacement(arg1)
+
+    def _optimize_op_cached(self, op, entry):
+        # emit op like its sibling did, with the interval it computed
+        func, arg0, arg1 = self.program.get_func_and_args(op)
+        func = OPS.mask(func)
+        self.stats.ops[ord(func)] += 1
+        self.stats.axis_intervals_reused += 1
+        numargs = OPS.num_args(func)
+        if numargs == 0:
+            arg0 = arg1 = 0
+        elif numargs == 1:
+            arg0 = self.get_replacement(arg0)
+            arg1 = 0
+        else:
+            arg0 = self.get_replacement(arg0)
+            arg1 = self.get_replacement(arg1)
+        return self.opt_default(func, entry.minvalues[op], entry.maxvalues[op], arg0, arg1)
+
+    def _optimize_op_bounded(self, op, minimum, maximum):
+        # emit op with the interval that the caller computed for it. the
+        # replacement of an op computes the same values, so the interval
+        # stays valid for it. only the arguments of min and max that can't
+        # be the result are dropped, the other rewrites need the intervals
+        # of the replacements
+        intervalframe = self.intervalframe
+        func, arg0, arg1 = self.program.get_func_and_args(op)
+        func = OPS.mask(func)
+        self.stats.ops[ord(func)] += 1
+        self.stats.batched_intervals_reused += 1
+        if func == OPS.const:
+            return self.newconst(self.program.get_const(arg0))
+        numargs = OPS.num_args(func)
+        if numargs == 0:
+            arg0 = arg1 = 0
+        elif numargs == 1:
+            arg0 = self.get_replacement(arg0)
+            arg1 = 0
+        else:
+            arg0 = self.get_replacement(arg0)
+            arg1 = self.get_replacement(arg1)
+            if func == OPS.min:
+                if intervalframe.maxvalues[arg0] < intervalframe.minvalues[arg1]:
+                    self.stats.min_range += 1
+                    return arg0
+                if intervalframe.maxvalues[arg1] < intervalframe.minvalues[arg0]:
+                    self.stats.min_range += 1
+                    return arg1
+            elif func == OPS.max:
+                if intervalframe.minvalues[arg0] > intervalframe.maxvalues[arg1]:
+                    self.stats.max_range += 1
+                    return arg0
+                if intervalframe.minvalues[arg1] > intervalframe.maxvalues[arg0]:
+                    self.stats.max_range += 1
+                    return arg1
+        return self.opt_default(func, minimum, maximum, arg0, arg1)
+
+    def _optimize_chain(self, start, end):
+        # optimize the chain of min or max ops from start to end at once:
+        # an operand whose lower bound is above the smallest upper bound of
+        # all the operands of a min can never be the result, even if it is
+        # not above the bound of any single other op of the chain
+        program = self.program
+        intervalframe = self.intervalframe
+        func, arg0, _ = program.get_func_and_args(start)
+        func = OPS.mask(func)
+        self.stats.ops[ord(func)] += end - start + 1
+        operands = self.operands
+        del operands[:]
+        operands.append(self.get_replacement(arg0))
+        for op in range(start, end + 1):
+            operands.append(self.get_replacement(program.get_args(op)[1]))
+        if func == OPS.min:
+            bound = INF
+            for arg in operands:
+                if intervalframe.maxvalues[arg] < bound:
+                    bound = intervalframe.maxvalues[arg]
+        else:
+            bound = -INF
+            for arg in operands:
+                if intervalframe.minvalues[arg] > bound:
+                    bound = intervalframe.minvalues[arg]
+        res = -1
+        for arg in operands:
+            argminimum = intervalframe.minvalues[arg]
+            argmaximum = intervalframe.maxvalues[arg]
+            if (func == OPS.min and argminimum > bound) or (func == OPS.max and argmaximum < bound):
+                self.stats.chain_pruned += 1
+                continue
+            if res < 0:
+                res = arg
+                continue
+            resminimum = intervalframe.minvalues[res]
+            resmaximum = intervalframe.maxvalues[res]
+            if func == OPS.min:
+                res = self.opt_min(res, arg, resminimum, resmaximum, argminimum, argmaximum)
+            else:
+                res = self.opt_max(res, arg, resminimum, resmaximum, argminimum, argmaximum)
+        return res
+
     def opt_default(self, func, minimum, maximum, arg0=0, arg1=0):
+        self.last_minimum = minimum
+        self.last_maximum = maximum
+        minimum, maximum = self.intervalframe.refine(func, arg0, arg1, minimum, maximum)
         if minimum == maximum and not math.isnan(minimum) and not math.isinf(minimum):
-            stats.constfold += 1
+            self.stats.constfold += 1
             newop = self.newconst(minimum)
         else:
             #newop = self.cse(func, arg0, arg1)
             #if newop < 0:
                 newop = self.newop(func, arg0, arg1)
+                self.intervalframe.commit(newop)
         self.intervalframe._set(newop, minimum, maximum)
         return newop
 
@@ -309,7 +479,7 @@ class Optimizer(object):
             other_arg0, other_arg1 = self.resultops.get_args(index)
             if (other_arg0 == arg0 and other_arg1 == arg1) or (
                     symmetric and other_arg1 == arg0 and other_arg0 == arg1):
-                stats.cse_worked += 1
+                self.stats.cse_worked += 1
                 return index
         return -1
 
@@ -321,7 +491,7 @@ class Optimizer(object):
         assert arg0 >= 0
         assert arg1 >= 0
         func = OPS.mask(func)
-        stats.ops[ord(func)] += 1
+        self.stats.ops[ord(func)] += 1
         if func == OPS.var_x:
             minimum = intervalframe.minx
             maximum = intervalframe.maxx
@@ -335,7 +505,7 @@ class Optimizer(object):
             maximum = intervalframe.maxz
             return self.opt_default(OPS.var_z, minimum, maximum)
         if func == OPS.const:
-            const = program.consts[arg0]
+            const = program.get_const(arg0)
             return self.newconst(const)
         arg0 = self.get_replacement(arg0)
         arg1 = self.get_replacement(arg1)
@@ -374,14 +544,14 @@ class Optimizer(object):
 
     def opt_abs(self, arg0, arg0minimum, arg0maximum):
         if arg0minimum >= 0:
-            stats.abs_pos += 1
+            self.stats.abs_pos += 1
             return arg0
         if arg0maximum < 0:
-            stats.abs_neg += 1
+            self.stats.abs_neg += 1
             return self.opt_neg(arg0, arg0minimum, arg0maximum)
         func, arg0arg0, _ = self.resultops.get_func_and_args(arg0)
         if OPS.mask(func) == OPS.neg:
-            stats.abs_of_neg += 1
+            self.stats.abs_of_neg += 1
             minimum, maximum = self.intervalframe.minvalues[arg0arg0], self.intervalframe.maxvalues[arg0arg0]
             return self.opt_abs(arg0arg0, minimum, maximum)
         minimum, maximum = self.intervalframe._abs(arg0minimum, arg0maximum)
@@ -390,7 +560,7 @@ class Optimizer(object):
     def opt_square(self, arg0, arg0minimum, arg0maximum):
         func, arg0arg0, _ = self.resultops.get_func_and_args(arg0)
         if OPS.mask(func) == OPS.neg:
-            stats.square_of_neg += 1
+            self.stats.square_of_neg += 1
             minimum, maximum = self.intervalframe.minvalues[arg0arg0], self.intervalframe.maxvalues[arg0arg0]
             return self.opt_square(arg0arg0, minimum, maximum)
         minimum, maximum = self.intervalframe._square(arg0minimum, arg0maximum)
@@ -403,7 +573,7 @@ class Optimizer(object):
     def opt_neg(self, arg0, arg0minimum, arg0maximum):
         func, arg0arg0, _ = self.resultops.get_func_and_args(arg0)
         if OPS.mask(func) == OPS.neg:
-            stats.neg_neg += 1
+            self.stats.neg_neg += 1
             return arg0arg0
         minimum, maximum = self.intervalframe._neg(arg0minimum, arg0maximum)
         return self.opt_default(OPS.neg, minimum, maximum, arg0)
@@ -411,19 +581,20 @@ class Optimizer(object):
     @symmetric
     def opt_add(self, arg0, arg1, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
         if arg0minimum == arg0maximum == 0:
-            stats.add0 += 1
+            self.stats.add0 += 1
             return arg1
         return -1
 
     def opt_sub(self, arg0, arg1, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
-        if arg0 == arg1:
-            stats.sub_self += 1
+        if arg0 == arg1 and isfinite(arg0minimum) and isfinite(arg0maximum):
+            # inf - inf is nan
+            self.stats.sub_self += 1
             return self.newconst(0.0)
         if arg0minimum == arg0maximum == 0:
-            stats.zero_sub += 1
+            self.stats.zero_sub += 1
             return self.opt_neg(arg1, arg1minimum, arg1maximum)
         if arg1minimum == arg1maximum == 0:
-            stats.sub_zero += 1
+            self.stats.sub_zero += 1
             return arg0
         minimum, maximum = self.intervalframe._sub(arg0minimum, arg0maximum, arg1minimum, arg1maximum)
         return self.opt_default(OPS.sub, minimum, maximum, arg0, arg1)
@@ -431,62 +602,77 @@ class Optimizer(object):
     @symmetric
     def opt_min(self, arg0, arg1, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
         if arg0maximum < arg1minimum:
-            stats.min_range += 1
+            self.stats.min_range += 1
             return arg0
         if arg0 == arg1:
-            stats.min_self += 1
+            self.stats.min_self += 1
             return arg0
         func, arg0arg0, arg0arg1 = self.resultops.get_func_and_args(arg0)
         if OPS.mask(func) == OPS.min:
             # min(a, min(a, b)) -> min(a, b)
             if arg0arg0 == arg1 or arg0arg1 == arg1:
-                stats.min_min_self += 1
+                self.stats.min_min_self += 1
                 return arg0
         return -1
 
     @symmetric
     def opt_max(self, arg0, arg1, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
         if arg0minimum > arg1maximum:
-            stats.max_range += 1
+            self.stats.max_range += 1
             return arg0
         if arg0 == arg1:
-            stats.max_self += 1
+            self.stats.max_self += 1
             return arg0
         func, arg0arg0, arg0arg1 = self.resultops.get_func_and_args(arg0)
         if OPS.mask(func) == OPS.max:
             # max(a, max(a, b)) -> max(a, b)
             if arg0arg0 == arg1 or arg0arg1 == arg1:
-                stats.max_max_self += 1
+                self.stats.max_max_self += 1
                 return arg0
         return -1
 
     @symmetric
     def opt_mul(self, arg0, arg1, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
         if arg0 == arg1:
-            stats.mul_self += 1
+            self.stats.mul_self += 1
             return self.opt_square(arg0, arg0minimum, arg0maximum)
         if arg0minimum == arg0maximum:
-            if arg0minimum == 0.0:
-                stats.mul0 += 1
+            if arg0minimum == 0.0 and isfinite(arg1minimum) and isfinite(arg1maximum):
+                # 0 * inf is nan
+                self.stats.mul0 += 1
                 return self.newconst(0.0)
             if arg0maximum == 1.0:
-                stats.mul1 += 1
+                self.stats.mul1 += 1
                 return arg1
             if arg0maximum == -1.0:
-                stats.mul_neg1 += 1
+                self.stats.mul_neg1 += 1
                 return self.opt_neg(arg1, arg1minimum, arg1maximum)
         return -1
 
+    def work_backwards(self, result, for_direct):
+        num_ops = result + 1
+        if len(self.opreplacements) < num_ops:
+            self.opreplacements = [0] * num_ops
+        if len(self.demands) < num_ops:
+            self.demands = [0] * num_ops
+        intervalframe = self.intervalframe
+        return work_backwards(self.resultops, result, intervalframe.minvalues, intervalframe.maxvalues,
+                              for_direct, self.stats, self.demands, self.opreplacements)
+
     def dce(self, final_op):
         ops = self.resultops
-        def mark_alive(new_positions, arg):
+        allocator = self.slot_allocator
+        allocator.reset()
+        def mark_alive(new_positions, allocator, arg):
             if new_positions[arg] == -1:
-                new_positions[arg] = 0
-        # reuse no longer used opreplacements lists
+                # the last use of arg, it needs a slot from here on
+                new_positions[arg] = allocator.take()
+        # reuse no longer used opreplacements lists. during the backwards
+        # pass they contain the slot of every alive op, -1 for dead ones
         new_positions = self.opreplacements
         for i in range(final_op):
             new_positions[i] = -1
-        new_positions[final_op] = 0
+        new_positions[final_op] = allocator.take()
         alive_ops = 0
         alive_consts = 0
         for index in range(final_op, -1, -1):
@@ -494,30 +680,33 @@ class Optimizer(object):
                 continue
             alive_ops += 1
             func, arg0, arg1 = ops.get_func_and_args(index)
-            if func == OPS.const:
-                alive_consts += 1
-                continue
-            numargs = OPS.num_args(func)
-            if numargs == 0:
-                pass
-            else:
-                if numargs == 1:
-                    mark_alive(new_positions, arg0)
+            if func != OPS.const:
+                numargs = OPS.num_args(func)
+                if numargs == 0:
+                    pass
                 else:
-                    mark_alive(new_positions, arg0)
-                    mark_alive(new_positions, arg1)
+                    if numargs == 1:
+                        mark_alive(new_positions, allocator, arg0)
+                    else:
+                        mark_alive(new_positions, allocator, arg0)
+                        mark_alive(new_positions, allocator, arg1)
+            else:
+                alive_consts += 1
+            # the ops before don't see the value, so they can use the slot.
+            # only after taking the slots of the arguments, the frames don't
+            # all read their arguments before writing the result
+            allocator.give_back(new_positions[index])
+        slots = [0] * alive_ops
         index = 0
 
         # fiddly, but saves time: move the operations in the ops ProgramBuilder in place
         ops.reset()
         for op in range(final_op + 1):
             if new_positions[index] >= 0:
-                func = ops.funcs[op]
-                arg0 = ops.arguments[op*2]
+                func, arg0, arg1 = ops.get_stale_func_and_args(op)
                 if func == OPS.const:
-                    newop = ops.add_const(ops.consts[arg0])
+                    newop = ops.add_const(ops.get_const(arg0))
                 else:
-                    arg1 = ops.arguments[op*2 + 1]
                     numargs = OPS.num_args(func)
                     if numargs == 0:
                         arg0 = arg1 = 0
@@ -528,11 +717,158 @@ class Optimizer(object):
                         arg0 = new_positions[arg0]
                         arg1 = new_positions[arg1]
                     newop = ops.add_op(func, arg0, arg1)
+                slots[newop] = new_positions[index]
                 new_positions[index] = newop
             index += 1
+        ops.set_slots(slots, allocator.num_slots)
+        self.context.stats.slots_saved += alive_ops - allocator.num_slots
         self.resultops = None
         return ops
 
+# the operands of a min or max that can still be its result in a box
+CHOICE_LEFT = 1
+CHOICE_RIGHT = 2
+CHOICE_BOTH = CHOICE_LEFT | CHOICE_RIGHT
+
+class ChoiceSlicer(object):
+    """ A cheaper alternative to the Optimizer, like the tape simplification
+    of fidget: one interval pass over the program records for every min and
+    max which of its operands can be the result in the box, then one pass
+    backwards and one forwards slice out all the ops that are no longer
+    needed. Apart from replacing a min or max by one of its operands nothing
+    is rewritten. """
+
+    def __init__(self, context=None):
+        if context is None:
+            context = RenderContext()
+        self.context = context
+        self.intervalframe = IntervalFrame(None)
+        self.choices = None
+        self.new_positions = None
+        self.slot_allocator = SlotAllocator()
+        self.next = None
+
+    @staticmethod
+    def new(context):
+        if context.unused_slicer is not None:
+            res = context.unused_slicer
+            context.unused_slicer = res.next
+            res.next = None
+            return res
+        return ChoiceSlicer(context)
+
+    def delete(self):
+        self.intervalframe.reset(None)
+        self.next = self.context.unused_slicer
+        self.context.unused_slicer = self
+
+    def run_choices(self, program, a, b, c, d, e, f):
+        """ Compute the intervals of all ops of program in the box and record
+        the choices of the mins and maxs. Return the interval of the
+        result. """
+        num_ops = program.num_operations()
+        frame = self.intervalframe
+        frame.reset(program)
+        frame.setup(num_ops)
+        frame.setxyz(a, b, c, d, e, f)
+        if self.choices is None or len(self.choices) < num_ops:
+            self.choices = [0] * num_ops
+            self.new_positions = [0] * num_ops
+        choices = self.choices
+        self.context.stats.ops_optimized += num_ops
+        for op in range(num_ops):
+            frame._run_op(op)
+            func, arg0, arg1 = program.get_func_and_args(op)
+            func = OPS.mask(func)
+            if func == OPS.min or func == OPS.max:
+                choices[op] = self._choice(func, arg0, arg1)
+        return frame.minvalues[num_ops - 1], frame.maxvalues[num_ops - 1]
+
+    def _choice(self, func, arg0, arg1):
+        frame = self.intervalframe
+        arg0minimum = frame.minvalues[arg0]
+        arg0maximum = frame.maxvalues[arg0]
+        arg1minimum = frame.minvalues[arg1]
+        arg1maximum = frame.maxvalues[arg1]
+        if any_nan(arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+            return CHOICE_BOTH
+        if func == OPS.min:
+            if arg0maximum < arg1minimum:
+                return CHOICE_LEFT
+            if arg1maximum < arg0minimum:
+                return CHOICE_RIGHT
+        else:
+            if arg0minimum > arg1maximum:
+                return CHOICE_LEFT
+            if arg1minimum > arg0maximum:
+                return CHOICE_RIGHT
+        return CHOICE_BOTH
+
+    def slice(self, program, for_direct=True):
+        """ Return a new program with only the ops that the result still
+        needs with the choices of the last run_choices. """
+        num_ops = program.num_operations()
+        choices = self.choices
+        # old index -> -1 if dead, then the new index
+        new_positions = self.new_positions
+        for op in range(num_ops - 1):
+            new_positions[op] = -1
+        new_positions[num_ops - 1] = 0
+        for op in range(num_ops - 1, -1, -1):
+            if new_positions[op] < 0:
+                continue
+            func, arg0, arg1 = program.get_func_and_args(op)
+            func = OPS.mask(func)
+            if func == OPS.const:
+                continue
+            numargs = OPS.num_args(func)
+            if func == OPS.min or func == OPS.max:
+                choice = choices[op]
+                if choice & CHOICE_LEFT:
+                    new_positions[arg0] = 0
+                if choice & CHOICE_RIGHT:
+                    new_positions[arg1] = 0
+            elif numargs >= 1:
+                new_positions[arg0] = 0
+                if numargs == 2:
+                    new_positions[arg1] = 0
+        resultops = program.new_builder(self.context, num_ops)
+        for op in range(num_ops):
+            if new_positions[op] < 0:
+                continue
+            func, arg0, arg1 = program.get_func_and_args(op)
+            func = OPS.mask(func)
+            if func == OPS.const:
+                newop = resultops.add_const(program.get_const(arg0))
+            elif (func == OPS.min or func == OPS.max) and choices[op] != CHOICE_BOTH:
+                # the op is replaced by the operand it chose
+                if choices[op] == CHOICE_LEFT:
+                    newop = new_positions[arg0]
+                else:
+                    newop = new_positions[arg1]
+            else:
+                numargs = OPS.num_args(func)
+                if numargs == 0:
+                    arg0 = arg1 = 0
+                elif numargs == 1:
+                    arg0 = new_positions[arg0]
+                    arg1 = 0
+                else:
+                    arg0 = new_positions[arg0]
+                    arg1 = new_positions[arg1]
+                newop = resultops.add_op(func, arg0, arg1)
+            new_positions[op] = newop
+        # everything that the result needs comes before it, so it is the
+        # last op, even if it is the operand of a min or max
+        result = new_positions[num_ops - 1]
+        assert result == resultops.num_operations() - 1
+        self.context.stats.choices_sliced += num_ops - resultops.num_operations()
+        if for_direct:
+            convert_to_shortcut(resultops, result)
+        allocate_slots(resultops, self.slot_allocator)
+        return resultops
+
+
 def convert_to_shortcut(resultops, op):
     func = OPS.mask(resultops.get_func(op))
     if func == OPS.min:
@@ -547,7 +883,7 @@ def convert_check_negative(resultops, op):
         func = OPS.mask(resultops.get_func(op))
         if func == OPS.const:
             break
-        resultops.funcs[op] = OPS.add_flag(func, OPS.RETURN_IF_NEG)
+        resultops.set_func(op, OPS.add_flag(func, OPS.RETURN_IF_NEG))
         if func == OPS.min:
             converted += 1
             op, arg1 = resultops.get_args(op)
@@ -562,7 +898,7 @@ def convert_check_positive(resultops, op):
         func = OPS.mask(resultops.get_func(op))
         if func == OPS.const:
             break
-        resultops.funcs[op] = OPS.add_flag(func, OPS.RETURN_IF_POS)
+        resultops.set_func(op, OPS.add_flag(func, OPS.RETURN_IF_POS))
         if func == OPS.max:
             converted += 1
             op, arg1 = resultops.get_args(op)
@@ -572,42 +908,483 @@ def convert_check_positive(resultops, op):
     return converted
 
 
-def work_backwards(resultops, result, minvalues, maxvalues, for_direct=False):
+# what the backwards pass needs to know about the value of an op. the result
+# of a program is only used for its sign (res > 0 or not), and many ops pass
+# on only a part of what is demanded of them to their arguments. the
+# demands of an op are the union of the demands of its uses.
+
+# whether the value is > 0
+DEMAND_POS = 1
+# whether the value is < 0
+DEMAND_NEG = 2
+# the sign, including whether the value is 0
+DEMAND_SIGN = DEMAND_POS | DEMAND_NEG
+DEMAND_VALUE = 4 | DEMAND_SIGN
+
+def flip_demand(demand):
+    """ What is demanded of a if demand is demanded of -a. """
+    if demand & 4:
+        return demand
+    res = 0
+    if demand & DEMAND_POS:
+        res |= DEMAND_NEG
+    if demand & DEMAND_NEG:
+        res |= DEMAND_POS
+    return res
+
+def min_can_drop(minimum, demand):
+    """ Whether min(a, b) has the demanded sign of a, if b >= minimum. """
+    if demand & DEMAND_POS:
+        return minimum > 0.0
+    return minimum >= 0.0
+
+def max_can_drop(maximum, demand):
+    """ Whether max(a, b) has the demanded sign of a, if b <= maximum. """
+    if demand & DEMAND_NEG:
+        return maximum < 0.0
+    return maximum <= 0.0
+
+def mul_keeps_sign(minimum, maximum):
+    # |b| >= 1, so that a * b can't underflow to 0. inf * 0 would be nan
+    return minimum >= 1.0 and isfinite(maximum)
+
+def add_can_drop(xmin, xmax, tmin, tmax, demand):
+    """ Whether x + t has the demanded sign of x for all x in [xmin, xmax]
+    and t in [tmin, tmax]. """
+    if not (isfinite(xmin) and isfinite(xmax) and isfinite(tmin) and isfinite(tmax)):
+        return False
+    if demand & DEMAND_POS:
+        # 0 < x <= -t makes x + t <= 0, -t < x <= 0 makes it > 0
+        if -tmin > 0.0 and xmax > 0.0 and xmin <= -tmin:
+            return False
+        if -tmax < 0.0 and xmin <= 0.0 and xmax > -tmax:
+            return False
+    if demand & DEMAND_NEG:
+        if -tmin > 0.0 and xmax >= 0.0 and xmin < -tmin:
+            return False
+        if -tmax < 0.0 and xmin < 0.0 and xmax >= -tmax:
+            return False
+    return True
+
+def work_backwards(resultops, result, minvalues, maxvalues, for_direct=False, stats=None, demands=None, replacements=None):
+    """ Compute backwards which part of the value of every op is needed to
+    know the sign of the result, and rewrite the ops that are only needed
+    for their sign into cheaper ops with the same sign, e.g. min(a, b) into a
+    if b > 0, or sqrt(a) into a. Return the new result op. demands and
+    replacements are lists of at least result + 1 elements that are
+    overwritten, or None. """
     #if not objectmodel.we_are_translated():
     #    for op in resultops:
     #        print(resultops.op_to_str(op), minvalues[op], maxvalues[op])
-    def check_gt(resultops, op, minvalues, maxvalues, check_gt, val=0.0):
-        while 1:
-            func, arg0, arg1 = resultops.get_func_and_args(op)
-            #if not objectmodel.we_are_translated():
-            #    print("round!", OPS.char_to_name(func), "_%x" % op, minvalues[op], maxvalues[op])
-            if func == OPS.max:
-                narg0 = check_gt(resultops, arg0, minvalues, maxvalues, check_gt, val)
-                if narg0 != arg0:
-                    resultops.arguments[op * 2 + 0] = narg0
-                narg1 = check_gt(resultops, arg1, minvalues, maxvalues, check_gt, val)
-                if narg1 != arg1:
-                    resultops.arguments[op * 2 + 1] = narg1
+    if demands is None:
+        demands = [0] * (result + 1)
+    if replacements is None:
+        replacements = [0] * (result + 1)
+    for op in range(result):
+        demands[op] = 0
+    demands[result] = DEMAND_POS
+    rewritten = 0
+    # the args of an op come before it, so all the uses of an op are visited
+    # before the op itself. replacements[op] is the op that op is replaced
+    # with, or op
+    for op in range(result, -1, -1):
+        replacements[op] = op
+        demand = demands[op]
+        if demand == 0:
+            continue
+        func, arg0, arg1 = resultops.get_func_and_args(op)
+        func = OPS.mask(func)
+        if func == OPS.const:
+            continue
+        numargs = OPS.num_args(func)
+        if numargs == 0:
+            continue
+        if demand & 4:
+            demands[arg0] |= DEMAND_VALUE
+            if numargs == 2:
+                demands[arg1] |= DEMAND_VALUE
+            continue
+        if func == OPS.min or func == OPS.max:
             if func == OPS.min:
-                if minvalues[arg0] > val:
-                    op = arg1
-                    continue
-                if minvalues[arg1] > val:
-                    op = arg0
-                    continue
-                narg0 = check_gt(resultops, arg0, minvalues, maxvalues, check_gt, val)
-                if narg0 != arg0:
-                    resultops.arguments[op * 2 + 0] = narg0
-                narg1 = check_gt(resultops, arg1, minvalues, maxvalues, check_gt, val)
-                if narg1 != arg1:
-                    resultops.arguments[op * 2 + 1] = narg1
-            break
-        return op
-    otherop = check_gt(resultops, result, minvalues, maxvalues, check_gt)
+                drop1 = min_can_drop(minvalues[arg1], demand)
+                drop0 = not drop1 and min_can_drop(minvalues[arg0], demand)
+            else:
+                drop1 = max_can_drop(maxvalues[arg1], demand)
+                drop0 = not drop1 and max_can_drop(maxvalues[arg0], demand)
+            if drop1:
+                replacements[op] = arg0
+                demands[arg0] |= demand
+            elif drop0:
+                replacements[op] = arg1
+                demands[arg1] |= demand
+            else:
+                demands[arg0] |= demand
+                demands[arg1] |= demand
+                continue
+        elif func == OPS.neg:
+            demands[arg0] |= flip_demand(demand)
+            continue
+        elif func == OPS.square or func == OPS.abs:
+            # > 0 if the argument is not 0, never < 0
+            demands[arg0] |= DEMAND_SIGN
+            continue
+        elif func == OPS.sqrt:
+            # > 0 if the argument is > 0, never < 0
+            if demand == DEMAND_POS or minvalues[arg0] >= 0.0:
+                replacements[op] = arg0
+                demands[arg0] |= demand
+            else:
+                demands[arg0] |= DEMAND_POS
+                continue
+        elif func == OPS.mul:
+            min0, max0 = minvalues[arg0], maxvalues[arg0]
+            min1, max1 = minvalues[arg1], maxvalues[arg1]
+            if mul_keeps_sign(min1, max1):
+                replacements[op] = arg0
+                demands[arg0] |= demand
+            elif mul_keeps_sign(min0, max0):
+                replacements[op] = arg1
+                demands[arg1] |= demand
+            elif mul_keeps_sign(-max1, -min1):
+                resultops.set_func(op, OPS.neg)
+                resultops.set_arg1(op, 0)
+                demands[arg0] |= flip_demand(demand)
+            elif mul_keeps_sign(-max0, -min0):
+                resultops.set_func(op, OPS.neg)
+                resultops.set_arg0(op, arg1)
+                resultops.set_arg1(op, 0)
+                demands[arg1] |= flip_demand(demand)
+            else:
+                # the sign of a product depends on the signs of both
+                demands[arg0] |= DEMAND_SIGN
+                demands[arg1] |= DEMAND_SIGN
+                continue
+        elif func == OPS.add or func == OPS.sub:
+            min0, max0 = minvalues[arg0], maxvalues[arg0]
+            min1, max1 = minvalues[arg1], maxvalues[arg1]
+            if func == OPS.sub:
+                min1, max1 = -max1, -min1
+            if add_can_drop(min0, max0, min1, max1, demand):
+                replacements[op] = arg0
+                demands[arg0] |= demand
+            elif add_can_drop(min1, max1, min0, max0, demand):
+                if func == OPS.add:
+                    replacements[op] = arg1
+                    demands[arg1] |= demand
+                else:
+                    resultops.set_func(op, OPS.neg)
+                    resultops.set_arg0(op, arg1)
+                    resultops.set_arg1(op, 0)
+                    demands[arg1] |= flip_demand(demand)
+            else:
+                demands[arg0] |= DEMAND_VALUE
+                demands[arg1] |= DEMAND_VALUE
+                continue
+        else:
+            demands[arg0] |= DEMAND_VALUE
+            if numargs == 2:
+                demands[arg1] |= DEMAND_VALUE
+            continue
+        rewritten += 1
+
+    # forwards, point the args of all the needed ops to their replacements
+    for op in range(result + 1):
+        if demands[op] == 0:
+            continue
+        replacement = replacements[op]
+        if replacement != op:
+            replacements[op] = replacements[replacement]
+            continue
+        func, arg0, arg1 = resultops.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            continue
+        numargs = OPS.num_args(func)
+        if numargs >= 1 and replacements[arg0] != arg0:
+            resultops.set_arg0(op, replacements[arg0])
+        if numargs == 2 and replacements[arg1] != arg1:
+            resultops.set_arg1(op, replacements[arg1])
+    otherop = replacements[result]
     #if result != otherop:
         #if not objectmodel.we_are_translated():
         #    print("SHORTENED! by", result - otherop, "to", "_%x" % otherop)
-    stats.backwards_shortening += result - otherop
+    if stats is not None:
+        stats.backwards_shortening += result - otherop
+        stats.demand_rewrites += rewritten
     if for_direct:
         converted = convert_to_shortcut(resultops, otherop)
     return otherop
+
+
+def value_numbering(program, context=None):
+    """ Global value numbering, done once when a program is loaded: every
+    op that computes the same thing as an earlier op (with the arguments of
+    symmetric ops in either order) and every repeated constant is replaced by
+    the earlier one. Ops that are not needed for the result are removed. """
+    if context is None:
+        context = RenderContext()
+    stats = context.stats
+    num_ops = program.num_operations()
+    if num_ops == 0:
+        return program
+    # old index -> index of the first old op computing the same value
+    replacements = [0] * num_ops
+    seen_ops = {}
+    seen_consts = {}
+    for op in range(num_ops):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            value = program.get_const(arg0)
+            if math.isnan(value):
+                replacements[op] = op
+                continue
+            # 0.0 and -0.0 compare equal, but must stay different
+            key = (value, copysign(1.0, value))
+            canonical = seen_consts.get(key, -1)
+            if canonical < 0:
+                seen_consts[key] = canonical = op
+            else:
+                stats.dedup_const_worked += 1
+            replacements[op] = canonical
+            continue
+        numargs = OPS.num_args(func)
+        if numargs == 0:
+            arg0 = arg1 = 0
+        elif numargs == 1:
+            arg0 = replacements[arg0]
+            arg1 = 0
+        else:
+            arg0 = replacements[arg0]
+            arg1 = replacements[arg1]
+        if OPS.is_symmetric(func) and arg1 < arg0:
+            key = (func, arg1, arg0)
+        else:
+            key = (func, arg0, arg1)
+        canonical = seen_ops.get(key, -1)
+        if canonical < 0:
+            seen_ops[key] = canonical = op
+        else:
+            stats.cse_worked += 1
+        replacements[op] = canonical
+
+    # all the args of an op come before it, so the replacement of the last op
+    # is also the last op that is still needed
+    result = replacements[num_ops - 1]
+    new_positions = [-1] * (result + 1)
+    new_positions[result] = 0
+    for op in range(result, -1, -1):
+        if new_positions[op] < 0:
+            continue
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            continue
+        numargs = OPS.num_args(func)
+        if numargs >= 1:
+            new_positions[replacements[arg0]] = 0
+        if numargs == 2:
+            new_positions[replacements[arg1]] = 0
+    resultops = program.new_builder(context, result + 1)
+    for op in range(result + 1):
+        if new_positions[op] < 0:
+            continue
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            newop = resultops.add_const(program.get_const(arg0))
+            resultops.set_func(newop, func)
+        else:
+            numargs = OPS.num_args(func)
+            if numargs == 0:
+                arg0 = arg1 = 0
+            elif numargs == 1:
+                arg0 = new_positions[replacements[arg0]]
+                arg1 = 0
+            else:
+                arg0 = new_positions[replacements[arg0]]
+                arg1 = new_positions[replacements[arg1]]
+            newop = resultops.add_op(func, arg0, arg1)
+        new_positions[op] = newop
+    return resultops
+
+
+def flatten_min_max(program, context=None):
+    """ Flatten the nested min and max ops of program, done once when a
+    program is loaded after value_numbering: every tree of min ops (or max
+    ops) whose inner ops are used nowhere else becomes a chain of its
+    operands (see vm.compute_chains), in place of the root of the tree. The
+    optimizer prunes the operands of a chain together, and the shortcuts of
+    convert_to_shortcut follow a chain without recursing. """
+    if context is None:
+        context = RenderContext()
+    stats = context.stats
+    num_ops = program.num_operations()
+    uses = [0] * num_ops
+    users = [0] * num_ops
+    for op in range(num_ops):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            continue
+        numargs = OPS.num_args(func)
+        if numargs >= 1:
+            uses[arg0] += 1
+            users[arg0] = op
+        if numargs == 2:
+            uses[arg1] += 1
+            users[arg1] = op
+    # whether op is a min or max that is only used by an op with the same func
+    inner = [False] * num_ops
+    for op in range(num_ops):
+        func = OPS.mask(program.get_func(op))
+        if (func == OPS.min or func == OPS.max) and uses[op] == 1:
+            inner[op] = OPS.mask(program.get_func(users[op])) == func
+    resultops = program.new_builder(context, num_ops)
+    new_positions = [0] * num_ops
+    operands = []
+    stack = []
+    for op in range(num_ops):
+        if inner[op]:
+            continue
+        func, arg0, arg1 = program.get_func_and_args(op)
+        bare_func = OPS.mask(func)
+        if bare_func == OPS.const:
+            newop = resultops.add_const(program.get_const(arg0))
+            resultops.set_func(newop, func)
+        elif (bare_func == OPS.min or bare_func == OPS.max) and (inner[arg0] or inner[arg1]):
+            # collect the operands of the tree from left to right
+            del operands[:]
+            stack.append(arg1)
+            stack.append(arg0)
+            while stack:
+                arg = stack.pop()
+                if inner[arg]:
+                    stats.min_max_flattened += 1
+                    left, right = program.get_args(arg)
+                    stack.append(right)
+                    stack.append(left)
+                else:
+                    operands.append(arg)
+            newop = new_positions[operands[0]]
+            for i in range(1, len(operands)):
+                newop = resultops.add_op(bare_func, newop, new_positions[operands[i]])
+        else:
+            numargs = OPS.num_args(func)
+            if numargs == 0:
+                arg0 = arg1 = 0
+            elif numargs == 1:
+                arg0 = new_positions[arg0]
+                arg1 = 0
+            else:
+                arg0 = new_positions[arg0]
+                arg1 = new_positions[arg1]
+            newop = resultops.add_op(func, arg0, arg1)
+        new_positions[op] = newop
+    return resultops
+
+
+def allocate_slots(program, allocator=None):
+    """ Let the ops of program share the slots of the frames, like
+    Optimizer.dce does for its result, for programs that come from
+    elsewhere. Ops whose value is never used still get a slot, that is free
+    at that point. """
+    if allocator is None:
+        allocator = SlotAllocator()
+    allocator.reset()
+    num_ops = program.num_operations()
+    if num_ops == 0:
+        return
+    slots = [-1] * num_ops
+    slots[num_ops - 1] = allocator.take()
+    for op in range(num_ops - 1, -1, -1):
+        slot = slots[op]
+        if slot < 0:
+            slot = slots[op] = allocator.take()
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) != OPS.const:
+            numargs = OPS.num_args(func)
+            if numargs >= 1 and slots[arg0] < 0:
+                slots[arg0] = allocator.take()
+            if numargs == 2 and slots[arg1] < 0:
+                slots[arg1] = allocator.take()
+        allocator.give_back(slot)
+    program.set_slots(slots, allocator.num_slots)
+
+
+def fuse_ops(program, context=None):
+    """ Replace common patterns of ops by fused ops, for the leaf tiles that
+    are evaluated pixel by pixel: sqrt(square(a) + square(b)) becomes
+    hypot2(a, b) and square(a - b) becomes sub-square(a, b), if the replaced
+    inner ops are used nowhere else. The fused ops compute bit-identical
+    results with fewer dispatches. The interval tapes are never fused, the
+    interval bounds of the fused ops would be the same as the ones of their
+    parts. Returns program itself if nothing is fused. """
+    if context is None:
+        context = RenderContext()
+    stats = context.stats
+    num_ops = program.num_operations()
+    uses = [0] * num_ops
+    for op in range(num_ops):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            continue
+        numargs = OPS.num_args(func)
+        if numargs >= 1:
+            uses[arg0] += 1
+        if numargs == 2:
+            uses[arg1] += 1
+    # the fused op that replaces op, with the flags of op, and whether op is
+    # only computed as a part of a fused op. an inner op with a flag would
+    # lose its early return, so it is never fused
+    fused = ['\x00'] * num_ops
+    inner = [False] * num_ops
+    flags = OPS.RETURN_IF_NEG | OPS.RETURN_IF_POS
+    num_fused = 0
+    for op in range(num_ops):
+        func, arg0, _ = program.get_func_and_args(op)
+        if OPS.mask(func) != OPS.sqrt or uses[arg0] != 1 or program.get_func(arg0) != OPS.add:
+            continue
+        square0, square1 = program.get_args(arg0)
+        if (square0 != square1 and
+                program.get_func(square0) == OPS.square and uses[square0] == 1 and
+                program.get_func(square1) == OPS.square and uses[square1] == 1):
+            fused[op] = OPS.add_flag(OPS.hypot2, ord(func) & flags)
+            inner[arg0] = inner[square0] = inner[square1] = True
+            num_fused += 3
+    for op in range(num_ops):
+        func, arg0, _ = program.get_func_and_args(op)
+        if (OPS.mask(func) == OPS.square and not inner[op] and uses[arg0] == 1 and
+                program.get_func(arg0) == OPS.sub):
+            fused[op] = OPS.add_flag(OPS.sub_square, ord(func) & flags)
+            inner[arg0] = True
+            num_fused += 1
+    if not num_fused:
+        return program
+    stats.ops_fused += num_fused
+    resultops = program.new_builder(context, num_ops - num_fused)
+    new_positions = [0] * num_ops
+    for op in range(num_ops):
+        if inner[op]:
+            continue
+        func, arg0, arg1 = program.get_func_and_args(op)
+        fusedfunc = fused[op]
+        if OPS.mask(func) == OPS.const:
+            newop = resultops.add_const(program.get_const(arg0))
+            resultops.set_func(newop, func)
+        elif OPS.mask(fusedfunc) == OPS.hypot2:
+            square0, square1 = program.get_args(arg0)
+            newop = resultops.add_op(fusedfunc, new_positions[program.get_args(square0)[0]],
+                                     new_positions[program.get_args(square1)[0]])
+        elif OPS.mask(fusedfunc) == OPS.sub_square:
+            sub0, sub1 = program.get_args(arg0)
+            newop = resultops.add_op(fusedfunc, new_positions[sub0], new_positions[sub1])
+        else:
+            numargs = OPS.num_args(func)
+            if numargs == 0:
+                arg0 = arg1 = 0
+            elif numargs == 1:
+                arg0 = new_positions[arg0]
+                arg1 = 0
+            else:
+                arg0 = new_positions[arg0]
+                arg1 = new_positions[arg1]
+            newop = resultops.add_op(func, arg0, arg1)
+        new_positions[op] = newop
+    allocate_slots(resultops)
+    return resultops
@@ -0,0 +1,185 @@
+from __future__ import division, print_function
+
+# rendering on several processes at once. only usable untranslated
+
+import ctypes
+import heapq
+import multiprocessing
+import os
+import time
+import traceback
+import Queue
+import cPickle as pickle
+
+from pyfidget.context import RenderContext
+from pyfidget.vm import render_image_octree_rec_optimize, render_image_leaf_fragment, \
+        _fill_black, render_directly, split_tile
+
+# state of a worker process, set up once by _init_worker when the pool starts
+_worker_state = None
+
+def _init_worker(program, buffer, width, height):
+    global _worker_state
+    _worker_state = program, buffer, width, height, RenderContext()
+
+def _render_tile(args):
+    minx, maxx, miny, maxy, startx, stopx, starty, stopy = args
+    program, buffer, width, height, context = _worker_state
+    render_image_octree_rec_optimize(program, width, height, minx, maxx, miny, maxy, buffer,
+                                     startx, stopx, starty, stopy, level=1, context=context)
+
+def _run_task(args):
+    try:
+        t1 = time.time()
+        subtasks = _process_tile(*args)
+        t2 = time.time()
+        return os.getpid(), t2 - t1, subtasks, None
+    except Exception:
+        return os.getpid(), 0.0, [], traceback.format_exc()
+
+def _process_tile(pickled_program, minx, maxx, miny, maxy, startx, stopx, starty, stopy, budget):
+    # specialize the program for one tile. if what is left of the tile is
+    # cheap enough, finish it right here, otherwise give its children back to
+    # the scheduler so that idle workers can pick them up
+    from pyfidget.optimize import opt_program
+    root, buffer, width, height, context = _worker_state
+    if pickled_program is None:
+        program = root
+    else:
+        program = pickle.loads(pickled_program)
+    a = minx + (maxx - minx) * startx / (width - 1)
+    b = minx + (maxx - minx) * (stopx - 1) / (width - 1)
+    c = miny + (maxy - miny) * starty / (height - 1)
+    d = miny + (maxy - miny) * (stopy - 1) / (height - 1)
+    direct = render_directly(program, startx, stopx, starty, stopy, context)
+    newprogram, minimum, maximum = opt_program(program, a, b, c, d, 0.0, 0.0, for_direct=direct, context=context)
+    if newprogram is None:
+        if maximum <= 0:
+            _fill_black(width, height, buffer, startx, stopx, starty, stopy)
+        return []
+    if direct:
+        render_image_leaf_fragment(newprogram, width, height, minx, maxx, miny, maxy, buffer, startx, stopx, starty, stopy, context)
+        newprogram.delete()
+        return []
+    children = split_tiles(startx, stopx, starty, stopy, 1, context)
+    cost = estimate_cost(newprogram, startx, stopx, starty, stopy)
+    if cost <= budget:
+        for tile in children:
+            render_image_octree_rec_optimize(newprogram, width, height, minx, maxx, miny, maxy, buffer,
+                                             tile[0], tile[1], tile[2], tile[3], level=1, context=context)
+        newprogram.delete()
+        return []
+    # the freelists and stats of the worker's context stay in the worker
+    newprogram.context = None
+    pickled = pickle.dumps(newprogram, pickle.HIGHEST_PROTOCOL)
+    newprogram.context = context
+    subtasks = [(estimate_cost(newprogram, *tile), pickled, tile) for tile in children]
+    newprogram.delete()
+    return subtasks
+
+def estimate_cost(program, startx, stopx, starty, stopy):
+    """ Rough cost of rendering a tile with a program: the specialized length
+    of the program times the area of the tile. """
+    return program.num_operations() * (stopx - startx) * (stopy - starty)
+
+def split_tiles(startx, stopx, starty, stopy, depth, context=None):
+    """ Split a tile the same way the octree recursion does, depth times. """
+    if context is None:
+        context = RenderContext()
+    if depth == 0:
+        return [(startx, stopx, starty, stopy)]
+    result = []
+    for new_startx, new_stopx, new_starty, new_stopy in split_tile(startx, stopx, starty, stopy, context):
+        result.extend(split_tiles(new_startx, new_stopx, new_starty, new_stopy, depth - 1, context))
+    return result
+
+
+class ParallelRenderer(object):
+    """ Renders one program at one image size on a pool of worker processes.
+    The workers get the program and a shared-memory output buffer once, when
+    the pool starts, and are reused for every call to render. """
+
+    def __init__(self, program, width, height, workers=0):
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        self.program = program
+        self.width = width
+        self.height = height
+        self.workers = workers
+        self.buffer = multiprocessing.RawArray(ctypes.c_char, width * height)
+        self.pool = multiprocessing.Pool(workers, _init_worker, (program, self.buffer, width, height))
+        self.utilisation = []
+        # enough subtrees that every worker gets several of them
+        self.depth = 1
+        while 4 ** self.depth < 4 * workers:
+            self.depth += 1
+
+    def render_static(self, minx, maxx, miny, maxy):
+        """ Render with a fixed split of the image into subtrees. """
+        ctypes.memset(self.buffer, 0, self.width * self.height)
+        tasks = [(minx, maxx, miny, maxy) + tile
+                    for tile in split_tiles(0, self.width, 0, self.height, self.depth)]
+        self.pool.map(_render_tile, tasks, chunksize=1)
+        return list(self.buffer.raw)
+
+    def render(self, minx, maxx, miny, maxy):
+        """ Render with dynamic load balancing. The pending subtrees are kept
+        in a queue ordered by their estimated cost, every idle worker takes
+        the most expensive one. A worker only finishes a subtree on its own
+        if its estimated cost is below a budget, otherwise it specializes the
+        program for it and puts the children back into the queue. """
+        ctypes.memset(self.buffer, 0, self.width * self.height)
+        width = self.width
+        height = self.height
+        budget = self.program.num_operations() * width * height // (TASKS_PER_WORKER * self.workers)
+        pending = []
+        for tile in split_tiles(0, width, 0, height, self.depth):
+            heapq.heappush(pending, (-estimate_cost(self.program, *tile), None, tile))
+        done = Queue.Queue()
+        in_flight = 0
+        busy = {}
+        t1 = time.time()
+        while pending or in_flight:
+            while pending and in_flight < 2 * self.workers:
+                _, pickled, tile = heapq.heappop(pending)
+                args = (pickled, minx, maxx, miny, maxy) + tile + (budget, )
+                self.pool.apply_async(_run_task, (args, ), callback=done.put)
+                in_flight += 1
+            pid, duration, subtasks, error = done.get()
+            in_flight -= 1
+            if error is not None:
+                raise RuntimeError("error in worker process:\n" + error)
+            busy[pid] = busy.get(pid, 0.0) + duration
+            for cost, pickled, tile in subtasks:
+                heapq.heappush(pending, (-cost, pickled, tile))
+        total = time.time() - t1
+        self.utilisation = sorted([(pid, duration / total) for pid, duration in busy.items()])
+        return list(self.buffer.raw)
+
+    def print_utilisation(self):
+        for pid, utilisation in self.utilisation:
+            print('worker %s: %.1f%% busy' % (pid, utilisation * 100))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+# how many pieces of roughly equal estimated cost the scheduler aims to give
+# every worker
+TASKS_PER_WORKER = 16
+
+_renderer = None
+
+def render_image_parallel(program, width, height, minx, maxx, miny, maxy, workers=0):
+    """ Like render_image_octree_optimize, but the subtrees are rendered by a
+    pool of worker processes. The pool is kept around and reused as long as
+    the program, the image size and the number of workers stay the same. """
+    global _renderer
+    renderer = _renderer
+    if (renderer is None or renderer.program is not program or renderer.width != width or
+            renderer.height != height or (workers and renderer.workers != workers)):
+        if renderer is not None:
+            renderer.close()
+        renderer = _renderer = ParallelRenderer(program, width, height, workers)
+    return renderer.render(minx, maxx, miny, maxy)
@@ -1,36 +1,125 @@
-from pyfidget.operations import OPS
+from pyfidget.operations import OPS, opname_to_char
 from pyfidget.vm import ProgramBuilder
 
-def parse(code):
-    lines = code.split("\n")
-    program = ProgramBuilder.new(len(lines))
-    opnames = {}
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        # ignore comments
-        if line.startswith("#"):
-            continue
-        parts = line.split(' ')
-        if len(parts) == 2:
-            name, func = parts
-            op = program.add_op(OPS.get(func), name=name)
-        elif len(parts) >= 3:
-            name = parts[0]
-            func = parts[1]
-            args = parts[2:]
-            if func == 'const':
-                op = program.add_const(float(args[0]), name)
-            else:
-                args = [opnames[arg] for arg in args]
-                if len(args) == 1:
-                    op = program.add_op(OPS.get(func), args[0], name=name)
-                elif len(args) == 2:
-                    op = program.add_op(OPS.get(func), args[0], args[1], name)
-                else:
-                    raise ValueError('too many arguments: %s' % line)
+
+class ParseError(Exception):
+    # no call to Exception.__init__, that is not RPython
+    def __init__(self, lineno, msg):
+        self.lineno = lineno
+        self.msg = msg
+
+    def format(self):
+        return "line %d: %s" % (self.lineno, self.msg)
+
+    def __str__(self):
+        return self.format()
+
+
+class Parser(object):
+    """ Builds a program line by line, so that the text never has to be in
+    memory as a whole. The names of the ops are mapped to their index in the
+    program, which is all that is kept of the text. """
+
+    def __init__(self, sizehint=10):
+        self.program = ProgramBuilder(sizehint)
+        self.opnames = {}
+        self.lineno = 0
+
+    def error(self, msg):
+        raise ParseError(self.lineno, msg)
+
+    def _next_word(self, line, start):
+        # return the bounds of the next space-separated word of line, or
+        # (-1, -1) if there is none
+        length = len(line)
+        while start < length and line[start] in ' \t\r\n':
+            start += 1
+        if start == length:
+            return -1, -1
+        stop = start
+        while stop < length and line[stop] not in ' \t\r\n':
+            stop += 1
+        return start, stop
+
+    def _lookup(self, line, start, stop):
+        assert start >= 0 and stop >= 0
+        name = line[start:stop]
+        op = self.opnames.get(name, -1)
+        if op < 0:
+            self.error("unknown name %s" % name)
+        return op
+
+    def parse_line(self, line):
+        self.lineno += 1
+        start, stop = self._next_word(line, 0)
+        # ignore empty lines and comments
+        if start < 0 or line[start] == '#':
+            return
+        # _next_word only returns -1 if there is no word, tell the annotator
+        assert stop >= 0
+        name = line[start:stop]
+        start, stop = self._next_word(line, stop)
+        if start < 0:
+            self.error("missing operation after %s" % name)
+        assert stop >= 0
+        funcname = line[start:stop]
+        if funcname not in opname_to_char or OPS.is_fused(OPS.get(funcname)):
+            self.error("unknown operation %s" % funcname)
+        func = OPS.get(funcname)
+        program = self.program
+        start, stop = self._next_word(line, stop)
+        if start < 0:
+            if OPS.num_args(func) != 0:
+                self.error("missing arguments for %s" % funcname)
+            op = program.add_op(func, name=name)
+        elif func == OPS.const:
+            assert stop >= 0
+            try:
+                value = float(line[start:stop])
+            except ValueError:
+                raise ParseError(self.lineno, "invalid constant %s" % line[start:stop])
+            if self._next_word(line, stop)[0] >= 0:
+                self.error("wrong number of arguments for const")
+            op = program.add_const(value, name)
         else:
-            raise ValueError("Invalid line: %s" % line)
-        opnames[name] = op
-    return program
+            arg0 = self._lookup(line, start, stop)
+            start, stop = self._next_word(line, stop)
+            if start < 0:
+                if OPS.num_args(func) != 1:
+                    self.error("wrong number of arguments for %s" % funcname)
+                op = program.add_op(func, arg0, name=name)
+            else:
+                arg1 = self._lookup(line, start, stop)
+                if OPS.num_args(func) != 2 or self._next_word(line, stop)[0] >= 0:
+                    self.error("wrong number of arguments for %s" % funcname)
+                op = program.add_op(func, arg0, arg1, name)
+        self.opnames[name] = op
+
+    def parse_file(self, f):
+        while 1:
+            line = f.readline()
+            if not line:
+                break
+            self.parse_line(line)
+
+    def finish(self):
+        self.opnames = None
+        return self.program
+
+
+def parse(code):
+    parser = Parser(code.count("\n") + 1)
+    start = 0
+    while start < len(code):
+        stop = code.find("\n", start)
+        if stop < 0:
+            stop = len(code)
+        parser.parse_line(code[start:stop])
+        start = stop + 1
+    return parser.finish()
+
+def parse_file(f):
+    """ Parse a program from a file object, reading it one line at a time. """
+    parser = Parser()
+    parser.parse_file(f)
+    return parser.finish()
@@ -0,0 +1,185 @@
+from __future__ import division, print_function
+
+from pyfidget.operations import OPS
+from pyfidget.optimize import allocate_slots
+from pyfidget.vm import LaneFrame, LANES, numpy_leaves
+
+# the flags of convert_to_shortcut let the interpreters return as soon as an
+# operand of the min (or max) at the end of a program decides the sign of the
+# result. that only helps if the deciding operand is computed early. before a
+# tile is evaluated by the LaneFrame leaf renderer, schedule_leaf evaluates
+# its program for a few chunks of lanes, counts at which op the evaluation
+# returned, and moves the ops that are needed for the most often deciding
+# (and cheapest) operands to the front of the program. the numpy leaf
+# renderer evaluates every op for the whole tile, so its programs are left
+# alone. the schedule is computed once per program and kept on it, tiles
+# that share a program through a tapecache.TapeCache share it too.
+
+# the sampled chunks of LANES columns and the sampled rows of a tile
+SAMPLES_PER_AXIS = 2
+
+
+class ExitProfile(object):
+    """ How often the evaluation of a program returned early at every op. """
+
+    def __init__(self, num_ops):
+        self.exits = [0] * num_ops
+        self.samples = 0
+
+    def record(self, op):
+        self.exits[op] += 1
+
+
+def profile_exits(program, width, height, minx, maxx, miny, maxy, startx, stopx, starty, stopy, context):
+    """ Evaluate program like render_image_lanes_fragment does, for
+    SAMPLES_PER_AXIS chunks of LANES columns in SAMPLES_PER_AXIS rows of the
+    tile, and return the ExitProfile. """
+    profile = ExitProfile(program.num_operations())
+    separable = program.get_separable()
+    frame = LaneFrame.new(context, program)
+    frame.profile = profile
+    dx = (maxx - minx) / (width - 1)
+    xs = [0.0] * LANES
+    results = [0.0] * LANES
+    frame.run_lanes_ops(separable.tile_ops, xs, miny, 0.0, None)
+    for i in range(SAMPLES_PER_AXIS):
+        column = startx + (stopx - startx) * (2 * i + 1) // (2 * SAMPLES_PER_AXIS)
+        # the chunk that render_image_lanes_fragment evaluates column in
+        chunk = startx + (column - startx) // LANES * LANES
+        count = stopx - chunk
+        if count > LANES:
+            count = LANES
+        for k in range(LANES):
+            if k < count:
+                xs[k] = minx + dx * (chunk + k)
+            else:
+                xs[k] = xs[count - 1]
+        frame.run_lanes_ops(separable.column_ops, xs, miny, 0.0, None)
+        for j in range(SAMPLES_PER_AXIS):
+            row = starty + (stopy - starty) * (2 * j + 1) // (2 * SAMPLES_PER_AXIS)
+            y = miny + (maxy - miny) * row / (height - 1)
+            frame.run_lanes_ops(separable.row_ops, xs, y, 0.0, None)
+            frame.run_lanes_ops(separable.pixel_ops, xs, y, 0.0, results)
+            profile.samples += 1
+    frame.profile = None
+    frame.delete()
+    return profile
+
+def _mark_cone(program, op, needed, stack):
+    # mark all the ops that op depends on, and op itself
+    count = 0
+    stack.append(op)
+    while stack:
+        op = stack.pop()
+        if needed[op]:
+            continue
+        needed[op] = True
+        count += 1
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            continue
+        numargs = OPS.num_args(func)
+        if numargs >= 1:
+            stack.append(arg0)
+        if numargs == 2:
+            stack.append(arg1)
+    return count
+
+def schedule_tape(program, profile, context):
+    """ Return a program that computes the same as program, but starts with
+    the ops that are needed by the ops at which the evaluations of profile
+    returned early. The op with the most exits per op that it still needs
+    comes first. Returns program itself if no op moves. """
+    num_ops = program.num_operations()
+    exits = profile.exits
+    candidates = []
+    for op in range(num_ops - 1):
+        if exits[op]:
+            candidates.append(op)
+    if not candidates:
+        return program
+    # emit the cones of the candidates one by one, always the one with the
+    # most exits per op that is not emitted yet next, in the order of program
+    emitted = [False] * num_ops
+    seen = [False] * num_ops
+    stack = []
+    new_positions = [-1] * num_ops
+    ops = []
+    while candidates:
+        best = -1
+        best_priority = 0.0
+        i = 0
+        while i < len(candidates):
+            op = candidates[i]
+            for j in range(num_ops):
+                seen[j] = emitted[j]
+            cost = _mark_cone(program, op, seen, stack)
+            if cost == 0:
+                # in the cone of a candidate that came before
+                del candidates[i]
+                continue
+            priority = exits[op] / cost
+            if best < 0 or priority > best_priority:
+                best = i
+                best_priority = priority
+            i += 1
+        if best < 0:
+            break
+        op = candidates[best]
+        del candidates[best]
+        for j in range(num_ops):
+            seen[j] = emitted[j]
+        _mark_cone(program, op, seen, stack)
+        for j in range(op + 1):
+            if seen[j] and not emitted[j]:
+                emitted[j] = True
+                new_positions[j] = len(ops)
+                ops.append(j)
+    for op in range(num_ops):
+        if not emitted[op]:
+            new_positions[op] = len(ops)
+            ops.append(op)
+    moved = False
+    for op in range(num_ops):
+        if new_positions[op] != op:
+            moved = True
+            break
+    if not moved:
+        return program
+    context.stats.tapes_scheduled += 1
+    resultops = program.new_builder(context, num_ops)
+    for op in ops:
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            newop = resultops.add_const(program.get_const(arg0))
+            resultops.set_func(newop, func)
+            continue
+        numargs = OPS.num_args(func)
+        if numargs == 0:
+            arg0 = arg1 = 0
+        elif numargs == 1:
+            arg0 = new_positions[arg0]
+            arg1 = 0
+        else:
+            arg0 = new_positions[arg0]
+            arg1 = new_positions[arg1]
+        resultops.add_op(func, arg0, arg1)
+    allocate_slots(resultops)
+    return resultops
+
+def schedule_leaf(program, width, height, minx, maxx, miny, maxy, startx, stopx, starty, stopy, context):
+    """ Profile program in the tile and schedule it, unless that was done
+    for program before. Returns either program or another program, in which
+    case program is deleted. """
+    if numpy_leaves():
+        return program
+    scheduled = program.scheduled
+    if scheduled is None:
+        profile = profile_exits(program, width, height, minx, maxx, miny, maxy, startx, stopx, starty, stopy, context)
+        scheduled = program.scheduled = schedule_tape(program, profile, context)
+    if scheduled is program:
+        return program
+    # one reference for program.scheduled, one for the caller
+    scheduled.shared += 1
+    program.delete()
+    return scheduled
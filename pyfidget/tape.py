@@ -0,0 +1,201 @@
+from __future__ import print_function
+
+# a binary format for programs, so that big formulas don't have to be parsed
+# again on every start. all numbers are little-endian. the layout is:
+#
+#   8 bytes   MAGIC
+#   int32     number of ops
+#   int32     number of consts
+#   double    consts[num_consts]
+#   int32     arguments[2 * num_ops]
+#   uint8     opcodes[num_ops], including the return_if_* flags
+#
+# every section starts at an offset that is a multiple of its item size, so
+# the arrays can be used directly from a memory mapping of the file.
+
+import sys
+
+from rpython.rlib import objectmodel
+from rpython.rlib.rstruct.runpack import runpack
+
+from pyfidget.operations import OPS, opnames
+from pyfidget.vm import ProgramBuilder, CompactProgramBuilder
+
+MAGIC = "PYFTAPE\x01"
+HEADER_SIZE = 16
+
+
+def tape_sections(num_ops, num_consts):
+    """ Return the offsets of the consts, arguments and opcodes sections and
+    the total size of a tape. """
+    consts_offset = HEADER_SIZE
+    arguments_offset = consts_offset + 8 * num_consts
+    funcs_offset = arguments_offset + 4 * 2 * num_ops
+    return consts_offset, arguments_offset, funcs_offset, funcs_offset + num_ops
+
+def is_tape(data):
+    return data.startswith(MAGIC)
+
+def program_to_tape(program):
+    """ Serialize program into a string in the tape format. """
+    import struct
+    num_ops = program.num_operations()
+    consts = []
+    arguments = []
+    funcs = []
+    for op in range(num_ops):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            consts.append(program.get_const(arg0))
+            arg0 = len(consts) - 1
+        arguments.append(arg0)
+        arguments.append(arg1)
+        funcs.append(func)
+    return "".join([
+        MAGIC,
+        struct.pack("<ii", num_ops, len(consts)),
+        struct.pack("<%dd" % len(consts), *consts),
+        struct.pack("<%di" % len(arguments), *arguments),
+        "".join(funcs)])
+
+def write_tape(program, filename):
+    with open(filename, "wb") as f:
+        f.write(program_to_tape(program))
+
+def _read_header(header, length):
+    if length < HEADER_SIZE or not is_tape(header):
+        raise ValueError("not a tape")
+    num_ops = runpack("<i", header[8:12])
+    num_consts = runpack("<i", header[12:16])
+    if num_ops < 0 or num_consts < 0:
+        raise ValueError("corrupt tape header")
+    size = tape_sections(num_ops, num_consts)[3]
+    if length < size:
+        raise ValueError("truncated tape: expected %d bytes, got %d" % (size, length))
+    return num_ops, num_consts
+
+def _check_op(op, func, arg0, arg1, num_consts):
+    # a tape can come from anywhere, the frames and the optimizer trust that
+    # every op only uses ops before it
+    if OPS.mask_to_int(func) >= len(opnames) or OPS.is_fused(func):
+        raise ValueError("corrupt tape: invalid opcode %d of op %d" % (ord(func), op))
+    numargs = OPS.num_args(func)
+    if OPS.mask(func) == OPS.const:
+        if not 0 <= arg0 < num_consts or arg1 != 0:
+            raise ValueError("corrupt tape: invalid constant of op %d" % op)
+        return
+    if (numargs < 1 and arg0 != 0) or (numargs < 2 and arg1 != 0):
+        raise ValueError("corrupt tape: unused argument of op %d" % op)
+    if (numargs >= 1 and not 0 <= arg0 < op) or (numargs >= 2 and not 0 <= arg1 < op):
+        raise ValueError("corrupt tape: argument of op %d out of range" % op)
+
+def program_from_tape(data):
+    """ Build a ProgramBuilder from a string in the tape format. Copies the
+    data, but works translated. """
+    num_ops, num_consts = _read_header(data[:HEADER_SIZE], len(data))
+    consts_offset, arguments_offset, funcs_offset, _ = tape_sections(num_ops, num_consts)
+    program = ProgramBuilder(num_ops, num_consts)
+    for op in range(num_ops):
+        func = data[funcs_offset + op]
+        start = arguments_offset + 8 * op
+        arg0 = runpack("<i", data[start:start + 4])
+        arg1 = runpack("<i", data[start + 4:start + 8])
+        _check_op(op, func, arg0, arg1, num_consts)
+        if OPS.mask(func) == OPS.const:
+            # checked by _check_op, tell the annotator
+            assert arg0 >= 0
+            start = consts_offset + 8 * arg0
+            program.add_const(runpack("<d", data[start:start + 8]))
+        else:
+            program.add_op(func, arg0, arg1)
+    return program
+
+
+class MappedProgramBuilder(CompactProgramBuilder):
+    """ A program that uses the arrays of a memory-mapped tape file directly,
+    without copying them. It can be run and specialized, but not extended;
+    specializing it gives a CompactProgramBuilder. Only usable untranslated. """
+
+    def __init__(self, mapping, num_ops, num_consts):
+        import ctypes
+        consts_offset, arguments_offset, funcs_offset, _ = tape_sections(num_ops, num_consts)
+        self.mapping = mapping
+        self.consts = (ctypes.c_double * num_consts).from_buffer(mapping, consts_offset)
+        self.arguments = (ctypes.c_int32 * (2 * num_ops)).from_buffer(mapping, arguments_offset)
+        self.funcs = (ctypes.c_uint8 * num_ops).from_buffer(mapping, funcs_offset)
+        self.index = num_ops
+        self.const_index = num_consts
+        self.context = None
+        self.next = None
+
+    def reset(self):
+        raise TypeError("a mapped tape is read-only")
+
+    def add_op(self, func, arg0=0, arg1=0, name=None):
+        raise TypeError("a mapped tape is read-only")
+
+    def add_const(self, const, name=None):
+        raise TypeError("a mapped tape is read-only")
+
+    def set_func(self, index, func):
+        raise TypeError("a mapped tape is read-only")
+
+    def new_builder(self, context, sizehint=10, const_sizehint=5):
+        return CompactProgramBuilder.new(context, sizehint, const_sizehint)
+
+
+def map_tape(filename):
+    """ Memory-map a tape file and return a MappedProgramBuilder for it. """
+    import mmap
+    with open(filename, "rb") as f:
+        # a private mapping, because ctypes needs a writable buffer. the
+        # pages are still shared with the page cache until someone writes
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    num_ops, num_consts = _read_header(mapping[:HEADER_SIZE], len(mapping))
+    program = MappedProgramBuilder(mapping, num_ops, num_consts)
+    for op in range(num_ops):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        _check_op(op, func, arg0, arg1, num_consts)
+    return program
+
+def _stdin():
+    if not objectmodel.we_are_translated():
+        return sys.stdin
+    from rpython.rlib import rfile
+    stdin, stdout, stderr = rfile.create_stdio()
+    return stdin
+
+def load_program(filename):
+    """ Load a program from a file that is either a tape or in the text
+    format. The text format is parsed while it is read. A filename of "-"
+    means stdin. """
+    from pyfidget.parse import Parser, parse_file
+    if filename == "-":
+        f = _stdin()
+        line = f.readline()
+        if is_tape(line):
+            return program_from_tape(line + f.read())
+        parser = Parser()
+        parser.parse_line(line)
+        parser.parse_file(f)
+        return parser.finish()
+    with open(filename, "rb") as f:
+        start = f.read(len(MAGIC))
+        if is_tape(start):
+            if not objectmodel.we_are_translated() and sys.byteorder == "little":
+                return map_tape(filename)
+            return program_from_tape(start + f.read())
+        f.seek(0)
+        return parse_file(f)
+
+
+def main(argv):
+    if len(argv) != 3:
+        print("Usage: %s <input.vm or -> <output.tape>" % argv[0])
+        return 1
+    program = load_program(argv[1])
+    write_tape(program, argv[2])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,149 @@
+from __future__ import division, print_function
+
+import math
+
+from rpython.rlib.objectmodel import compute_hash
+from rpython.rlib.rarithmetic import intmask
+from rpython.rlib.rfloat import copysign
+
+from pyfidget.operations import OPS
+
+# many tiles of a render end up with the same specialized program, e.g. the
+# ones around the same part of the shape. a TapeCache makes them share one
+# program object, and with it everything that is computed once per program
+# (the axes of the ops, the SeparableOps of the leaf renderers, the intervals
+# of optimize.AxisIntervals). the cache keeps the programs it saw last, up to
+# a fixed number.
+
+DEFAULT_CAPACITY = 256
+
+
+def program_hash(program):
+    h = 0x345678
+    for op in range(program.num_operations()):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        h = intmask((h ^ ord(func)) * 1000003)
+        if func == OPS.const:
+            h = intmask((h ^ compute_hash(program.get_const(arg0))) * 1000003)
+        else:
+            h = intmask((h ^ arg0) * 1000003)
+            h = intmask((h ^ arg1) * 1000003)
+    return h
+
+def _same_const(a, b):
+    if math.isnan(a):
+        return math.isnan(b)
+    # 0.0 and -0.0 compare equal, but must stay different
+    return a == b and copysign(1.0, a) == copysign(1.0, b)
+
+def programs_equal(program, other):
+    num_ops = program.num_operations()
+    if num_ops != other.num_operations():
+        return False
+    for op in range(num_ops):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        other_func, other_arg0, other_arg1 = other.get_func_and_args(op)
+        if func != other_func:
+            return False
+        if func == OPS.const:
+            if not _same_const(program.get_const(arg0), other.get_const(other_arg0)):
+                return False
+        elif arg0 != other_arg0 or arg1 != other_arg1:
+            return False
+    return True
+
+
+class CacheEntry(object):
+    def __init__(self, program, hash):
+        self.program = program
+        self.hash = hash
+        # the entries in the order of their last use, most recent first
+        self.prev = None
+        self.next = None
+        # the next entry with the same hash
+        self.next_in_bucket = None
+
+
+class TapeCache(object):
+    """ A content-addressed cache of specialized programs with LRU eviction.
+    share() returns a program that was added before and is equal to its
+    argument, or adds its argument. Every program in the cache has one
+    reference for the cache and one for every user, delete() of the program
+    drops a user and eviction the reference of the cache. """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        assert capacity > 0
+        self.capacity = capacity
+        self.buckets = {}
+        self.size = 0
+        self.first = None
+        self.last = None
+
+    def share(self, program, stats):
+        """ Return the program of the cache that is equal to program and
+        delete program, or add program to the cache and return it. The
+        result must be deleted once it is no longer needed, like program. """
+        h = program_hash(program)
+        entry = self.buckets.get(h, None)
+        while entry is not None:
+            if programs_equal(entry.program, program):
+                break
+            entry = entry.next_in_bucket
+        if entry is not None:
+            stats.tape_cache_hits += 1
+            self._unlink(entry)
+            self._link_first(entry)
+            program.delete()
+            entry.program.shared += 1
+            return entry.program
+        stats.tape_cache_misses += 1
+        entry = CacheEntry(program, h)
+        entry.next_in_bucket = self.buckets.get(h, None)
+        self.buckets[h] = entry
+        self._link_first(entry)
+        self.size += 1
+        program.shared += 1
+        if self.size > self.capacity:
+            self._evict(self.last)
+        return program
+
+    def clear(self):
+        while self.last is not None:
+            self._evict(self.last)
+
+    def _evict(self, entry):
+        self._unlink(entry)
+        prev = None
+        bucket = self.buckets[entry.hash]
+        while bucket is not entry:
+            prev = bucket
+            bucket = bucket.next_in_bucket
+        if prev is None:
+            if entry.next_in_bucket is None:
+                del self.buckets[entry.hash]
+            else:
+                self.buckets[entry.hash] = entry.next_in_bucket
+        else:
+            prev.next_in_bucket = entry.next_in_bucket
+        self.size -= 1
+        entry.program.delete()
+
+    def _link_first(self, entry):
+        entry.prev = None
+        entry.next = self.first
+        if self.first is not None:
+            self.first.prev = entry
+        self.first = entry
+        if self.last is None:
+            self.last = entry
+
+    def _unlink(self, entry):
+        if entry.prev is not None:
+            entry.prev.next = entry.next
+        else:
+            self.first = entry.next
+        if entry.next is not None:
+            entry.next.prev = entry.prev
+        else:
+            self.last = entry.prev
+        entry.prev = entry.next = None
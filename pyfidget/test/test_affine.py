@@ -0,0 +1,90 @@
+from __future__ import division, print_function
+import pytest
+from hypothesis import given, strategies
+
+from pyfidget.affine import AffineForm, linear, mul, square
+from pyfidget.context import RenderContext
+from pyfidget.optimize import optimize
+from pyfidget.parse import parse
+from pyfidget.vm import render_image_octree_optimize
+from pyfidget.bench import count_tiles
+
+regular_floats = strategies.floats(min_value=-1e10, max_value=1e10)
+noise = strategies.floats(min_value=-1.0, max_value=1.0)
+
+def load(filename):
+    with open(filename) as f:
+        return parse(f.read())
+
+def affine_context():
+    context = RenderContext()
+    context.affine = True
+    return context
+
+def evaluate(form, symbols):
+    res = form.center
+    for symbol, coeff in zip(form.symbols, form.coeffs):
+        res += coeff * symbols[symbol]
+    return res
+
+def check_contains(form, value):
+    minimum, maximum = form.bounds()
+    assert minimum <= value <= maximum
+
+@given(regular_floats, regular_floats, regular_floats, regular_floats, noise, noise, noise)
+def test_mul_square_linear(a0, a1, b0, b1, e0, e1, e2):
+    symbols = [e0, e1, e2]
+    a = AffineForm(a0, [0, 1], [a1, 1.0], 0.0)
+    b = AffineForm(b0, [1, 2], [b1, -0.5], 0.0)
+    aval = evaluate(a, symbols)
+    bval = evaluate(b, symbols)
+    check_contains(linear(a, 1.0, b, -1.0), aval - bval)
+    check_contains(linear(a, 2.5, None, 0.0, 1.0), 2.5 * aval + 1.0)
+    check_contains(mul(a, b, 3), aval * bval)
+    check_contains(square(a, 3), aval * aval)
+
+def test_correlation():
+    # x * (1 - x) on [0, 1] is in [0, 0.25], intervals give [0, 1]
+    program = parse("""
+x var-x
+one const 1.0
+a sub one x
+out mul x a
+""")
+    _, minimum, maximum = optimize(program, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0)
+    assert maximum == 1.0
+    _, minimum, maximum = optimize(program, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, context=affine_context())
+    assert minimum == 0.0
+    assert 0.25 <= maximum < 0.6
+
+def test_optimize_affine_is_tighter():
+    program = parse("""
+x var-x
+y var-y
+a mul x x
+b mul x y
+c sub a b
+out sub c a
+""")
+    _, minimum, maximum = optimize(program, -1.0, 1.0, 0.5, 1.0, 0.0, 0.0)
+    _, aminimum, amaximum = optimize(program, -1.0, 1.0, 0.5, 1.0, 0.0, 0.0, context=affine_context())
+    assert minimum <= aminimum and amaximum <= maximum
+    assert amaximum - aminimum < maximum - minimum
+
+@pytest.mark.parametrize("filename, bounds", [
+    ("quarter.vm", (-1.0, 1.0, -1.0, 1.0)),
+    ("tanglecube.vm", (-3.0, 3.0, -3.0, 3.0)),
+    ("tanglecube.vm", (-1.5, 2.5, -2.0, 1.0)),
+])
+def test_render_affine(filename, bounds):
+    program = load(filename)
+    expected = render_image_octree_optimize(program, 256, 256, *bounds)
+    assert render_image_octree_optimize(program, 256, 256, *bounds, context=affine_context()) == expected
+
+def test_count_tiles():
+    program = load("tanglecube.vm")
+    levels = count_tiles(program, 256, 256, -3.0, 3.0, -3.0, 3.0)
+    affine_levels = count_tiles(program, 256, 256, -3.0, 3.0, -3.0, 3.0, affine_context())
+    assert levels[0].subdivided == affine_levels[0].subdivided == 1
+    assert sum([counts.leaf_pixels for counts in affine_levels]) < \
+            sum([counts.leaf_pixels for counts in levels])
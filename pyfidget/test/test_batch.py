@@ -0,0 +1,92 @@
+from __future__ import division, print_function
+import pytest
+
+from pyfidget.vm import DirectFrame, IntervalFrame, render_image_naive_fragment, render_image_octree_optimize
+from pyfidget.parse import parse
+
+numpy = pytest.importorskip("numpy")
+
+from pyfidget.batch import NumpyFrame, render_image_numpy_fragment, render_image_numpy, \
+        NumpyIntervalFrame, render_image_octree_optimize_bfs
+
+def load(filename):
+    with open(filename) as f:
+        return parse(f.read())
+
+def test_run_arrays():
+    program = load("quarter.vm")
+    frame = DirectFrame(program)
+    xs = numpy.array([[-1.0, -0.5, 0.0, 0.25, 1.0]])
+    ys = numpy.array([[-1.0], [-0.1], [0.3]])
+    res = NumpyFrame(program).run_arrays(xs, ys, 0.0)
+    assert res.shape == (3, 5)
+    for i, y in enumerate(ys[:, 0]):
+        for j, x in enumerate(xs[0]):
+            assert res[i, j] == frame.run_floats(x, y, 0.0)
+
+@pytest.mark.parametrize("filename", ["quarter.vm", "tanglecube.vm"])
+def test_numpy_fragment_matches_naive(filename):
+    program = load(filename)
+    for startx, stopx, starty, stopy in [(0, 20, 0, 20), (2, 5, 2, 18), (7, 8, 3, 11)]:
+        result1 = ['\x00'] * 400
+        render_image_naive_fragment(DirectFrame(program), 20, 20, -2.0, 2.0, -2.0, 2.0, result1, startx, stopx, starty, stopy)
+        result2 = ['\x00'] * 400
+        render_image_numpy_fragment(NumpyFrame(program), 20, 20, -2.0, 2.0, -2.0, 2.0, result2, startx, stopx, starty, stopy)
+        assert result1 == result2
+
+def test_render_image_numpy():
+    program = load("quarter.vm")
+    result = ['\x00'] * (64 * 64)
+    render_image_naive_fragment(DirectFrame(program), 64, 64, -1.0, 1.0, -1.0, 1.0, result, 0, 64, 0, 64)
+    assert render_image_numpy(program, 64, 64, -1.0, 1.0, -1.0, 1.0) == result
+
+def test_octree_leaves_use_numpy():
+    program = load("quarter.vm")
+    result = ['\x00'] * (256 * 256)
+    render_image_naive_fragment(DirectFrame(program), 256, 256, -1.0, 1.0, -1.0, 1.0, result, 0, 256, 0, 256)
+    assert render_image_octree_optimize(program, 256, 256, -1.0, 1.0, -1.0, 1.0) == result
+
+def test_numpy_intervals_match_interval_frame():
+    program = load("tanglecube.vm")
+    boxes = [(-2.0, -1.0, 0.5, 3.0), (0.0, 0.0, -1.0, 1.0), (-0.5, 0.25, -3.0, -2.5)]
+    minx, maxx, miny, maxy = [numpy.array(column) for column in zip(*boxes)]
+    zeros = numpy.zeros(len(boxes))
+    frame = NumpyIntervalFrame(program)
+    minimum, maximum = frame.run_intervals(minx, maxx, miny, maxy, zeros, zeros)
+    assert frame.minvalues.shape == (program.num_operations(), len(boxes))
+    for i, box in enumerate(boxes):
+        expected = IntervalFrame(program).run_intervals(box[0], box[1], box[2], box[3], 0.0, 0.0)
+        assert (minimum[i], maximum[i]) == expected
+
+@pytest.mark.parametrize("filename", ["quarter.vm", "tanglecube.vm"])
+def test_render_bfs(filename):
+    program = load(filename)
+    data1 = render_image_octree_optimize(program, 256, 256, -1.5, 1.5, -1.5, 1.5)
+    data2 = render_image_octree_optimize_bfs(program, 256, 256, -1.5, 1.5, -1.5, 1.5)
+    assert data1 == data2
+
+def test_count_choices():
+    from pyfidget.batch import count_choices
+    program = parse("""
+_0 var-x
+_1 var-y
+_2 min _0 _1
+_3 max _0 _1
+""")
+    boxes = [(0.0, 1.0, 2.0, 3.0), (0.0, 1.0, 0.5, 3.0)]
+    minx, maxx, miny, maxy = [numpy.array(column) for column in zip(*boxes)]
+    zeros = numpy.zeros(len(boxes))
+    frame = NumpyIntervalFrame(program)
+    frame.run_intervals(minx, maxx, miny, maxy, zeros, zeros, all_ops=True)
+    assert list(count_choices(program, frame.minvalues, frame.maxvalues)) == [2, 0]
+
+def test_render_bfs_keeps_parent_programs():
+    from pyfidget.context import RenderContext
+    program = load("tanglecube.vm")
+    expected = render_image_octree_optimize(program, 256, 256, -1.5, 1.5, -1.5, 1.5)
+    context = RenderContext()
+    assert render_image_octree_optimize_bfs(program, 256, 256, -1.5, 1.5, -1.5, 1.5, context=context) == expected
+    # tiles where the intervals decide nothing are checked together with the
+    # children of other tiles, and the optimizer reuses the intervals
+    assert context.stats.specializations_skipped > 0
+    assert context.stats.batched_intervals_reused > 0
@@ -0,0 +1,106 @@
+from __future__ import division, print_function
+import pytest
+
+from pyfidget.context import RenderContext
+from pyfidget.costmodel import CostModel, calibrate
+from pyfidget.parse import parse
+from pyfidget.vm import render_image_octree_optimize
+
+def load(filename):
+    with open(filename) as f:
+        return parse(f.read())
+
+def test_min_shrink():
+    model = CostModel(1e-6, 1e-8)
+    assert model.min_shrink(100) == pytest.approx(1.0)
+    assert model.min_shrink(1000) == pytest.approx(0.1)
+    assert model.should_specialize(0.2, 1000)
+    assert not model.should_specialize(0.05, 1000)
+
+def test_calibrate():
+    program = load("tanglecube.vm")
+    model = calibrate(program, -3.0, 3.0, -3.0, 3.0)
+    assert model.optimize_cost > 0
+    assert model.evaluate_cost > 0
+    assert model.tile_cost > 0
+
+@pytest.mark.parametrize("filename, bounds", [
+    ("quarter.vm", (-1.0, 1.0, -1.0, 1.0)),
+    ("tanglecube.vm", (-3.0, 3.0, -3.0, 3.0)),
+])
+def test_render_skipping_specializations(filename, bounds):
+    program = load(filename)
+    expected = render_image_octree_optimize(program, 256, 256, *bounds)
+    # specializing is never worth it below the first level
+    context = RenderContext()
+    context.cost_model = PinnedSubdivision(1.0, 1e-9)
+    assert render_image_octree_optimize(program, 256, 256, *bounds, context=context) == expected
+    assert context.stats.specializations_skipped > 0
+    skipped = context.stats.specializations_skipped
+    # worth it unless the parent didn't shrink the program at all
+    context = RenderContext()
+    context.cost_model = PinnedSubdivision(1e-9, 1.0)
+    assert render_image_octree_optimize(program, 256, 256, *bounds, context=context) == expected
+    assert context.stats.specializations_skipped < skipped
+
+class PinnedSubdivision(CostModel):
+    # subdivides like without a cost model, so that only the specializations
+    # depend on the costs
+    def should_subdivide(self, num_ops, pixels, num_children=4):
+        from pyfidget.vm import LIMIT
+        return pixels > LIMIT * LIMIT
+
+def test_render_adaptive():
+    program = load("tanglecube.vm")
+    expected = render_image_octree_optimize(program, 256, 256, -3.0, 3.0, -3.0, 3.0)
+    context = RenderContext()
+    context.adaptive = True
+    assert render_image_octree_optimize(program, 256, 256, -3.0, 3.0, -3.0, 3.0, context=context) == expected
+    assert context.cost_model is not None
+
+def test_should_subdivide():
+    model = CostModel(1e-6, 1e-8)
+    # subdividing costs 4e-6 per op, directly evaluating 1e-8 per op and
+    # pixel, of which half are saved
+    assert not model.should_subdivide(100, 800)
+    assert model.should_subdivide(100, 801)
+    # without a cost per tile, the length of the program cancels out
+    assert model.should_subdivide(7866, 801) == model.should_subdivide(10, 801)
+    # with one, short programs are evaluated directly in bigger tiles
+    model = CostModel(1e-6, 1e-8, tile_cost=1e-4)
+    assert model.should_subdivide(7866, 1000)
+    assert not model.should_subdivide(10, 1000)
+    assert model.should_subdivide(10, 40800)
+
+def test_render_directly():
+    from pyfidget.vm import render_directly
+    program = load("quarter.vm")
+    context = RenderContext()
+    assert render_directly(program, 0, 8, 0, 8, context)
+    assert not render_directly(program, 0, 16, 0, 16, context)
+    context.cost_model = CostModel(1e-6, 1e-8)
+    assert render_directly(program, 0, 16, 0, 16, context)
+    assert not render_directly(program, 0, 32, 0, 32, context)
+    context.cost_model = CostModel(1e-9, 1e-6)
+    assert not render_directly(program, 0, 2, 0, 2, context)
+    assert render_directly(program, 0, 1, 0, 2, context)
+
+def test_profile(tmpdir):
+    from pyfidget.costmodel import save_profile, load_profile
+    filename = str(tmpdir.join("profile"))
+    save_profile(CostModel(1.5e-6, 2.25e-8, 0.25, 3e-5), filename)
+    model = load_profile(filename)
+    assert (model.optimize_cost, model.evaluate_cost, model.ambiguous_fraction,
+            model.tile_cost) == (1.5e-6, 2.25e-8, 0.25, 3e-5)
+    with open(filename, "w") as f:
+        f.write("optimize_cost 1.0\n")
+    with pytest.raises(ValueError):
+        load_profile(filename)
+
+def test_render_with_cost_model():
+    program = load("quarter.vm")
+    expected = render_image_octree_optimize(program, 128, 128, -1.0, 1.0, -1.0, 1.0)
+    # subdivides down to single pixels
+    context = RenderContext()
+    context.cost_model = CostModel(1e-12, 1.0)
+    assert render_image_octree_optimize(program, 128, 128, -1.0, 1.0, -1.0, 1.0, context=context) == expected
@@ -0,0 +1,89 @@
+from __future__ import division, print_function
+import math
+
+import pytest
+from hypothesis import given, strategies
+
+from pyfidget.context import RenderContext
+from pyfidget.gradient import GradientFrame, lipschitz_sign
+from pyfidget.parse import parse
+from pyfidget.vm import DirectFrame, render_image_octree_optimize
+from pyfidget.bench import count_tiles
+
+def load(filename):
+    with open(filename) as f:
+        return parse(f.read())
+
+circle = parse("""
+x var-x
+y var-y
+x2 square x
+y2 square y
+r2 add x2 y2
+r sqrt r2
+one const 1.0
+out sub r one
+""")
+
+coordinates = strategies.floats(min_value=-3.0, max_value=3.0)
+
+@given(coordinates, coordinates, coordinates, coordinates)
+def test_gradient_contains_derivative(x0, x1, y0, y1):
+    program = load("tanglecube.vm")
+    minx, maxx = sorted([x0, x1])
+    miny, maxy = sorted([y0, y1])
+    frame = GradientFrame(program)
+    frame.run_gradients(minx, maxx, miny, maxy, 0.0, 0.0)
+    result = program.num_operations() - 1
+    # the derivative of x ** 4 - 5 * x ** 2 + ... along x
+    for x in [minx, maxx, minx * 0.5 + maxx * 0.5]:
+        dx = 4 * x ** 3 - 10 * x
+        assert frame.mingrads[result * 3] - 1e-9 <= dx <= frame.maxgrads[result * 3] + 1e-9
+    assert frame.mingrads[result * 3 + 2] == frame.maxgrads[result * 3 + 2] == 0.0
+
+def test_gradient_point():
+    # at a point the gradient intervals are exact: a normal of the circle
+    frame = GradientFrame(circle)
+    frame.run_gradients(0.6, 0.6, 0.8, 0.8, 0.0, 0.0)
+    result = circle.num_operations() - 1
+    assert abs(frame.mingrads[result * 3] - 0.6) < 1e-12
+    assert abs(frame.maxgrads[result * 3 + 1] - 0.8) < 1e-12
+
+def test_gradient_sqrt_of_zero_is_unknown():
+    frame = GradientFrame(circle)
+    frame.run_gradients(-0.1, 0.1, -0.1, 0.1, 0.0, 0.0)
+    result = circle.num_operations() - 1
+    assert math.isnan(frame.gradient_bound(result, 0))
+
+def test_lipschitz_sign():
+    context = RenderContext()
+    # |grad| <= 1 for a distance field
+    assert lipschitz_sign(circle, 0.1, 0.2, 0.1, 0.2, context) == -1
+    assert lipschitz_sign(circle, 1.5, 1.6, -0.1, 0.1, context) == 1
+    assert lipschitz_sign(circle, 0.9, 1.1, -0.1, 0.1, context) == 0
+    assert context.stats.lipschitz_resolved == 2
+    # all the calls use the frame of the context
+    frame = context.gradient_frame
+    assert frame is not None
+    lipschitz_sign(circle, 0.1, 0.2, 0.1, 0.2, context)
+    assert context.gradient_frame is frame
+
+@pytest.mark.parametrize("filename, bounds", [
+    ("quarter.vm", (-1.0, 1.0, -1.0, 1.0)),
+    ("tanglecube.vm", (-3.0, 3.0, -3.0, 3.0)),
+])
+def test_render_lipschitz(filename, bounds):
+    program = load(filename)
+    context = RenderContext()
+    context.lipschitz = True
+    expected = render_image_octree_optimize(program, 256, 256, *bounds)
+    assert render_image_octree_optimize(program, 256, 256, *bounds, context=context) == expected
+
+def test_count_tiles_lipschitz():
+    program = load("tanglecube.vm")
+    context = RenderContext()
+    context.lipschitz = True
+    levels = count_tiles(program, 256, 256, -3.0, 3.0, -3.0, 3.0)
+    lipschitz_levels = count_tiles(program, 256, 256, -3.0, 3.0, -3.0, 3.0, context)
+    assert sum([counts.leaf_pixels for counts in lipschitz_levels]) < \
+            sum([counts.leaf_pixels for counts in levels])
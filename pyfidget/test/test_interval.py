@@ -112,3 +112,79 @@ def test_min(val):
     rmin, rmax = intervalframe._min(a1, c1, a2, c2)
     res = frame.min(b1, b2)
     assert contains(res, rmin, rmax)
+
+
+# infinite bounds
+
+extended_floats = strategies.floats(allow_nan=False)
+
+def contains_extended(res, rmin, rmax):
+    # a nan result must have been predicted
+    if math.isnan(res):
+        return math.isnan(rmin) and math.isnan(rmax)
+    return contains(res, rmin, rmax)
+
+range_and_contained_extended_float = strategies.builds(
+    make_range_and_contained_float, extended_floats, extended_floats, extended_floats)
+
+range_and_contained_extended_float2 = strategies.builds(
+    make_range_and_contained_float2,
+    extended_floats, extended_floats, extended_floats,
+    extended_floats, extended_floats, extended_floats
+)
+
+@given(range_and_contained_extended_float)
+def test_unary_extended(val):
+    a, b, c = val
+    for name in ["square", "abs", "neg"]:
+        rmin, rmax = getattr(intervalframe, "_" + name)(a, c)
+        res = getattr(frame, name)(b)
+        assert contains_extended(res, rmin, rmax)
+    rmin, rmax = intervalframe._exp(a, c)
+    assert not math.isnan(rmin) and not math.isnan(rmax)
+    if b < 700:
+        assert contains_extended(frame.exp(b), rmin, rmax)
+    else:
+        assert rmax == float('inf') or rmax >= math.exp(700)
+    if a >= 0:
+        assert contains_extended(frame.sqrt(b), *intervalframe._sqrt(a, c))
+
+@given(range_and_contained_extended_float2)
+def test_binary_extended(val):
+    a1, b1, c1, a2, b2, c2 = val
+    for name in ["add", "sub", "mul", "min", "max"]:
+        rmin, rmax = getattr(intervalframe, "_" + name)(a1, c1, a2, c2)
+        res = getattr(frame, name)(b1, b2)
+        assert contains_extended(res, rmin, rmax)
+
+def test_infinities():
+    inf = float('inf')
+    assert intervalframe._exp(0.0, 1000.0) == (1.0, inf)
+    assert intervalframe._exp(-inf, 0.0) == (0.0, 1.0)
+    assert intervalframe._add(1.0, inf, 2.0, 3.0) == (3.0, inf)
+    assert intervalframe._square(-inf, 1.0) == (0.0, inf)
+    assert intervalframe._min(-inf, 1.0, 0.0, 2.0) == (-inf, 1.0)
+    for rmin, rmax in [intervalframe._add(-inf, 0.0, 0.0, inf),
+                       intervalframe._sub(0.0, inf, 0.0, inf),
+                       intervalframe._mul(0.0, 1.0, 1.0, inf),
+                       intervalframe._add(float('nan'), float('nan'), 0.0, 1.0),
+                       intervalframe._max(float('nan'), float('nan'), 0.0, 1.0)]:
+        assert math.isnan(rmin) and math.isnan(rmax)
+
+def test_optimize_overflow():
+    from pyfidget.optimize import optimize
+    from pyfidget.parse import parse
+    program = parse("""
+x var-x
+y var-y
+big const 1e300
+a mul y big
+b mul a big
+out min x b
+""")
+    # b overflows, but the min is still known to be negative
+    newprogram, minimum, maximum = optimize(program, -2.0, -1.0, 0.0, 1.0, 0.0, 0.0)
+    assert newprogram is None
+    assert minimum == -2.0 and maximum == -1.0
+    newprogram, minimum, maximum = optimize(program, -1.0, 1.0, 0.0, 1.0, 0.0, 0.0)
+    assert minimum == -1.0 and maximum == 1.0
@@ -6,7 +6,7 @@ from hypothesis import given, strategies, assume
 
 from pyfidget.optimize import optimize, convert_to_shortcut
 from pyfidget.parse import parse
-from pyfidget.vm import ProgramBuilder, DirectFrame
+from pyfidget.vm import ProgramBuilder, DirectFrame, CompactProgramBuilder
 from pyfidget.vm import IntervalFrame
 from pyfidget.operations import OPS
 
@@ -42,6 +42,30 @@ def check_well_formed(program):
             for arg in program.get_args(op):
                 assert arg in seen
         seen.add(op)
+    if program.slots is not None:
+        check_slots(program)
+
+def check_slots(program):
+    # no op may write a slot whose value is still needed later
+    num_ops = program.num_operations()
+    last_use = [-1] * num_ops
+    for op in program:
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            continue
+        numargs = OPS.num_args(func)
+        if numargs >= 1:
+            last_use[arg0] = op
+        if numargs == 2:
+            last_use[arg1] = op
+    slots = program.get_slots()
+    owners = {}
+    for op in program:
+        slot = slots[op]
+        assert 0 <= slot < program.size_storage()
+        if slot in owners:
+            assert last_use[owners[slot]] < op
+        owners[slot] = op
 
 def test_optimize_abs():
     ops = parse("""
@@ -204,11 +228,14 @@ mtwo const -2.0
 two const 2.0
 mfour mul mtwo two
 out mul mfour x
+res add out two
 """)
     check_optimize(ops, expected="""\
 x var-x
+two const 2.0
 mfour const -4.0
 out mul mfour x
+res add out two
 """)
 
 @pytest.mark.xfail
@@ -420,6 +447,87 @@ _5 min _2 _4
     check_optimize(program, expected)
 
 
+def test_demand_neg_flips():
+    # the sign of -max(x, y) only depends on x if y < 0
+    ops = """
+x var-x
+y var-y
+m max x y
+out neg m
+"""
+    check_optimize(ops, -10.0, 10.0, -10.0, -1.0, 0, 0, """
+x var-x
+out neg x
+""")
+
+def test_demand_mul_positive():
+    ops = """
+x var-x
+y var-y
+m min x y
+two const 2.0
+out mul m two
+"""
+    check_optimize(ops, -10.0, 10.0, 1.0, 10.0, 0, 0, """
+x var-x
+""")
+    # multiplying by a negative number flips the sign
+    check_optimize(ops.replace("2.0", "-2.0"), -10.0, 10.0, 1.0, 10.0, 0, 0, """
+x var-x
+out neg x
+""")
+
+def test_demand_sqrt_square():
+    ops = """
+x var-x
+y var-y
+m min x y
+out sqrt m
+"""
+    check_optimize(ops, -10.0, 10.0, 1.0, 10.0, 0, 0, """
+x var-x
+""")
+    # square only needs to know whether the max is 0
+    ops = """
+x var-x
+y var-y
+m max x y
+out square m
+"""
+    check_optimize(ops, -10.0, 10.0, -10.0, -1.0, 0, 0, """
+x var-x
+out square x
+""")
+
+def test_demand_value_use_blocks_rewrite():
+    # m is also used for its value, so it must stay a min
+    ops = """
+x var-x
+y var-y
+m min x y
+one const 1.0
+a add m one
+out min a m
+"""
+    check_optimize(ops, -10.0, 10.0, 1.0, 10.0, 0, 0, """
+x var-x
+y var-y
+m min x y
+one const 1.0
+a add m one
+out min a m
+""")
+
+def test_add_can_drop():
+    from pyfidget.optimize import add_can_drop, DEMAND_POS, DEMAND_NEG, DEMAND_SIGN
+    assert add_can_drop(1.0, 2.0, 0.5, 0.9, DEMAND_SIGN)
+    assert add_can_drop(1.0, 2.0, -0.5, 0.5, DEMAND_POS)
+    assert not add_can_drop(1.0, 2.0, -1.0, 0.5, DEMAND_POS)
+    assert not add_can_drop(-1.0, 1.0, 0.5, 0.9, DEMAND_POS)
+    assert add_can_drop(-2.0, -1.0, -0.5, 0.5, DEMAND_NEG)
+    assert not add_can_drop(-2.0, -1.0, -0.5, 1.0, DEMAND_NEG)
+    assert not add_can_drop(1.0, float('inf'), 0.5, 0.9, DEMAND_POS)
+
 @pytest.mark.xfail
 def test_min_max_interleave_backwards():
     program = """
@@ -471,8 +579,141 @@ def make_op2(data, operations):
     func = data.draw(strategies.sampled_from(['add', 'sub', 'min', 'max', 'mul']))
     return operations.add_op(OPS.get(func), arg0, arg1)
 
+def test_optimize_compact_program():
+    with open("tanglecube.vm") as f:
+        program = parse(f.read())
+    compact = CompactProgramBuilder.from_program(program)
+    for box in [(-1.5, 1.5, -1.5, 1.5), (-0.2, 0.1, 0.5, 0.8), (1.0, 1.2, -1.5, -1.4), (0.5, 1.5, 0.5, 1.5)]:
+        newops, minimum, maximum = optimize(program, box[0], box[1], box[2], box[3], 0.0, 0.0)
+        newcompact, minimum2, maximum2 = optimize(compact, box[0], box[1], box[2], box[3], 0.0, 0.0)
+        assert (minimum, maximum) == (minimum2, maximum2)
+        if newops is None:
+            assert newcompact is None
+            continue
+        assert isinstance(newcompact, CompactProgramBuilder)
+        check_well_formed(newcompact)
+        assert newcompact.pretty_format() == newops.pretty_format()
+
+@pytest.mark.parametrize("affine", [False, True])
+def test_optimize_siblings_share_axis_intervals(affine):
+    from pyfidget.context import RenderContext
+    with open("tanglecube.vm") as f:
+        program = parse(f.read())
+    context = RenderContext()
+    context.affine = affine
+    parent, _, _ = optimize(program, -3.0, 0.0, -3.0, 0.0, 0.0, 0.0, context=context)
+    assert parent.context is context
+    # a copy that belongs to no context doesn't share anything
+    copy = CompactProgramBuilder.from_program(parent)
+    for a, b in [(-3.0, -1.5), (-1.5, 0.0)]:
+        for c, d in [(-3.0, -1.5), (-1.5, 0.0)]:
+            reused = context.stats.axis_intervals_reused
+            newops, minimum, maximum = optimize(parent, a, b, c, d, 0.0, 0.0, context=context)
+            expected, minimum2, maximum2 = optimize(copy, a, b, c, d, 0.0, 0.0, context=context)
+            assert (minimum, maximum) == (minimum2, maximum2)
+            if newops is None:
+                assert expected is None
+            else:
+                assert newops.pretty_format() == expected.pretty_format()
+            if (a, c) == (-3.0, -3.0):
+                assert context.stats.axis_intervals_reused == reused
+    assert context.stats.axis_intervals_reused > 0
+    # a reset program forgets them
+    parent.delete()
+    reused = ProgramBuilder.new(context)
+    assert reused is parent and reused.axis_intervals is None and reused.axes is None
+
+def test_optimize_with_bounds():
+    program = parse("""
+_0 var-x
+_1 const 1
+_2 sub _0 _1
+_3 var-y
+_4 min _2 _3
+""")
+    from pyfidget.context import RenderContext
+    context = RenderContext()
+    frame = IntervalFrame(program)
+    frame.run_intervals(0.5, 2.0, 2.0, 3.0, 0.0, 0.0)
+    newops, minimum, maximum = optimize(program, 0.5, 2.0, 2.0, 3.0, 0.0, 0.0, context=context,
+                                        minbounds=frame.minvalues[:5], maxbounds=frame.maxvalues[:5])
+    assert newops.pretty_format() == parse("""
+_0 var-x
+_1 const 1
+_2 sub _0 _1
+""").pretty_format()
+    assert (minimum, maximum) == (-0.5, 1.0)
+    assert context.stats.batched_intervals_reused == 5
+
+def test_slice_program():
+    from pyfidget.context import RenderContext
+    from pyfidget.optimize import slice_program
+    program = parse("""
+x var-x
+y var-y
+x2 square x
+y2 square y
+r2 add x2 y2
+one const 1.0
+circle sub r2 one
+xm sub x one
+out min circle xm
+""")
+    context = RenderContext()
+    # xm is < 0 everywhere, circle is not
+    newprogram, minimum, maximum = slice_program(program, -0.5, 0.5, 2.0, 3.0, 0.0, 0.0, context=context)
+    assert newprogram is None and maximum < 0
+    # circle is > 0.2 everywhere, xm is <= 0.2
+    newprogram, minimum, maximum = slice_program(program, 0.0, 1.2, 1.2, 1.5, 0.0, 0.0, for_direct=False, context=context)
+    assert newprogram.pretty_format() == """\
+_0 var-x
+_1 const 1.000000
+_2 sub _0 _1"""
+    assert context.stats.choices_sliced == 6
+    # both are possible
+    newprogram, minimum, maximum = slice_program(program, 0.5, 1.5, 0.0, 0.5, 0.0, 0.0, context=context)
+    assert newprogram.num_operations() == program.num_operations()
+    assert OPS.should_return_if_neg(newprogram.get_func(newprogram.num_operations() - 1))
+
+@pytest.mark.parametrize("filename, bounds", [
+    ("quarter.vm", (-1.0, 1.0, -1.0, 1.0)),
+    ("tanglecube.vm", (-3.0, 3.0, -3.0, 3.0)),
+])
+def test_render_choice_tape(filename, bounds):
+    from pyfidget.context import RenderContext
+    from pyfidget.vm import render_image_octree_optimize
+    with open(filename) as f:
+        program = parse(f.read())
+    context = RenderContext()
+    context.choice_tape = True
+    expected = render_image_octree_optimize(program, 256, 256, *bounds)
+    assert render_image_octree_optimize(program, 256, 256, *bounds, context=context) == expected
+    assert context.unused_slicer is not None
+    assert context.unused_optimizer is None
+
 @given(strategies.data())
 def test_random(data):
+    check_random(data)
+
+@given(strategies.data())
+def test_random_affine(data):
+    from pyfidget.context import RenderContext
+    context = RenderContext()
+    context.affine = True
+    check_random(data, context)
+
+@given(strategies.data())
+def test_random_choice_tape(data):
+    from pyfidget.context import RenderContext
+    context = RenderContext()
+    context.choice_tape = True
+    check_random(data, context)
+
+@given(strategies.data())
+def test_random_bounds(data):
+    check_random(data, with_bounds=True)
+
+def check_random(data, context=None, with_bounds=False):
     num_ops = data.draw(strategies.integers(1, 100))
     num_final_ops = data.draw(strategies.integers(3, 10))
     a = data.draw(regular_floats)
@@ -500,7 +741,16 @@ def test_random(data):
         prev_op = ops.add_op(OPS.get(func), *args)
     program = ops
     frame = DirectFrame(program)
-    resultops, minimum, maximum = optimize(program, minx, maxx, miny, maxy, 0.0, 0.0)
+    minbounds = maxbounds = None
+    if with_bounds:
+        # the intervals of all the ops, like the breadth-first renderer
+        # passes them in
+        intervalframe = IntervalFrame(program)
+        intervalframe.run_intervals(minx, maxx, miny, maxy, 0.0, 0.0)
+        minbounds = intervalframe.minvalues[:program.num_operations()]
+        maxbounds = intervalframe.maxvalues[:program.num_operations()]
+    resultops, minimum, maximum = optimize(program, minx, maxx, miny, maxy, 0.0, 0.0, context=context,
+                                           minbounds=minbounds, maxbounds=maxbounds)
     if resultops:
         check_well_formed(resultops)
     try:
@@ -536,3 +786,387 @@ def test_random(data):
             import pdb;pdb.set_trace()
             assert 0
 
+
+def check_value_numbering(program, expected):
+    from pyfidget.optimize import value_numbering
+    if isinstance(program, str):
+        program = parse(program)
+    newops = value_numbering(program)
+    check_well_formed(newops)
+    assert newops.pretty_format() == parse(expected).pretty_format()
+
+def test_value_numbering():
+    check_value_numbering("""
+x var-x
+y var-y
+a add x y
+b add y x
+c sub x y
+d sub y x
+e mul a c
+f mul b d
+g min e f
+""", """
+x var-x
+y var-y
+a add x y
+c sub x y
+d sub y x
+e mul a c
+f mul a d
+g min e f
+""")
+
+def test_value_numbering_consts():
+    check_value_numbering("""
+x var-x
+c0 const 1.5
+c1 const 1.5
+z0 const 0.0
+z1 const -0.0
+z2 const 0.0
+a add x c0
+b add x c1
+m mul a b
+n mul z0 z1
+o mul z2 z1
+p add n o
+q add m p
+""", """
+x var-x
+c0 const 1.5
+z0 const 0.0
+z1 const -0.0
+a add x c0
+m mul a a
+n mul z0 z1
+p add n n
+q add m p
+""")
+
+def test_value_numbering_empty():
+    from pyfidget.optimize import value_numbering
+    program = parse("")
+    assert value_numbering(program) is program
+
+def test_value_numbering_result_is_duplicate():
+    # the last op is a duplicate, everything after its first occurrence is
+    # not needed any more
+    check_value_numbering("""
+x var-x
+y var-y
+a max x y
+b neg a
+c max y x
+""", """
+x var-x
+y var-y
+a max x y
+""")
+
+@pytest.mark.parametrize("filename", ["quarter.vm", "tanglecube.vm"])
+def test_value_numbering_render(filename):
+    from pyfidget.optimize import value_numbering
+    from pyfidget.vm import render_image_octree_optimize
+    with open(filename) as f:
+        program = parse(f.read())
+    newops = value_numbering(program)
+    assert newops.num_operations() <= program.num_operations()
+    assert render_image_octree_optimize(newops, 128, 128, -1.5, 1.5, -1.5, 1.5) == \
+            render_image_octree_optimize(program, 128, 128, -1.5, 1.5, -1.5, 1.5)
+
+def check_flatten_min_max(program, expected):
+    from pyfidget.optimize import flatten_min_max
+    if isinstance(program, str):
+        program = parse(program)
+    newops = flatten_min_max(program)
+    check_well_formed(newops)
+    assert newops.pretty_format() == parse(expected).pretty_format()
+
+def test_flatten_min_max():
+    check_flatten_min_max("""
+x var-x
+y var-y
+z var-z
+a min x y
+one const 1.0
+b add z one
+c min b z
+d min a c
+e max d x
+""", """
+x var-x
+y var-y
+z var-z
+one const 1.0
+b add z one
+a min x y
+d min a b
+c min d z
+e max c x
+""")
+
+def test_flatten_min_max_shared():
+    # a is also used by the add, so it must stay
+    check_flatten_min_max("""
+x var-x
+y var-y
+z var-z
+a min x y
+b min z a
+c add a b
+""", """
+x var-x
+y var-y
+z var-z
+a min x y
+b min z a
+c add a b
+""")
+
+def test_optimize_chain_prunes_together():
+    from pyfidget.context import RenderContext
+    # x in [5, 6] is above z in [0, 1], but not above y, the other operand of
+    # its min
+    program = parse("""
+x var-x
+y var-y
+z var-z
+a min x y
+out min a z
+""")
+    context = RenderContext()
+    newops, _, _ = optimize(program, 5.0, 6.0, -10.0, 10.0, 0.0, 1.0, context=context)
+    assert newops.pretty_format() == """\
+_0 var-y return_if_neg
+_1 var-z return_if_neg
+_2 min return_if_neg _0 _1"""
+    assert context.stats.chain_pruned == 1
+
+@pytest.mark.parametrize("filename", ["quarter.vm", "tanglecube.vm"])
+def test_flatten_min_max_render(filename):
+    from pyfidget.optimize import value_numbering, flatten_min_max
+    from pyfidget.vm import render_image_octree_optimize
+    with open(filename) as f:
+        program = parse(f.read())
+    newops = flatten_min_max(value_numbering(program))
+    assert newops.num_operations() == value_numbering(program).num_operations()
+    assert render_image_octree_optimize(newops, 128, 128, -1.5, 1.5, -1.5, 1.5) == \
+            render_image_octree_optimize(program, 128, 128, -1.5, 1.5, -1.5, 1.5)
+
+@given(strategies.data())
+def test_random_flatten_min_max(data):
+    from pyfidget.optimize import flatten_min_max
+    ops = ProgramBuilder(10)
+    make_op0(data, ops)
+    for i in range(data.draw(strategies.integers(1, 30))):
+        func = data.draw(strategies.sampled_from(all_operation_generators))
+        func(data, ops)
+    newops = flatten_min_max(ops)
+    check_well_formed(newops)
+    x = data.draw(regular_floats)
+    y = data.draw(regular_floats)
+    try:
+        res = DirectFrame(ops).run_floats(x, y, 0.0)
+    except ValueError:
+        return
+    res2 = DirectFrame(newops).run_floats(x, y, 0.0)
+    assert res == res2 or (math.isnan(res) and math.isnan(res2))
+
+def test_dce_shares_slots():
+    from pyfidget.context import RenderContext
+    with open("tanglecube.vm") as f:
+        program = parse(f.read())
+    context = RenderContext()
+    newops, _, _ = optimize(program, -1.0, 1.0, -1.0, 1.0, 0.0, 0.0, context=context)
+    check_slots(newops)
+    assert newops.size_storage() < newops.num_operations() // 2
+    assert context.stats.slots_saved == newops.num_operations() - newops.size_storage()
+
+@pytest.mark.parametrize("filename", ["quarter.vm", "tanglecube.vm"])
+def test_allocate_slots_render(filename):
+    from pyfidget.optimize import allocate_slots
+    from pyfidget.vm import render_image_octree_optimize, render_image_naive, IntervalFrame
+    with open(filename) as f:
+        program = parse(f.read())
+    expected = render_image_octree_optimize(program, 128, 128, -1.5, 1.5, -1.5, 1.5)
+    naive = render_image_naive(DirectFrame(program), 64, 64, -1.5, 1.5, -1.5, 1.5)
+    interval = IntervalFrame(program).run_intervals(-1.5, 0.0, -1.5, 0.0, 0.0, 0.0)
+    allocate_slots(program)
+    check_slots(program)
+    assert program.size_storage() < program.num_operations()
+    assert render_image_octree_optimize(program, 128, 128, -1.5, 1.5, -1.5, 1.5) == expected
+    assert render_image_naive(DirectFrame(program), 64, 64, -1.5, 1.5, -1.5, 1.5) == naive
+    assert IntervalFrame(program).run_intervals(-1.5, 0.0, -1.5, 0.0, 0.0, 0.0) == interval
+
+@given(strategies.data())
+def test_random_allocate_slots(data):
+    from pyfidget.optimize import allocate_slots
+    ops = ProgramBuilder(10)
+    make_op0(data, ops)
+    for i in range(data.draw(strategies.integers(1, 30))):
+        func = data.draw(strategies.sampled_from(all_operation_generators))
+        func(data, ops)
+    x = data.draw(regular_floats)
+    y = data.draw(regular_floats)
+    try:
+        res = DirectFrame(ops).run_floats(x, y, 0.0)
+    except ValueError:
+        return
+    minimum, maximum = IntervalFrame(ops).run_intervals(x, x + 1.0, y, y + 1.0, 0.0, 0.0)
+    allocate_slots(ops)
+    check_slots(ops)
+    res2 = DirectFrame(ops).run_floats(x, y, 0.0)
+    assert res == res2 or (math.isnan(res) and math.isnan(res2))
+    minimum2, maximum2 = IntervalFrame(ops).run_intervals(x, x + 1.0, y, y + 1.0, 0.0, 0.0)
+    assert minimum == minimum2 or (math.isnan(minimum) and math.isnan(minimum2))
+    assert maximum == maximum2 or (math.isnan(maximum) and math.isnan(maximum2))
+
+def check_fuse_ops(program, expected):
+    from pyfidget.optimize import fuse_ops
+    if isinstance(program, str):
+        program = parse(program)
+    newops = fuse_ops(program)
+    check_well_formed(newops)
+    # the fused ops can't be parsed, compare the formatted programs
+    assert newops.pretty_format() == expected
+    return newops
+
+def test_fuse_ops():
+    check_fuse_ops("""
+x var-x
+y var-y
+x2 square x
+y2 square y
+r2 add x2 y2
+r sqrt r2
+one const 1.0
+d sub y one
+d2 square d
+out min r d2
+""", """\
+_0 var-x
+_1 var-y
+_2 hypot2 _0 _1
+_3 const 1.000000
+_4 sub-square _1 _3
+_5 min _2 _4""")
+
+def test_fuse_ops_shared():
+    # x2 and d are also used elsewhere, so they must stay
+    program = parse("""
+x var-x
+y var-y
+x2 square x
+y2 square y
+r2 add x2 y2
+r sqrt r2
+d sub x y
+d2 square d
+a add r x2
+b add d2 d
+out min a b
+""")
+    newops = check_fuse_ops(program, program.pretty_format())
+    assert newops is program
+
+def test_fuse_ops_flags():
+    # the flags of the outer op move to the fused op, an inner op with a
+    # flag is not fused
+    program = parse("""
+x var-x
+y var-y
+x2 square x
+y2 square y
+r2 add x2 y2
+r sqrt r2
+d sub x y
+d2 square d
+out min r d2
+""")
+    program.set_func(5, OPS.add_flag(OPS.sqrt, OPS.RETURN_IF_NEG))
+    program.set_func(6, OPS.add_flag(OPS.sub, OPS.RETURN_IF_POS))
+    check_fuse_ops(program, """\
+_0 var-x
+_1 var-y
+_2 hypot2 return_if_neg _0 _1
+_3 sub return_if_pos _0 _1
+_4 square _3
+_5 min _2 _4""")
+
+def test_fuse_ops_not_parsed():
+    from pyfidget.parse import ParseError
+    with pytest.raises(ParseError):
+        parse("""
+x var-x
+y var-y
+out hypot2 x y
+""")
+
+def test_fuse_ops_leaf(monkeypatch):
+    from pyfidget import batch
+    from pyfidget.context import RenderContext
+    from pyfidget.vm import LaneFrame, render_image_leaf_fragment, render_image_lanes_fragment
+    program = parse("""
+x var-x
+y var-y
+cx const 0.3
+dx sub x cx
+dx2 square dx
+y2 square y
+r2 add dx2 y2
+r sqrt r2
+radius const 0.7
+circle sub r radius
+ey sub y cx
+ey2 square ey
+x2 square x
+e add ey2 x2
+h const 0.2
+ellipse sub e h
+out min circle ellipse
+""")
+    expected = ['\x00'] * (32 * 32)
+    render_image_lanes_fragment(LaneFrame(program), 32, 32, -1.0, 1.0, -1.0, 1.0, expected, 0, 32, 0, 32)
+    assert '\x01' in expected
+    for use_numpy in [True, False]:
+        if not use_numpy:
+            monkeypatch.setattr(batch, "numpy", None)
+        context = RenderContext()
+        result = ['\x00'] * (32 * 32)
+        render_image_leaf_fragment(program, 32, 32, -1.0, 1.0, -1.0, 1.0, result, 0, 32, 0, 32, context)
+        assert context.stats.ops_fused == 4
+        assert result == expected
+    # the program itself is left alone
+    assert program.num_operations() == 17
+
+@given(strategies.data())
+def test_random_fuse_ops(data):
+    from pyfidget.optimize import fuse_ops
+    ops = ProgramBuilder(10)
+    make_op0(data, ops)
+    for i in range(data.draw(strategies.integers(1, 30))):
+        if data.draw(strategies.booleans()):
+            # make the patterns of fuse_ops likely
+            arg0 = data.draw(strategies.sampled_from(list(ops)))
+            arg1 = data.draw(strategies.sampled_from(list(ops)))
+            if data.draw(strategies.booleans()):
+                a = ops.add_op(OPS.square, arg0)
+                b = ops.add_op(OPS.square, arg1)
+                ops.add_op(OPS.sqrt, ops.add_op(OPS.add, a, b))
+            else:
+                ops.add_op(OPS.square, ops.add_op(OPS.sub, arg0, arg1))
+        else:
+            func = data.draw(strategies.sampled_from(all_operation_generators))
+            func(data, ops)
+    newops = fuse_ops(ops)
+    check_well_formed(newops)
+    assert newops.num_operations() <= ops.num_operations()
+    x = data.draw(regular_floats)
+    y = data.draw(regular_floats)
+    try:
+        res = DirectFrame(ops).run_floats(x, y, 0.0)
+    except ValueError:
+        return
+    res2 = DirectFrame(newops).run_floats(x, y, 0.0)
+    assert res == res2 or (math.isnan(res) and math.isnan(res2))
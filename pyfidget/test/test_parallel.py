@@ -0,0 +1,44 @@
+from pyfidget.vm import render_image_octree_optimize
+from pyfidget.parse import parse
+from pyfidget import parallel
+from pyfidget.parallel import render_image_parallel, split_tiles, ParallelRenderer
+
+def load(filename):
+    with open(filename) as f:
+        return parse(f.read())
+
+def test_split_tiles():
+    assert split_tiles(0, 10, 0, 20, 0) == [(0, 10, 0, 20)]
+    assert split_tiles(0, 10, 0, 20, 1) == [(0, 5, 0, 10), (0, 5, 10, 20), (5, 10, 0, 10), (5, 10, 10, 20)]
+    tiles = split_tiles(0, 64, 0, 64, 3)
+    assert len(tiles) == 64
+    assert sum((stopx - startx) * (stopy - starty) for startx, stopx, starty, stopy in tiles) == 64 * 64
+
+def test_render_parallel():
+    program = load("quarter.vm")
+    try:
+        expected = render_image_octree_optimize(program, 256, 256, -1., 1., -1., 1.)
+        assert render_image_parallel(program, 256, 256, -1., 1., -1., 1., workers=2) == expected
+        pool = parallel._renderer.pool
+        # the pool is reused for the next frame
+        expected = render_image_octree_optimize(program, 256, 256, -1.5, 1., -1., 1.5)
+        assert render_image_parallel(program, 256, 256, -1.5, 1., -1., 1.5, workers=2) == expected
+        assert parallel._renderer.pool is pool
+    finally:
+        parallel._renderer.close()
+        parallel._renderer = None
+
+def test_render_work_stealing(monkeypatch):
+    # a tiny budget forces the workers to hand almost all subtrees back
+    monkeypatch.setattr(parallel, "TASKS_PER_WORKER", 10000)
+    program = load("tanglecube.vm")
+    renderer = ParallelRenderer(program, 256, 256, workers=2)
+    try:
+        expected = render_image_octree_optimize(program, 256, 256, -1.5, 1.5, -1.5, 1.5)
+        assert renderer.render(-1.5, 1.5, -1.5, 1.5) == expected
+        assert 1 <= len(renderer.utilisation) <= 2
+        for pid, utilisation in renderer.utilisation:
+            assert 0.0 < utilisation <= 1.0
+        assert renderer.render_static(-1.5, 1.5, -1.5, 1.5) == expected
+    finally:
+        renderer.close()
@@ -1,6 +1,6 @@
 # test to parse tanglecube.vm
 
-from pyfidget.parse import parse
+from pyfidget.parse import parse, parse_file, ParseError
 
 import pytest
 
@@ -30,3 +30,36 @@ _10 add _f _8
 _11 sub _10 _c
 _12 const 10.000000
 _13 add _11 _12"""
+
+
+def test_parse_file():
+    with open("tanglecube.vm") as f:
+        code = f.read()
+    with open("tanglecube.vm") as f:
+        operations = parse_file(f)
+    assert operations.pretty_format() == parse(code).pretty_format()
+
+def test_parse_whitespace():
+    operations = parse("# comment\r\n\n  a   var-x\r\nb var-y\t\nc add a b")
+    assert operations.pretty_format() == """\
+_0 var-x
+_1 var-y
+_2 add _0 _1"""
+
+@pytest.mark.parametrize("code, lineno, msg", [
+    ("a var-x\nb neg c", 2, "unknown name c"),
+    ("a var-x\n\nb frobnicate a", 3, "unknown operation frobnicate"),
+    ("a var-x\nb add a", 2, "wrong number of arguments for add"),
+    ("a var-x\nb neg a a", 2, "wrong number of arguments for neg"),
+    ("a var-x\nb add a a a", 2, "wrong number of arguments for add"),
+    ("a const", 1, "missing arguments for const"),
+    ("a const x1", 1, "invalid constant x1"),
+    ("a const 1.5 2", 1, "wrong number of arguments for const"),
+    ("a", 1, "missing operation after a"),
+])
+def test_parse_errors(code, lineno, msg):
+    with pytest.raises(ParseError) as excinfo:
+        parse(code)
+    assert excinfo.value.lineno == lineno
+    assert excinfo.value.msg == msg
+    assert str(excinfo.value) == "line %d: %s" % (lineno, msg)
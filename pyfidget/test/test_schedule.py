@@ -0,0 +1,151 @@
+from __future__ import division, print_function
+import math
+
+import pytest
+from hypothesis import given, strategies
+
+from pyfidget.context import RenderContext
+from pyfidget.operations import OPS
+from pyfidget.optimize import convert_to_shortcut
+from pyfidget.parse import parse
+from pyfidget.schedule import ExitProfile, profile_exits, schedule_tape
+from pyfidget.vm import DirectFrame, render_image_octree_optimize
+
+def load(filename):
+    with open(filename) as f:
+        return parse(f.read())
+
+def make_program():
+    program = parse("""
+x var-x
+x2 square x
+x4 square x2
+one const 1.0
+a sub x4 one
+y var-y
+out min a y
+""")
+    convert_to_shortcut(program, program.num_operations() - 1)
+    return program
+
+def make_xy_program():
+    # the ops that only depend on x or on y are computed before the pixel
+    # ops by the leaf renderers, only the order of the pixel ops matters
+    program = parse("""
+x var-x
+y var-y
+xy add x y
+xy2 square xy
+xy4 square xy2
+one const 1.0
+a sub xy4 one
+b sub x y
+out min a b
+""")
+    convert_to_shortcut(program, program.num_operations() - 1)
+    return program
+
+def test_profile_exits():
+    program = make_xy_program()
+    context = RenderContext()
+    # a is > 0 and b is <= 0 in the whole tile
+    profile = profile_exits(program, 16, 16, -1.0, -0.5, 2.0, 3.0, 0, 16, 0, 16, context)
+    assert profile.samples == 4
+    assert profile.exits[7] == 4
+    assert sum(profile.exits) == 4
+
+def test_schedule_leaf(monkeypatch):
+    from pyfidget import batch
+    from pyfidget.schedule import schedule_leaf
+    program = make_xy_program()
+    context = RenderContext()
+    # the numpy leaf renderer never returns early
+    assert schedule_leaf(program, 16, 16, -1.0, -0.5, 2.0, 3.0, 0, 16, 0, 16, context) is program
+    assert program.scheduled is None
+    monkeypatch.setattr(batch, "numpy", None)
+    # two more users, like tiles that share the program through a tape cache
+    program.shared = 2
+    newprogram = schedule_leaf(program, 16, 16, -1.0, -0.5, 2.0, 3.0, 0, 16, 0, 16, context)
+    # b is the first pixel op now
+    func, arg0, arg1 = newprogram.get_func_and_args(newprogram.get_separable().pixel_ops[0])
+    assert (OPS.mask(func), arg0, arg1) == (OPS.sub, 0, 1)
+    assert program.scheduled is newprogram
+    assert context.stats.tapes_scheduled == 1
+    # the schedule is kept on the program
+    assert schedule_leaf(program, 16, 16, -1.0, -0.5, 2.0, 3.0, 0, 16, 0, 8, context) is newprogram
+    assert context.stats.tapes_scheduled == 1
+    assert (program.shared, newprogram.shared) == (0, 2)
+
+def test_schedule_tape():
+    program = make_program()
+    context = RenderContext()
+    profile = ExitProfile(program.num_operations())
+    profile.record(5)
+    newprogram = schedule_tape(program, profile, context)
+    assert newprogram.pretty_format() == """\
+_0 var-y return_if_neg
+_1 var-x
+_2 square _1
+_3 square _2
+_4 const 1.000000
+_5 sub return_if_neg _3 _4
+_6 min return_if_neg _5 _0"""
+    assert context.stats.tapes_scheduled == 1
+    frame = DirectFrame(program, context)
+    frame.run_floats(0.5, -0.5, 0.0)
+    skipped = context.stats.ops_skipped
+    frame = DirectFrame(newprogram, context)
+    frame.run_floats(0.5, -0.5, 0.0)
+    assert context.stats.ops_skipped - skipped == 6
+    # nothing to move
+    profile = ExitProfile(program.num_operations())
+    profile.record(4)
+    assert schedule_tape(program, profile, context) is program
+
+@pytest.mark.parametrize("filename, bounds", [
+    ("quarter.vm", (-1.0, 1.0, -1.0, 1.0)),
+    ("tanglecube.vm", (-3.0, 3.0, -3.0, 3.0)),
+])
+def test_render_schedule(filename, bounds, monkeypatch):
+    from pyfidget import batch
+    program = load(filename)
+    expected = render_image_octree_optimize(program, 256, 256, *bounds)
+    # with the LaneFrame leaf renderer
+    monkeypatch.setattr(batch, "numpy", None)
+    context = RenderContext()
+    context.schedule = True
+    assert render_image_octree_optimize(program, 256, 256, *bounds, context=context) == expected
+
+@given(strategies.data())
+def test_random_schedule(data):
+    from pyfidget.test.test_optimize import all_operation_generators, make_op0, regular_floats
+    from pyfidget.vm import ProgramBuilder
+    from pyfidget.operations import OPS
+    program = ProgramBuilder(10)
+    make_op0(data, program)
+    for i in range(data.draw(strategies.integers(1, 30))):
+        func = data.draw(strategies.sampled_from(all_operation_generators))
+        func(data, program)
+    arg0 = data.draw(strategies.sampled_from(list(program)))
+    arg1 = data.draw(strategies.sampled_from(list(program)))
+    program.add_op(OPS.get(data.draw(strategies.sampled_from(['min', 'max']))), arg0, arg1)
+    num_ops = program.num_operations()
+    convert_to_shortcut(program, num_ops - 1)
+    profile = ExitProfile(num_ops)
+    for op in data.draw(strategies.lists(strategies.integers(0, num_ops - 1))):
+        profile.record(op)
+    newprogram = schedule_tape(program, profile, RenderContext())
+    assert newprogram.num_operations() == num_ops
+    x = data.draw(regular_floats)
+    y = data.draw(regular_floats)
+    try:
+        res = DirectFrame(program).run_floats(x, y, 0.0)
+    except ValueError:
+        return
+    try:
+        res2 = DirectFrame(newprogram).run_floats(x, y, 0.0)
+    except ValueError:
+        # the ops that raise can move before an early return
+        return
+    if not math.isnan(res) and not math.isnan(res2):
+        assert (res > 0.0) == (res2 > 0.0)
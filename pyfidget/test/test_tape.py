@@ -0,0 +1,111 @@
+import struct
+
+import pytest
+
+from pyfidget.operations import OPS
+from pyfidget.parse import parse
+from pyfidget.optimize import optimize, convert_to_shortcut
+from pyfidget.vm import DirectFrame, CompactProgramBuilder, render_image_octree_optimize
+from pyfidget.tape import program_to_tape, program_from_tape, write_tape, map_tape, \
+        load_program, MappedProgramBuilder, tape_sections, main
+
+def load(filename):
+    with open(filename) as f:
+        return parse(f.read())
+
+def test_roundtrip():
+    program = load("tanglecube.vm")
+    data = program_to_tape(program)
+    assert len(data) == tape_sections(program.num_operations(), 2)[3]
+    assert program_from_tape(data).pretty_format() == program.pretty_format()
+
+def test_roundtrip_flags():
+    program = parse("""
+a var-x
+b var-y
+c const 2.5
+d min a b
+out min d c
+""")
+    convert_to_shortcut(program, 4)
+    assert program_from_tape(program_to_tape(program)).pretty_format() == program.pretty_format()
+
+def test_truncated():
+    data = program_to_tape(load("quarter.vm"))
+    with pytest.raises(ValueError):
+        program_from_tape(data[:-1])
+    with pytest.raises(ValueError):
+        program_from_tape("abc")
+
+def corrupt_tapes():
+    # the ops of quarter.vm are var-y, var-x, max, square, square, add,
+    # const, sub, max
+    program = load("quarter.vm")
+    data = program_to_tape(program)
+    _, arguments_offset, funcs_offset, _ = tape_sections(program.num_operations(), 1)
+    def patch(offset, value):
+        return data[:offset] + value + data[offset + len(value):]
+    return [
+        # an opcode that doesn't exist
+        patch(funcs_offset + 3, "\x3f"),
+        # the second argument of the add is the add itself
+        patch(arguments_offset + 8 * 5 + 4, struct.pack("<i", 5)),
+        # a negative argument of the first square
+        patch(arguments_offset + 8 * 3, struct.pack("<i", -1)),
+        # the const refers to a missing constant
+        patch(arguments_offset + 8 * 6, struct.pack("<i", 1)),
+        # var-y with an argument
+        patch(arguments_offset, struct.pack("<i", 1)),
+        # the add is a fused op, those are only made by the leaf renderer
+        patch(funcs_offset + 5, OPS.hypot2),
+    ]
+
+def test_corrupt():
+    for data in corrupt_tapes():
+        with pytest.raises(ValueError):
+            program_from_tape(data)
+
+def test_map_corrupt(tmpdir):
+    filename = str(tmpdir.join("corrupt.tape"))
+    for data in corrupt_tapes():
+        with open(filename, "wb") as f:
+            f.write(data)
+        with pytest.raises(ValueError):
+            map_tape(filename)
+
+def test_map_tape(tmpdir):
+    program = load("tanglecube.vm")
+    filename = str(tmpdir.join("tanglecube.tape"))
+    write_tape(program, filename)
+    mapped = map_tape(filename)
+    assert isinstance(mapped, MappedProgramBuilder)
+    assert mapped.pretty_format() == program.pretty_format()
+    for x, y in [(0.1, 0.2), (-1.5, 0.7), (1.1, -0.9)]:
+        assert DirectFrame(mapped).run_floats(x, y, 0.0) == DirectFrame(program).run_floats(x, y, 0.0)
+    newprogram, minimum, maximum = optimize(mapped, -1.5, 1.5, -1.5, 1.5, 0.0, 0.0)
+    assert isinstance(newprogram, CompactProgramBuilder)
+    with pytest.raises(TypeError):
+        mapped.add_op(program.get_func(0))
+    with pytest.raises(TypeError):
+        mapped.set_func(0, program.get_func(1))
+    assert render_image_octree_optimize(mapped, 128, 128, -1.5, 1.5, -1.5, 1.5) == \
+            render_image_octree_optimize(program, 128, 128, -1.5, 1.5, -1.5, 1.5)
+
+def test_load_program_and_converter(tmpdir):
+    filename = str(tmpdir.join("quarter.tape"))
+    assert main(["tape", "quarter.vm", filename]) == 0
+    expected = load("quarter.vm").pretty_format()
+    assert load_program(filename).pretty_format() == expected
+    assert load_program("quarter.vm").pretty_format() == expected
+
+def test_load_program_stdin(tmpdir, monkeypatch):
+    import sys
+    expected = load("quarter.vm").pretty_format()
+    with open("quarter.vm") as f:
+        monkeypatch.setattr(sys, "stdin", f)
+        assert load_program("-").pretty_format() == expected
+    filename = str(tmpdir.join("quarter.tape"))
+    write_tape(load("quarter.vm"), filename)
+    with open(filename, "rb") as f:
+        monkeypatch.setattr(sys, "stdin", f)
+        assert load_program("-").pretty_format() == expected
@@ -0,0 +1,84 @@
+from __future__ import division, print_function
+import pytest
+
+from pyfidget.context import RenderContext, Stats
+from pyfidget.optimize import optimize
+from pyfidget.parse import parse
+from pyfidget.tapecache import TapeCache, program_hash, programs_equal
+from pyfidget.vm import ProgramBuilder, render_image_octree_optimize
+
+def load(filename):
+    with open(filename) as f:
+        return parse(f.read())
+
+def make_program(context, const):
+    program = ProgramBuilder.new(context)
+    x = program.add_op('\x00')
+    c = program.add_const(const)
+    program.add_op('\x0a', x, c)
+    return program
+
+def test_programs_equal():
+    context = RenderContext()
+    a = make_program(context, 1.0)
+    b = make_program(context, 1.0)
+    assert a is not b
+    assert programs_equal(a, b)
+    assert program_hash(a) == program_hash(b)
+    assert not programs_equal(a, make_program(context, 2.0))
+    assert not programs_equal(make_program(context, 0.0), make_program(context, -0.0))
+    assert programs_equal(make_program(context, float('nan')), make_program(context, float('nan')))
+
+def test_share_and_evict():
+    context = RenderContext()
+    stats = Stats()
+    cache = TapeCache(2)
+    a = cache.share(make_program(context, 1.0), stats)
+    b = make_program(context, 1.0)
+    assert cache.share(b, stats) is a
+    # b went back to the freelist
+    assert context.unused_program is b
+    assert (stats.tape_cache_hits, stats.tape_cache_misses) == (1, 1)
+    c = cache.share(make_program(context, 2.0), stats)
+    # a is used by two users and the cache
+    assert a.shared == 2
+    a.delete()
+    a.delete()
+    assert a.shared == 0
+    # a is the least recently used, adding a third program evicts and frees it
+    d = cache.share(make_program(context, 3.0), stats)
+    assert cache.size == 2
+    assert context.unused_program is a
+    cache.share(make_program(context, 1.0), stats)
+    assert stats.tape_cache_misses == 4
+    cache.clear()
+    assert cache.size == 0 and cache.first is None and cache.last is None
+    # c and d are still used
+    assert c.shared == 0 and d.shared == 0
+
+def test_render_with_tape_cache():
+    program = load("tanglecube.vm")
+    expected = render_image_octree_optimize(program, 256, 256, -3.0, 3.0, -3.0, 3.0)
+    context = RenderContext()
+    context.tape_cache = TapeCache()
+    assert render_image_octree_optimize(program, 256, 256, -3.0, 3.0, -3.0, 3.0, context=context) == expected
+    assert context.stats.tape_cache_hits > 0
+    # a second render finds everything in the cache
+    misses = context.stats.tape_cache_misses
+    assert render_image_octree_optimize(program, 256, 256, -3.0, 3.0, -3.0, 3.0, context=context) == expected
+    assert context.stats.tape_cache_misses == misses
+
+def test_render_bfs_with_tape_cache():
+    pytest.importorskip("numpy")
+    from pyfidget.batch import render_image_octree_optimize_bfs
+    program = load("tanglecube.vm")
+    expected = render_image_octree_optimize(program, 256, 256, -3.0, 3.0, -3.0, 3.0)
+    context = RenderContext()
+    context.tape_cache = cache = TapeCache()
+    assert render_image_octree_optimize_bfs(program, 256, 256, -3.0, 3.0, -3.0, 3.0, context=context) == expected
+    assert context.stats.tape_cache_hits > 0
+    # only the references of the cache are left
+    entry = cache.first
+    while entry is not None:
+        assert entry.program.shared == 0
+        entry = entry.next
@@ -1,8 +1,10 @@
 from __future__ import division, print_function
+import pytest
 from pyfidget.vm import render_image_naive, flat_list_to_ppm, render_image_naive_fragment, \
         render_image_octree, flat_list_to_ppm_binary, DirectFrame, IntervalFrame, \
-        render_image_octree_optimize
+        render_image_octree_optimize, LaneFrame, LANES, render_image_lanes_fragment
 from pyfidget.parse import parse
+from pyfidget.optimize import convert_to_shortcut
 
 def quarter_frame(cls=DirectFrame):
     with open("quarter.vm") as f:
@@ -236,3 +238,228 @@ def test_render_octree_optimize():
     data1 = render_image_octree(frame, 1024, 1024, -1., 1., -1., 1.)
     data2 = render_image_octree_optimize(frame.program, 1024, 1024, -1., 1., -1., 1.)
     assert data1 == data2
+
+def test_lanes():
+    frame = quarter_frame()
+    lane_frame = LaneFrame(frame.program)
+    xs = [-1.0 + 0.3 * i for i in range(LANES)]
+    results = [0.0] * LANES
+    lane_frame.run_lanes(xs, 0.2, 0.0, results)
+    for i in range(LANES):
+        assert results[i] == frame.run_floats(xs[i], 0.2, 0.0)
+
+def test_lanes_return_early_only_if_all_lanes_agree():
+    program = parse("""
+a var-x
+b var-y
+out min a b
+""")
+    convert_to_shortcut(program, 2)
+    frame = LaneFrame(program)
+    results = [0.0] * LANES
+    xs = [-1.0] * LANES
+    frame.run_lanes(xs, 5.0, 0.0, results)
+    assert results == [-1.0] * LANES
+    xs[3] = 2.0
+    frame.run_lanes(xs, 5.0, 0.0, results)
+    assert results[3] == 2.0
+    assert results[4] == -1.0
+
+def test_render_lanes_fragment():
+    for filename in ["quarter.vm", "tanglecube.vm"]:
+        with open(filename) as f:
+            program = parse(f.read())
+        for startx, stopx, starty, stopy in [(0, 20, 0, 20), (2, 5, 2, 18), (3, 20, 1, 2)]:
+            result1 = ['\x00'] * 400
+            render_image_naive_fragment(DirectFrame(program), 20, 20, -2.0, 2.0, -2.0, 2.0, result1, startx, stopx, starty, stopy)
+            result2 = ['\x00'] * 400
+            render_image_lanes_fragment(LaneFrame(program), 20, 20, -2.0, 2.0, -2.0, 2.0, result2, startx, stopx, starty, stopy)
+            assert result1 == result2
+
+def test_separable_ops():
+    from pyfidget.vm import compute_axes, SeparableOps, AXIS_X, AXIS_Y, AXIS_Z
+    program = parse("""
+x var-x
+y var-y
+z var-z
+one const 1.0
+x2 square x
+y2 square y
+y3 add y2 one
+z1 mul z one
+xy add x2 y3
+out add xy z1
+""")
+    assert compute_axes(program) == [AXIS_X, AXIS_Y, AXIS_Z, 0, AXIS_X, AXIS_Y, AXIS_Y,
+                                     AXIS_Z, AXIS_X | AXIS_Y, AXIS_X | AXIS_Y | AXIS_Z]
+    separable = SeparableOps(program)
+    assert separable.tile_ops == [2, 3, 7]
+    assert separable.column_ops == [0, 4]
+    assert separable.row_ops == [1, 5, 6]
+    assert separable.pixel_ops == [8, 9]
+    assert separable.num_hoisted() == 8
+    # x y z one x2 y2 y3 z1 xy out
+    assert separable.slots == [8, 3, 0, 1, 9, 4, 5, 2, 7, 6]
+    assert separable.column_base == 8
+    assert separable.num_slots == 10
+
+def test_separable_slots_shared():
+    with open("tanglecube.vm") as f:
+        program = parse(f.read())
+    separable = program.get_separable()
+    assert separable.num_slots - separable.column_base == len(separable.column_ops)
+    # the pixel ops of tanglecube are a long sum, most of them share slots
+    assert separable.num_slots < program.num_operations()
+    frame = LaneFrame(program)
+    result = ['\x00'] * 400
+    render_image_lanes_fragment(frame, 20, 20, -2.0, 2.0, -2.0, 2.0, result, 0, 20, 0, 20)
+    assert len(frame.values) == separable.num_slots * LANES
+
+def test_naive_fragment_keeps_column_values():
+    with open("tanglecube.vm") as f:
+        program = parse(f.read())
+    separable = program.get_separable()
+    frame = DirectFrame(program)
+    result = ['\x00'] * 400
+    render_image_naive_fragment(frame, 20, 20, -2.0, 2.0, -2.0, 2.0, result, 0, 20, 0, 20)
+    # the column ops ran once per column, the pixels read their values in
+    # place
+    assert len(frame.floatvalues) == separable.num_slots + len(separable.column_ops) * 19
+    assert result == render_image_naive(DirectFrame(program), 20, 20, -2.0, 2.0, -2.0, 2.0)
+
+def test_compute_chains():
+    from pyfidget.vm import compute_chains
+    program = parse("""
+x var-x
+y var-y
+z var-z
+a min x y
+b min a z
+c min b x
+d max c y
+e max d z
+f max y z
+g add e f
+h max g f
+""")
+    assert compute_chains(program) == [-1, -1, -1, 5, -1, -1, 7, -1, -1, -1, -1]
+    assert program.get_chains() is program.get_chains()
+
+def test_separable_fragments_match_run_floats():
+    from pyfidget.optimize import optimize
+    with open("tanglecube.vm") as f:
+        tanglecube = parse(f.read())
+    with open("quarter.vm") as f:
+        quarter = parse(f.read())
+    # a specialized program has return flags
+    specialized, _, _ = optimize(quarter, -1.0, 0.0, -1.0, 1.0, 0.0, 0.0)
+    only_y = parse("""
+y var-y
+out square y
+""")
+    for program in [tanglecube, quarter, specialized, only_y]:
+        expected = ['\x00'] * 400
+        frame = DirectFrame(program)
+        for row_index in range(1, 19):
+            y = -2.0 + 4.0 * row_index / 19
+            for column_index in range(2, 13):
+                x = -2.0 + 4.0 / 19 * column_index
+                expected[row_index * 20 + column_index] = chr(frame.run_floats(x, y, 0.0) <= 0.0)
+        result1 = ['\x00'] * 400
+        render_image_naive_fragment(DirectFrame(program), 20, 20, -2.0, 2.0, -2.0, 2.0, result1, 2, 13, 1, 19)
+        assert result1 == expected
+        result2 = ['\x00'] * 400
+        render_image_lanes_fragment(LaneFrame(program), 20, 20, -2.0, 2.0, -2.0, 2.0, result2, 2, 13, 1, 19)
+        assert result2 == expected
+
+def test_render_octree_optimize_lanes(monkeypatch):
+    from pyfidget import batch
+    monkeypatch.setattr(batch, "numpy", None)
+    frame = quarter_frame(IntervalFrame)
+    data1 = render_image_octree(frame, 256, 256, -1., 1., -1., 1.)
+    data2 = render_image_octree_optimize(frame.program, 256, 256, -1., 1., -1., 1.)
+    assert data1 == data2
+
+def test_split_tile():
+    from pyfidget.vm import split_tile
+    from pyfidget.context import RenderContext
+    context = RenderContext()
+    assert split_tile(0, 10, 0, 20, context) == [(0, 5, 0, 10), (0, 5, 10, 20), (5, 10, 0, 10), (5, 10, 10, 20)]
+    context.kd_split = True
+    assert split_tile(0, 10, 0, 20, context) == [(0, 10, 0, 10), (0, 10, 10, 20)]
+    assert split_tile(0, 30, 4, 16, context) == [(0, 15, 4, 16), (15, 30, 4, 16)]
+    assert split_tile(0, 12, 0, 10, context) == [(0, 6, 0, 5), (0, 6, 5, 10), (6, 12, 0, 5), (6, 12, 5, 10)]
+    # a row of pixels can still be split
+    assert split_tile(0, 3, 0, 1, context) == [(0, 1, 0, 1), (1, 3, 0, 1)]
+
+def test_kd_split_leaves_are_near_square():
+    from pyfidget.vm import split_tile, render_directly, LIMIT
+    from pyfidget.context import RenderContext
+    program = quarter_frame().program
+    context = RenderContext()
+    context.kd_split = True
+    leaves = []
+    def walk(tile):
+        if render_directly(program, tile[0], tile[1], tile[2], tile[3], context):
+            leaves.append(tile)
+            return
+        for child in split_tile(tile[0], tile[1], tile[2], tile[3], context):
+            walk(child)
+    for tile in split_tile(0, 1920, 0, 1080, context):
+        walk(tile)
+    assert sum([(stopx - startx) * (stopy - starty) for startx, stopx, starty, stopy in leaves]) == 1920 * 1080
+    for startx, stopx, starty, stopy in leaves:
+        width = stopx - startx
+        height = stopy - starty
+        assert width <= LIMIT and height <= LIMIT
+        assert width < 2 * height + 2 and height < 2 * width + 2
+
+@pytest.mark.parametrize("size", [(240, 135), (64, 300), (256, 256)])
+def test_render_kd_split(size):
+    from pyfidget.context import RenderContext
+    width, height = size
+    program = quarter_frame().program
+    expected = render_image_octree_optimize(program, width, height, -1., 1., -1., 1.)
+    context = RenderContext()
+    context.kd_split = True
+    assert render_image_octree_optimize(program, width, height, -1., 1., -1., 1., context=context) == expected
+
+def test_render_octree_optimize_threads():
+    import threading
+    from pyfidget.context import RenderContext
+    frame = quarter_frame(IntervalFrame)
+    expected = render_image_octree(frame, 256, 256, -1., 1., -1., 1.)
+    contexts = [RenderContext() for i in range(4)]
+    results = [None] * len(contexts)
+    def render(i):
+        for j in range(3):
+            results[i] = render_image_octree_optimize(frame.program, 256, 256, -1., 1., -1., 1., context=contexts[i])
+    threads = [threading.Thread(target=render, args=(i, )) for i in range(len(contexts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i, context in enumerate(contexts):
+        assert results[i] == expected
+        # every context has its own counters and freelists
+        assert context.stats.ops_optimized == contexts[0].stats.ops_optimized > 0
+        assert context.unused_optimizer is not None
+
+def test_compact_program_builder():
+    from pyfidget.vm import CompactProgramBuilder
+    from pyfidget.context import RenderContext
+    program = quarter_frame().program
+    compact = CompactProgramBuilder.from_program(program)
+    assert compact.pretty_format() == program.pretty_format()
+    for x, y in [(0.1, 0.2), (-0.5, 0.7), (0.9, -0.9)]:
+        assert DirectFrame(compact).run_floats(x, y, 0.0) == DirectFrame(program).run_floats(x, y, 0.0)
+    # storage grows on demand and the builder is reused from its context
+    context = RenderContext()
+    ops = CompactProgramBuilder.new(context, 1, 1)
+    for i in range(20):
+        ops.add_const(float(i))
+    assert ops.num_operations() == 20
+    assert ops.get_const(19) == 19.0
+    ops.delete()
+    assert CompactProgramBuilder.new(context) is ops
+    assert ops.num_operations() == 0
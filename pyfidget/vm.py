@@ -1,39 +1,84 @@
 from __future__ import division, print_function
 import time
 import math
+import array
 from rpython.rlib import jit, objectmodel
 from pyfidget.operations import OPS
+from pyfidget.context import RenderContext
 
 def should_unroll_one_iteration(program):
     return True
 
 
 class ProgramBuilder(object):
-    def __init__(self, sizehint=10, const_sizehint=5):
+    # the axes of every op, see get_axes, the split of the ops for the leaf
+    # renderers, see get_separable, the chains of min and max ops, see
+    # get_chains, and the intervals of the ops that the optimizer shares
+    # between the siblings of a tile, see optimize.AxisIntervals. all of them
+    # are thrown away when the program is reset
+    axes = None
+    separable = None
+    chains = None
+    # the storage slot of every op, see get_slots
+    slots = None
+    num_slots = 0
+    axis_intervals = None
+    # the program that schedule.schedule_leaf reordered this one into, or the
+    # program itself if nothing moved. deleted together with the program
+    scheduled = None
+    # the number of users of the program apart from the first one, if it is
+    # in a tapecache.TapeCache or the scheduled program of another one.
+    # delete() only frees it when it is 0
+    shared = 0
+
+    def __init__(self, sizehint=10, const_sizehint=5, context=None):
         self.funcs = ['\xff'] * sizehint
         self.arguments = [0] * (sizehint * 2)
         self.index = 0
         self.consts = [0.0] * const_sizehint
         self.const_index = 0
+        # the context whose freelist the program goes back to in delete().
+        # programs that were not allocated with new() are never reused
+        self.context = context
         self.next = None
 
     def reset(self):
         self.index = self.const_index = 0
+        self.axes = None
+        self.separable = None
+        self.chains = None
+        self.slots = None
+        self.num_slots = 0
+        self.axis_intervals = None
+        self.scheduled = None
+        self.shared = 0
 
     @staticmethod
-    def new(sizehint=10, const_sizehint=5):
-        if mem_manager.unused_program is not None:
-            res = mem_manager.unused_program
-            mem_manager.unused_program = res.next
+    def new(context, sizehint=10, const_sizehint=5):
+        if context.unused_program is not None:
+            res = context.unused_program
+            context.unused_program = res.next
             res.next = None
             res.reset()
             return res
-        return ProgramBuilder(sizehint, const_sizehint)
+        return ProgramBuilder(sizehint, const_sizehint, context)
 
     def delete(self):
-        self.program = None
-        self.next = mem_manager.unused_program
-        mem_manager.unused_program = self
+        if self.shared:
+            self.shared -= 1
+            return
+        self._delete_scheduled()
+        context = self.context
+        if context is None:
+            return
+        self.next = context.unused_program
+        context.unused_program = self
+
+    def _delete_scheduled(self):
+        scheduled = self.scheduled
+        self.scheduled = None
+        if scheduled is not None and scheduled is not self:
+            scheduled.delete()
 
     def add_const(self, const, name=None):
         arg = self.const_index
@@ -74,11 +119,76 @@ class ProgramBuilder(object):
     def get_args(self, index):
         return self.arguments[index*2], self.arguments[index*2 + 1]
 
+    def get_stale_func_and_args(self, index):
+        # like get_func_and_args, but also works for ops that are behind
+        # self.index after a reset. dce uses that to move ops in place
+        return self.funcs[index], self.arguments[index*2], self.arguments[index*2 + 1]
+
+    @objectmodel.always_inline
+    def get_const(self, arg):
+        return self.consts[arg]
+
+    def set_func(self, index, func):
+        assert index < self.index
+        self.funcs[index] = func
+
+    def set_arg0(self, index, arg0):
+        assert index < self.index
+        self.arguments[index*2] = arg0
+
+    def set_arg1(self, index, arg1):
+        assert index < self.index
+        self.arguments[index*2 + 1] = arg1
+
+    def new_builder(self, context, sizehint=10, const_sizehint=5):
+        """ Return an empty program from context with the same kind of
+        storage as self. """
+        return ProgramBuilder.new(context, sizehint, const_sizehint)
+
     def num_operations(self):
         return self.index
 
+    def get_axes(self):
+        """ The axes that every op depends on, see compute_axes. Computed
+        once per program. """
+        axes = self.axes
+        if axes is None or len(axes) != self.index:
+            axes = self.axes = compute_axes(self)
+        return axes
+
+    def get_chains(self):
+        """ The chains of min and max ops, see compute_chains. Computed once
+        per program. """
+        chains = self.chains
+        if chains is None or len(chains) != self.index:
+            chains = self.chains = compute_chains(self)
+        return chains
+
+    def get_separable(self):
+        """ The SeparableOps of the program. Computed once per program. """
+        separable = self.separable
+        if separable is None or separable.num_ops != self.index:
+            separable = self.separable = SeparableOps(self)
+        return separable
+
+    def set_slots(self, slots, num_slots):
+        self.slots = slots
+        self.num_slots = num_slots
+
+    def get_slots(self):
+        """ The slot of every op in the storage of the frames that run the
+        whole program. Optimizer.dce and optimize.allocate_slots let ops whose
+        values are no longer needed share slots, otherwise every op has its
+        own. """
+        slots = self.slots
+        if slots is None or len(slots) != self.index:
+            slots = self.slots = range(self.index)
+            self.num_slots = self.index
+        return slots
+
     def size_storage(self):
-        return self.num_operations() # for now
+        self.get_slots()
+        return self.num_slots
 
 
     def op_to_str(self, i):
@@ -90,7 +200,7 @@ class ProgramBuilder(object):
         funcchar, arg0, arg1 = self.get_func_and_args(i)
         func = OPS.char_to_name(funcchar)
         if func.startswith("const"):
-            result.append("_%x %s %f" % (i, func, self.consts[arg0]))
+            result.append("_%x %s %f" % (i, func, self.get_const(arg0)))
         else:
             if OPS.num_args(funcchar) == 0:
                 result.append("_%x %s" % (i, func))
@@ -118,17 +228,107 @@ class ProgramBuilder(object):
         graph(self)
 
 
+class CompactProgramBuilder(ProgramBuilder):
+    """ A ProgramBuilder that keeps its ops in unboxed arrays: a bytearray of
+    opcodes (including the flags), an array of C ints for the arguments and
+    an array of C doubles for the constants. Needs a lot less memory per op
+    than the lists of ProgramBuilder. Only usable untranslated. """
+
+    def __init__(self, sizehint=10, const_sizehint=5, context=None):
+        # the arrays grow by doubling, so they must never be empty
+        if sizehint < 1:
+            sizehint = 1
+        if const_sizehint < 1:
+            const_sizehint = 1
+        self.funcs = bytearray('\xff' * sizehint)
+        self.arguments = array.array('i', [0]) * (sizehint * 2)
+        self.index = 0
+        self.consts = array.array('d', [0.0]) * const_sizehint
+        self.const_index = 0
+        self.context = context
+        self.next = None
 
-class MemManager(object):
-    unused_frame = None
-    unused_program = None
+    @staticmethod
+    def new(context, sizehint=10, const_sizehint=5):
+        if context.unused_compact_program is not None:
+            res = context.unused_compact_program
+            context.unused_compact_program = res.next
+            res.next = None
+            res.reset()
+            return res
+        return CompactProgramBuilder(sizehint, const_sizehint, context)
+
+    @staticmethod
+    def from_program(program, context=None):
+        """ Copy program into a new CompactProgramBuilder. """
+        num_ops = program.num_operations()
+        res = CompactProgramBuilder(num_ops, context=context)
+        for op in range(num_ops):
+            func, arg0, arg1 = program.get_func_and_args(op)
+            if func == OPS.const:
+                res.add_const(program.get_const(arg0))
+            else:
+                res.add_op(func, arg0, arg1)
+        return res
+
+    def delete(self):
+        if self.shared:
+            self.shared -= 1
+            return
+        self._delete_scheduled()
+        context = self.context
+        if context is None:
+            return
+        self.next = context.unused_compact_program
+        context.unused_compact_program = self
+
+    def new_builder(self, context, sizehint=10, const_sizehint=5):
+        return CompactProgramBuilder.new(context, sizehint, const_sizehint)
+
+    def add_const(self, const, name=None):
+        arg = self.const_index
+        if arg == len(self.consts):
+            self.consts.extend(self.consts)
+        self.consts[arg] = const
+        self.const_index = arg + 1
+        return self.add_op(OPS.const, arg, name=name)
+
+    def add_op(self, func, arg0=0, arg1=0, name=None):
+        res = self.index
+        self.index = res + 1
+        if res == len(self.funcs):
+            self.funcs.extend(self.funcs)
+            self.arguments.extend(self.arguments)
+        self.funcs[res] = func
+        self.arguments[2 * res + 0] = arg0
+        self.arguments[2 * res + 1] = arg1
+        return res
+
+    def get_func(self, index):
+        assert index < self.index
+        return chr(self.funcs[index])
+
+    def get_func_and_args(self, index):
+        assert index < self.index
+        return chr(self.funcs[index]), self.arguments[index*2], self.arguments[index*2 + 1]
+
+    def get_stale_func_and_args(self, index):
+        return chr(self.funcs[index]), self.arguments[index*2], self.arguments[index*2 + 1]
+
+    def set_func(self, index, func):
+        assert index < self.index
+        self.funcs[index] = func
 
-mem_manager = MemManager()
 
 
 class DirectFrame(object):
+    # a schedule.ExitProfile that run records its early returns in, or None
+    profile = None
 
-    def __init__(self, program):
+    def __init__(self, program, context=None):
+        if context is None:
+            context = RenderContext()
+        self.context = context
         self.program = program
         self.floatvalues = None
         self.next = None
@@ -137,19 +337,19 @@ class DirectFrame(object):
         self.program = program
 
     @staticmethod
-    def new(program):
-        if mem_manager.unused_frame is not None:
-            res = mem_manager.unused_frame
-            mem_manager.unused_frame = res.next
+    def new(context, program):
+        if context.unused_frame is not None:
+            res = context.unused_frame
+            context.unused_frame = res.next
             res.next = None
             res._reset(program)
             return res
-        return DirectFrame(program)
+        return DirectFrame(program, context)
 
     def delete(self):
         self.program = None
-        self.next = mem_manager.unused_frame
-        mem_manager.unused_frame = self
+        self.next = self.context.unused_frame
+        self.context.unused_frame = self
 
     def run_floats(self, x, y, z):
         self.setxyz(x, y, z)
@@ -166,63 +366,127 @@ class DirectFrame(object):
         self.z = z
 
     def run(self):
-        from pyfidget.optimize import stats
+        stats = self.context.stats
         program = self.program
         num_ops = program.num_operations()
+        slots = program.get_slots()
+        size = program.size_storage()
         floatvalues = self.floatvalues
-        if floatvalues and len(floatvalues) >= num_ops:
+        if floatvalues and len(floatvalues) >= size:
             pass
         else:
-            floatvalues = self.floatvalues = [0.0] * num_ops
+            floatvalues = self.floatvalues = [0.0] * size
         stats.ops_executed += num_ops
         for op in range(num_ops):
             func, arg0, arg1 = program.get_func_and_args(op)
             if func == OPS.const:
-                floatvalues[op] = program.consts[arg0]
+                floatvalues[slots[op]] = program.get_const(arg0)
                 continue
-            farg0 = floatvalues[arg0]
-            farg1 = floatvalues[arg1]
-            bare_func = OPS.mask(func)
-            if bare_func == OPS.const:
-                res = program.consts[arg0]
-            elif bare_func == OPS.var_x:
-                res = self.x
-            elif bare_func == OPS.var_y:
-                res = self.y
-            elif bare_func == OPS.var_z:
-                res = self.z
-            elif bare_func == OPS.add:
-                res = self.add(farg0, farg1)
-            elif bare_func == OPS.sub:
-                res = self.sub(farg0, farg1)
-            elif bare_func == OPS.mul:
-                res = self.mul(farg0, farg1)
-            elif bare_func == OPS.max:
-                res = self.max(farg0, farg1)
-            elif bare_func == OPS.min:
-                res = self.min(farg0, farg1)
-            elif bare_func == OPS.square:
-                res = self.square(farg0)
-            elif bare_func == OPS.sqrt:
-                res = self.sqrt(farg0)
-            elif bare_func == OPS.exp:
-                res = self.exp(farg0)
-            elif bare_func == OPS.neg:
-                res = self.neg(farg0)
-            elif bare_func == OPS.abs:
-                res = self.abs(farg0)
-            else:
-                assert 0
+            if OPS.mask(func) != OPS.const:
+                arg0 = slots[arg0]
+                arg1 = slots[arg1]
+            res = self._compute(program, floatvalues, func, arg0, arg1)
             if OPS.should_return_if_neg(func):
                 if res <= 0.0:
                     stats.ops_skipped += num_ops - op - 1
+                    if self.profile is not None:
+                        self.profile.record(op)
                     return res
             if OPS.should_return_if_pos(func):
                 if res > 0.0:
                     stats.ops_skipped += num_ops - op - 1
+                    if self.profile is not None:
+                        self.profile.record(op)
                     return res
-            floatvalues[op] = res
-        return self.floatvalues[self.program.size_storage() - 1]
+            floatvalues[slots[op]] = res
+        return floatvalues[slots[num_ops - 1]]
+
+    def run_ops(self, ops, check_flags, column_offset=0):
+        """ Evaluate only the ops in the list ops, in order, at the point
+        that setxyz set. Their arguments must have been computed before. If
+        check_flags is true, return early like run does and return the result
+        of the program, which must then be computed by ops. The values are
+        stored in the slots of the SeparableOps of the program, the ones of
+        the column ops column_offset slots further, so that the values of
+        several columns can be kept at once. """
+        stats = self.context.stats
+        program = self.program
+        num_ops = program.num_operations()
+        separable = program.get_separable()
+        slots = separable.slots
+        column_base = separable.column_base
+        self.setup(separable.num_slots + column_offset)
+        floatvalues = self.floatvalues
+        stats.ops_executed += len(ops)
+        for i in range(len(ops)):
+            op = ops[i]
+            func, arg0, arg1 = program.get_func_and_args(op)
+            if OPS.mask(func) != OPS.const:
+                arg0 = slots[arg0]
+                if arg0 >= column_base:
+                    arg0 += column_offset
+                arg1 = slots[arg1]
+                if arg1 >= column_base:
+                    arg1 += column_offset
+            res = self._compute(program, floatvalues, func, arg0, arg1)
+            if check_flags:
+                if OPS.should_return_if_neg(func):
+                    if res <= 0.0:
+                        stats.ops_skipped += len(ops) - i - 1
+                        return res
+                if OPS.should_return_if_pos(func):
+                    if res > 0.0:
+                        stats.ops_skipped += len(ops) - i - 1
+                        return res
+            slot = slots[op]
+            if slot >= column_base:
+                slot += column_offset
+            floatvalues[slot] = res
+        slot = slots[num_ops - 1]
+        if slot >= column_base:
+            slot += column_offset
+        return floatvalues[slot]
+
+    @objectmodel.always_inline
+    def _compute(self, program, floatvalues, func, arg0, arg1):
+        farg0 = floatvalues[arg0]
+        farg1 = floatvalues[arg1]
+        bare_func = OPS.mask(func)
+        if bare_func == OPS.const:
+            res = program.get_const(arg0)
+        elif bare_func == OPS.var_x:
+            res = self.x
+        elif bare_func == OPS.var_y:
+            res = self.y
+        elif bare_func == OPS.var_z:
+            res = self.z
+        elif bare_func == OPS.add:
+            res = self.add(farg0, farg1)
+        elif bare_func == OPS.sub:
+            res = self.sub(farg0, farg1)
+        elif bare_func == OPS.mul:
+            res = self.mul(farg0, farg1)
+        elif bare_func == OPS.max:
+            res = self.max(farg0, farg1)
+        elif bare_func == OPS.min:
+            res = self.min(farg0, farg1)
+        elif bare_func == OPS.square:
+            res = self.square(farg0)
+        elif bare_func == OPS.sqrt:
+            res = self.sqrt(farg0)
+        elif bare_func == OPS.exp:
+            res = self.exp(farg0)
+        elif bare_func == OPS.neg:
+            res = self.neg(farg0)
+        elif bare_func == OPS.abs:
+            res = self.abs(farg0)
+        elif bare_func == OPS.hypot2:
+            res = self.hypot2(farg0, farg1)
+        elif bare_func == OPS.sub_square:
+            res = self.sub_square(farg0, farg1)
+        else:
+            assert 0
+        return res
 
     def add(self, arg0, arg1):
         return arg0 + arg1
@@ -255,6 +519,370 @@ class DirectFrame(object):
     def abs(self, arg0):
         return abs(arg0)
 
+    def hypot2(self, arg0, arg1):
+        # not math.hypot, the result must be the same as the one of the ops
+        # that fuse_ops replaced
+        return math.sqrt(arg0 * arg0 + arg1 * arg1)
+
+    def sub_square(self, arg0, arg1):
+        val = arg0 - arg1
+        return val * val
+
+
+# number of points that a LaneFrame evaluates at once, like the float8 vectors
+# in experiments.c
+LANES = 8
+
+class LaneFrame(object):
+    """ Evaluates a program for LANES points at once. Every op is dispatched
+    once and then computed for all lanes in a loop of fixed length, which the
+    JIT unrolls. Like in experiments.c, x is different per lane, y and z are
+    the same for all lanes. """
+
+    # a schedule.ExitProfile that the run methods record their early returns
+    # in, or None
+    profile = None
+
+    def __init__(self, program, context=None):
+        if context is None:
+            context = RenderContext()
+        self.context = context
+        self.program = program
+        self.values = None
+        self.next = None
+
+    def _reset(self, program):
+        self.program = program
+
+    @staticmethod
+    def new(context, program):
+        if context.unused_lane_frame is not None:
+            res = context.unused_lane_frame
+            context.unused_lane_frame = res.next
+            res.next = None
+            res._reset(program)
+            return res
+        return LaneFrame(program, context)
+
+    def delete(self):
+        self.program = None
+        self.next = self.context.unused_lane_frame
+        self.context.unused_lane_frame = self
+
+    def setup(self, length):
+        if self.values and len(self.values) >= length * LANES:
+            return
+        self.values = [0.0] * (length * LANES)
+
+    def run_lanes(self, xs, y, z, results):
+        """ Evaluate the program at the points (xs[i], y, z) and write the
+        results into results[i]. Return early only if the flag of an op allows
+        it for all lanes. """
+        stats = self.context.stats
+        program = self.program
+        num_ops = program.num_operations()
+        slots = program.get_slots()
+        self.setup(program.size_storage())
+        stats.ops_executed += num_ops * LANES
+        for op in range(num_ops):
+            func, arg0, arg1 = program.get_func_and_args(op)
+            res = slots[op] * LANES
+            if OPS.mask(func) != OPS.const:
+                arg0 = slots[arg0]
+                arg1 = slots[arg1]
+            self._compute(program, func, arg0, arg1, res, xs, y, z)
+            if OPS.should_return_if_neg(func):
+                if self._all_lanes_neg(res):
+                    stats.ops_skipped += (num_ops - op - 1) * LANES
+                    self._copy_results(res, results)
+                    if self.profile is not None:
+                        self.profile.record(op)
+                    return
+            if OPS.should_return_if_pos(func):
+                if self._all_lanes_pos(res):
+                    stats.ops_skipped += (num_ops - op - 1) * LANES
+                    self._copy_results(res, results)
+                    if self.profile is not None:
+                        self.profile.record(op)
+                    return
+        self._copy_results(slots[num_ops - 1] * LANES, results)
+
+    def run_lanes_ops(self, ops, xs, y, z, results):
+        """ Like run_lanes, but evaluate only the ops in the list ops, whose
+        arguments must have been computed before. If results is None, the
+        flags are ignored and nothing is written to it. Like
+        DirectFrame.run_ops, the values are stored in the slots of the
+        SeparableOps of the program. """
+        stats = self.context.stats
+        program = self.program
+        num_ops = program.num_operations()
+        separable = program.get_separable()
+        slots = separable.slots
+        self.setup(separable.num_slots)
+        stats.ops_executed += len(ops) * LANES
+        for i in range(len(ops)):
+            op = ops[i]
+            func, arg0, arg1 = program.get_func_and_args(op)
+            res = slots[op] * LANES
+            if OPS.mask(func) != OPS.const:
+                arg0 = slots[arg0]
+                arg1 = slots[arg1]
+            self._compute(program, func, arg0, arg1, res, xs, y, z)
+            if results is None:
+                continue
+            if OPS.should_return_if_neg(func):
+                if self._all_lanes_neg(res):
+                    stats.ops_skipped += (len(ops) - i - 1) * LANES
+                    self._copy_results(res, results)
+                    if self.profile is not None:
+                        self.profile.record(op)
+                    return
+            if OPS.should_return_if_pos(func):
+                if self._all_lanes_pos(res):
+                    stats.ops_skipped += (len(ops) - i - 1) * LANES
+                    self._copy_results(res, results)
+                    if self.profile is not None:
+                        self.profile.record(op)
+                    return
+        if results is not None:
+            self._copy_results(slots[num_ops - 1] * LANES, results)
+
+    @objectmodel.always_inline
+    def _compute(self, program, func, arg0, arg1, res, xs, y, z):
+        values = self.values
+        if func == OPS.const:
+            const = program.get_const(arg0)
+            for i in range(LANES):
+                values[res + i] = const
+            return
+        arg0 *= LANES
+        arg1 *= LANES
+        bare_func = OPS.mask(func)
+        if bare_func == OPS.var_x:
+            for i in range(LANES):
+                values[res + i] = xs[i]
+        elif bare_func == OPS.var_y:
+            for i in range(LANES):
+                values[res + i] = y
+        elif bare_func == OPS.var_z:
+            for i in range(LANES):
+                values[res + i] = z
+        elif bare_func == OPS.add:
+            for i in range(LANES):
+                values[res + i] = values[arg0 + i] + values[arg1 + i]
+        elif bare_func == OPS.sub:
+            for i in range(LANES):
+                values[res + i] = values[arg0 + i] - values[arg1 + i]
+        elif bare_func == OPS.mul:
+            for i in range(LANES):
+                values[res + i] = values[arg0 + i] * values[arg1 + i]
+        elif bare_func == OPS.max:
+            for i in range(LANES):
+                values[res + i] = max(values[arg0 + i], values[arg1 + i])
+        elif bare_func == OPS.min:
+            for i in range(LANES):
+                values[res + i] = min(values[arg0 + i], values[arg1 + i])
+        elif bare_func == OPS.square:
+            for i in range(LANES):
+                val = values[arg0 + i]
+                values[res + i] = val * val
+        elif bare_func == OPS.sqrt:
+            for i in range(LANES):
+                values[res + i] = math.sqrt(values[arg0 + i])
+        elif bare_func == OPS.exp:
+            for i in range(LANES):
+                values[res + i] = math.exp(values[arg0 + i])
+        elif bare_func == OPS.neg:
+            for i in range(LANES):
+                values[res + i] = -values[arg0 + i]
+        elif bare_func == OPS.abs:
+            for i in range(LANES):
+                values[res + i] = abs(values[arg0 + i])
+        elif bare_func == OPS.hypot2:
+            for i in range(LANES):
+                val0 = values[arg0 + i]
+                val1 = values[arg1 + i]
+                values[res + i] = math.sqrt(val0 * val0 + val1 * val1)
+        elif bare_func == OPS.sub_square:
+            for i in range(LANES):
+                val = values[arg0 + i] - values[arg1 + i]
+                values[res + i] = val * val
+        else:
+            assert 0
+
+    def _all_lanes_neg(self, start):
+        for i in range(LANES):
+            if self.values[start + i] > 0.0:
+                return False
+        return True
+
+    def _all_lanes_pos(self, start):
+        for i in range(LANES):
+            if self.values[start + i] <= 0.0:
+                return False
+        return True
+
+    def _copy_results(self, start, results):
+        for i in range(LANES):
+            results[i] = self.values[start + i]
+
+# the axes that the value of an op can depend on, as a bitmask. constants
+# depend on none of them
+AXIS_X = 1
+AXIS_Y = 2
+AXIS_Z = 4
+AXIS_XY = AXIS_X | AXIS_Y
+
+def compute_axes(program):
+    """ Return a list with the axes that every op of program depends on. """
+    num_ops = program.num_operations()
+    axes = [0] * num_ops
+    for op in range(num_ops):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        func = OPS.mask(func)
+        if func == OPS.const:
+            continue
+        if func == OPS.var_x:
+            axes[op] = AXIS_X
+        elif func == OPS.var_y:
+            axes[op] = AXIS_Y
+        elif func == OPS.var_z:
+            axes[op] = AXIS_Z
+        elif OPS.num_args(func) == 1:
+            axes[op] = axes[arg0]
+        else:
+            axes[op] = axes[arg0] | axes[arg1]
+    return axes
+
+def compute_chains(program):
+    """ Return a list that maps the first op of every chain of program to
+    the last op of the chain, and all other ops to -1. A chain is a run of at
+    least two min ops (or max ops) where every op is the first argument of
+    the next one and not used anywhere else, so together they compute the
+    min (or max) of all their operands. optimize.flatten_min_max turns nested
+    min and max ops into chains. """
+    num_ops = program.num_operations()
+    uses = [0] * num_ops
+    for op in range(num_ops):
+        func, arg0, arg1 = program.get_func_and_args(op)
+        if OPS.mask(func) == OPS.const:
+            continue
+        numargs = OPS.num_args(func)
+        if numargs >= 1:
+            uses[arg0] += 1
+        if numargs == 2:
+            uses[arg1] += 1
+    chains = [-1] * num_ops
+    op = 0
+    while op < num_ops - 1:
+        func = OPS.mask(program.get_func(op))
+        if func == OPS.min or func == OPS.max:
+            end = op
+            while end + 1 < num_ops and uses[end] == 1:
+                nextfunc, nextarg0, _ = program.get_func_and_args(end + 1)
+                if OPS.mask(nextfunc) != func or nextarg0 != end:
+                    break
+                end += 1
+            if end > op:
+                chains[op] = end
+                op = end + 1
+                continue
+        op += 1
+    return chains
+
+class SlotAllocator(object):
+    """ Hands out the slots of the storage of the frames during a backwards
+    sweep over a program: a value takes a slot at its last use and gives it
+    back at the op that computes it, so that the ops before can reuse it. """
+
+    def __init__(self):
+        self.free = []
+        self.num_slots = 0
+
+    def reset(self):
+        del self.free[:]
+        self.num_slots = 0
+
+    def take(self):
+        if self.free:
+            return self.free.pop()
+        slot = self.num_slots
+        self.num_slots = slot + 1
+        return slot
+
+    def give_back(self, slot):
+        self.free.append(slot)
+
+
+class SeparableOps(object):
+    """ The ops of a program, split by how often they have to be computed
+    when a tile is rendered row by row with a fixed z: ops that don't depend
+    on x or y once per tile, ops that only depend on x once per column, ops
+    that only depend on y once per row and the rest once per pixel. Every
+    list keeps the order of the program, and the ops of a list only use the
+    ops of the same or earlier lists.
+
+    slots maps every op to its slot in the storage of the frames. The values
+    of the hoisted ops are needed for many pixels, so every one of them has a
+    slot of its own: first the tile ops, then the row ops, then the slots
+    that the pixel ops share, and the column ops last, from column_base on.
+    The value of a pixel op is only needed until its last use in the same
+    pixel. """
+
+    def __init__(self, program):
+        num_ops = self.num_ops = program.num_operations()
+        self.tile_ops = []
+        self.column_ops = []
+        self.row_ops = []
+        self.pixel_ops = []
+        axes = program.get_axes()
+        for op in range(num_ops):
+            op_axes = axes[op] & (AXIS_X | AXIS_Y)
+            if op_axes == 0:
+                self.tile_ops.append(op)
+            elif op_axes == AXIS_X:
+                self.column_ops.append(op)
+            elif op_axes == AXIS_Y:
+                self.row_ops.append(op)
+            else:
+                self.pixel_ops.append(op)
+        slots = self.slots = [-1] * num_ops
+        slot = 0
+        for op in self.tile_ops:
+            slots[op] = slot
+            slot += 1
+        for op in self.row_ops:
+            slots[op] = slot
+            slot += 1
+        pixel_base = slot
+        allocator = SlotAllocator()
+        pixel_ops = self.pixel_ops
+        for i in range(len(pixel_ops) - 1, -1, -1):
+            op = pixel_ops[i]
+            if slots[op] < 0:
+                # not used by a later pixel op
+                slots[op] = pixel_base + allocator.take()
+            func, arg0, arg1 = program.get_func_and_args(op)
+            if OPS.mask(func) != OPS.const:
+                # the column ops don't have their slots yet
+                numargs = OPS.num_args(func)
+                if numargs >= 1 and slots[arg0] < 0 and (axes[arg0] & AXIS_XY) == AXIS_XY:
+                    slots[arg0] = pixel_base + allocator.take()
+                if numargs == 2 and slots[arg1] < 0 and (axes[arg1] & AXIS_XY) == AXIS_XY:
+                    slots[arg1] = pixel_base + allocator.take()
+            allocator.give_back(slots[op] - pixel_base)
+        self.column_base = pixel_base + allocator.num_slots
+        slot = self.column_base
+        for op in self.column_ops:
+            slots[op] = slot
+            slot += 1
+        # the size of the storage of a frame for one column
+        self.num_slots = slot
+
+    def num_hoisted(self):
+        return len(self.tile_ops) + len(self.column_ops) + len(self.row_ops)
+
+
 def float_choose(cond, iftrue, iffalse):
     if not jit.we_are_jitted():
         if cond:
@@ -268,6 +896,18 @@ def min(a, b):
 def max(a, b):
     return float_choose(a <= b, b, a)
 
+INF = float('inf')
+NAN = float('nan')
+
+def exp_or_inf(x):
+    try:
+        return math.exp(x)
+    except OverflowError:
+        return INF
+
+def any_nan(a, b, c, d):
+    return math.isnan(a) or math.isnan(b) or math.isnan(c) or math.isnan(d)
+
 def min4(a, b, c, d):
     return min(min(a, b), min(c, d))
 
@@ -276,6 +916,10 @@ def max4(a, b, c, d):
 
 
 class IntervalFrame(object):
+    """ Interval arithmetic over the extended reals. The bounds can be
+    infinite; if a bound is nan, the value is unknown and can be nan. The
+    transfer functions return nan bounds as soon as an argument is unknown or
+    the op can produce nan (inf - inf, 0 * inf). """
 
     def __init__(self, program):
         self.program = program
@@ -287,7 +931,8 @@ class IntervalFrame(object):
     def run_intervals(self, minx, maxx, miny, maxy, minz, maxz):
         self.setxyz(minx, maxx, miny, maxy, minz, maxz)
         self.run()
-        index = self.program.size_storage() - 1
+        program = self.program
+        index = program.get_slots()[program.num_operations() - 1]
         return self.minvalues[index], self.maxvalues[index]
 
     def setup(self, length):
@@ -320,9 +965,19 @@ class IntervalFrame(object):
         self.minvalues[resindex] = const
         self.maxvalues[resindex] = const
 
+    def refine(self, func, arg0, arg1, minimum, maximum):
+        # hook for more precise domains: called by the optimizer with the
+        # interval of an op it is about to emit, can return a tighter one
+        return minimum, maximum
+
+    def commit(self, resindex):
+        # hook for more precise domains: the op that was passed to the last
+        # call of refine is stored at resindex
+        pass
+
     def _set(self, resindex, minvalue, maxvalue):
-        if math.isinf(minvalue) or math.isinf(maxvalue):
-            minvalue = maxvalue = float('nan')
+        if math.isnan(minvalue) or math.isnan(maxvalue):
+            minvalue = maxvalue = NAN
         self.minvalues[resindex] = minvalue
         self.maxvalues[resindex] = maxvalue
 
@@ -336,6 +991,12 @@ class IntervalFrame(object):
 
     @objectmodel.always_inline
     def _add(self, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+        if any_nan(arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+            return NAN, NAN
+        # -inf + inf
+        if ((arg0minimum == -INF and arg1maximum == INF) or
+                (arg0maximum == INF and arg1minimum == -INF)):
+            return NAN, NAN
         return arg0minimum + arg1minimum, arg0maximum + arg1maximum
 
     def sub(self, arg0index, arg1index, resindex):
@@ -348,6 +1009,12 @@ class IntervalFrame(object):
 
     @objectmodel.always_inline
     def _sub(self, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+        if any_nan(arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+            return NAN, NAN
+        # inf - inf
+        if ((arg0maximum == INF and arg1maximum == INF) or
+                (arg0minimum == -INF and arg1minimum == -INF)):
+            return NAN, NAN
         return arg0minimum - arg1maximum, arg0maximum - arg1minimum
 
     def mul(self, arg0index, arg1index, resindex):
@@ -360,6 +1027,12 @@ class IntervalFrame(object):
 
     @objectmodel.always_inline
     def _mul(self, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+        if any_nan(arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+            return NAN, NAN
+        # 0 * inf
+        if ((arg0minimum <= 0.0 <= arg0maximum and (math.isinf(arg1minimum) or math.isinf(arg1maximum))) or
+                (arg1minimum <= 0.0 <= arg1maximum and (math.isinf(arg0minimum) or math.isinf(arg0maximum)))):
+            return NAN, NAN
         return min4(arg0minimum * arg1minimum, arg0minimum * arg1maximum, arg0maximum * arg1minimum, arg0maximum * arg1maximum), \
                max4(arg0minimum * arg1minimum, arg0minimum * arg1maximum, arg0maximum * arg1minimum, arg0maximum * arg1maximum)
 
@@ -373,6 +1046,8 @@ class IntervalFrame(object):
 
     @objectmodel.always_inline
     def _max(self, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+        if any_nan(arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+            return NAN, NAN
         return max(arg0minimum, arg1minimum), max(arg0maximum, arg1maximum)
 
     def min(self, arg0index, arg1index, resindex):
@@ -385,6 +1060,8 @@ class IntervalFrame(object):
 
     @objectmodel.always_inline
     def _min(self, arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+        if any_nan(arg0minimum, arg0maximum, arg1minimum, arg1maximum):
+            return NAN, NAN
         return min(arg0minimum, arg1minimum), min(arg0maximum, arg1maximum)
 
     def square(self, arg0index, resindex):
@@ -406,8 +1083,10 @@ class IntervalFrame(object):
 
     @objectmodel.always_inline
     def _sqrt(self, min0, max0):
-        if max0 < 0:
-            return float('nan'), float('nan')
+        # sqrt is only defined for the non-negative part of the range, the
+        # vm raises for negative arguments
+        if not max0 >= 0:
+            return NAN, NAN
         return math.sqrt(max(0, min0)), math.sqrt(max0)
 
     def abs(self, arg0index, resindex):
@@ -436,22 +1115,31 @@ class IntervalFrame(object):
 
     @objectmodel.always_inline
     def _exp(self, min0, max0):
-        return math.exp(min0), math.exp(max0)
+        return exp_or_inf(min0), exp_or_inf(max0)
 
     # only used for tests
 
     def run(self):
         program = self.program
         num_ops = program.num_operations()
-        self.setup(num_ops)
+        slots = program.get_slots()
+        self.setup(program.size_storage())
         for op in range(num_ops):
-            self._run_op(op)
+            func, arg0, arg1 = program.get_func_and_args(op)
+            if OPS.mask(func) != OPS.const:
+                arg0 = slots[arg0]
+                arg1 = slots[arg1]
+            self._run_func(func, arg0, arg1, slots[op])
 
     def _run_op(self, op):
+        func, arg0, arg1 = self.program.get_func_and_args(op)
+        self._run_func(func, arg0, arg1, op)
+
+    def _run_func(self, func, arg0, arg1, op):
         program = self.program
-        func, arg0, arg1 = program.get_func_and_args(op)
+        func = OPS.mask(func)
         if func == OPS.const:
-            self.make_constant(program.consts[arg0], op)
+            self.make_constant(program.get_const(arg0), op)
         elif func == OPS.var_x:
             self.get_x(op)
         elif func == OPS.var_y:
@@ -512,18 +1200,98 @@ def render_image_naive(frame, width, height, minx, maxx, miny, maxy):
     return result
 
 def render_image_naive_fragment(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy):
-    num_pixels = width * height
+    # the ops that only depend on x are computed once per column, the ones
+    # that only depend on y once per row. only the remaining ops run for
+    # every pixel. the frame keeps the values of the column ops of all the
+    # columns, the ones of a column at column_index * num_column_ops slots
+    # after the slots of the SeparableOps
+    separable = frame.program.get_separable()
+    column_ops = separable.column_ops
+    num_column_ops = len(column_ops)
+    frame.setup(separable.num_slots + num_column_ops * (stopx - startx - 1))
     dx = (maxx - minx) / (width - 1)
+    frame.setxyz(minx, miny, 0.0)
+    frame.run_ops(separable.tile_ops, False)
+    x = minx + dx * startx
+    for column_index in range(stopx - startx):
+        frame.setxyz(x, miny, 0.0)
+        frame.run_ops(column_ops, False, column_index * num_column_ops)
+        x += dx
     for row_index in range(starty, stopy):
         y = miny + (maxy - miny) * row_index / (height - 1)
         x = minx + dx * startx
+        frame.setxyz(x, y, 0.0)
+        frame.run_ops(separable.row_ops, False)
         index = row_index * width + startx
-        for column_index in range(startx, stopx):
-            res = frame.run_floats(x, y, 0)
+        for column_index in range(stopx - startx):
+            frame.setxyz(x, y, 0.0)
+            res = frame.run_ops(separable.pixel_ops, True, column_index * num_column_ops)
             result[index] = chr(res <= 0.0)
             index += 1
             x += dx
 
+def render_image_lanes_fragment(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy):
+    # same pixels as render_image_naive_fragment, but the tile is fed to the
+    # LaneFrame in chunks of LANES columns. the lanes past the end of a row
+    # repeat the last pixel. the ops that only depend on x are computed once
+    # per chunk, the ones that only depend on y once per row of a chunk
+    separable = frame.program.get_separable()
+    dx = (maxx - minx) / (width - 1)
+    xs = [0.0] * LANES
+    results = [0.0] * LANES
+    frame.run_lanes_ops(separable.tile_ops, xs, miny, 0.0, None)
+    x = minx + dx * startx
+    column_index = startx
+    while column_index < stopx:
+        count = stopx - column_index
+        if count > LANES:
+            count = LANES
+        for i in range(LANES):
+            if i < count:
+                xs[i] = x
+                x += dx
+            else:
+                xs[i] = xs[count - 1]
+        frame.run_lanes_ops(separable.column_ops, xs, miny, 0.0, None)
+        for row_index in range(starty, stopy):
+            y = miny + (maxy - miny) * row_index / (height - 1)
+            frame.run_lanes_ops(separable.row_ops, xs, y, 0.0, None)
+            frame.run_lanes_ops(separable.pixel_ops, xs, y, 0.0, results)
+            index = row_index * width + column_index
+            for i in range(count):
+                result[index + i] = chr(results[i] <= 0.0)
+        column_index += count
+
+def numpy_leaves():
+    """ Whether render_image_leaf_fragment evaluates tiles with numpy. """
+    if objectmodel.we_are_translated():
+        return False
+    from pyfidget import batch
+    return batch.numpy is not None
+
+def render_image_leaf_fragment(program, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, context=None):
+    # evaluate a whole tile with numpy if we can, LANES pixels at a time
+    # otherwise
+    from pyfidget.optimize import fuse_ops
+    if context is None:
+        context = RenderContext()
+    # only the leaves are fused, the interval bounds of the fused ops are no
+    # better than the ones of their parts
+    fused = fuse_ops(program, context)
+    if not objectmodel.we_are_translated():
+        from pyfidget import batch
+        if numpy_leaves():
+            frame = batch.NumpyFrame(fused)
+            batch.render_image_numpy_fragment(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy)
+            if fused is not program:
+                fused.delete()
+            return
+    frame = LaneFrame.new(context, fused)
+    render_image_lanes_fragment(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy)
+    frame.delete()
+    if fused is not program:
+        fused.delete()
+
 def render_image_octree(frame, width, height, minx, maxx, miny, maxy):
     result = ['\x00'] * (width * height)
     render_image_octree_rec(frame, width, height, minx, maxx, miny, maxy, result, 0, width, 0, height)
@@ -531,6 +1299,42 @@ def render_image_octree(frame, width, height, minx, maxx, miny, maxy):
 
 LIMIT = 8
 
+def render_directly(program, startx, stopx, starty, stopy, context):
+    """ Whether a tile should be evaluated pixel by pixel instead of being
+    subdivided further. Decided by the cost model of the context if there is
+    one, by LIMIT otherwise. """
+    width = stopx - startx
+    height = stopy - starty
+    if context.kd_split:
+        if width <= 1 and height <= 1:
+            return True
+    elif width <= 1 or height <= 1:
+        return True
+    cost_model = context.cost_model
+    if cost_model is None:
+        if context.kd_split:
+            return width <= LIMIT and height <= LIMIT
+        return width <= LIMIT or height <= LIMIT
+    num_children = len(split_tile(startx, stopx, starty, stopy, context))
+    return not cost_model.should_subdivide(program.num_operations(), width * height, num_children)
+
+def split_tile(startx, stopx, starty, stopy, context):
+    """ The children of a tile, as a list of (startx, stopx, starty, stopy).
+    Both axes are halved, except with context.kd_split: then a tile that is
+    at least twice as wide as high (or the other way round) is only split
+    along its longer axis, so that the tiles stay close to square. """
+    midx = (startx + stopx) // 2
+    midy = (starty + stopy) // 2
+    if context.kd_split:
+        width = stopx - startx
+        height = stopy - starty
+        if width >= 2 * height or height <= 1:
+            return [(startx, midx, starty, stopy), (midx, stopx, starty, stopy)]
+        if height >= 2 * width or width <= 1:
+            return [(startx, stopx, starty, midy), (startx, stopx, midy, stopy)]
+    return [(startx, midx, starty, midy), (startx, midx, midy, stopy),
+            (midx, stopx, starty, midy), (midx, stopx, midy, stopy)]
+
 def render_image_octree_rec(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, level=0):
     # proof of concept
     # use intervals to check for uniform color
@@ -560,14 +1364,23 @@ def render_image_octree_rec(frame, width, height, minx, maxx, miny, maxy, result
         for new_starty, new_stopy in [(starty, midy), (midy, stopy)]:
             render_image_octree_rec(frame, width, height, minx, maxx, miny, maxy, result, new_startx, new_stopx, new_starty, new_stopy, level+1)
 
-def render_image_octree_optimize(program, width, height, minx, maxx, miny, maxy):
+def render_image_octree_optimize(program, width, height, minx, maxx, miny, maxy, context=None):
+    if context is None:
+        context = RenderContext()
+    if context.adaptive and context.cost_model is None:
+        from pyfidget.costmodel import calibrate
+        context.cost_model = calibrate(program, minx, maxx, miny, maxy)
     result = ['\x00'] * (width * height)
-    render_image_octree_rec_optimize(program, width, height, minx, maxx, miny, maxy, result, 0, width, 0, height)
+    render_image_octree_rec_optimize(program, width, height, minx, maxx, miny, maxy, result, 0, width, 0, height, context=context)
     return result
 
-def render_image_octree_rec_optimize(program, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, level=0):
+def render_image_octree_rec_optimize(program, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, level=0, context=None, shrink=1.0):
     # proof of concept
+    # shrink is the fraction of ops that the specialization of the parent
+    # tile removed
     from pyfidget.optimize import opt_program
+    if context is None:
+        context = RenderContext()
     # use intervals to check for uniform color
 
     #print("==" * level, startx, stopx, starty, stopy)
@@ -577,8 +1390,15 @@ def render_image_octree_rec_optimize(program, width, height, minx, maxx, miny, m
         c = miny + (maxy - miny) * starty / (height - 1)
         d = miny + (maxy - miny) * (stopy - 1) / (height - 1)
 
-        direct = stopx - startx <= LIMIT or stopy - starty <= LIMIT
-        newprogram, minimum, maximum = opt_program(program, a, b, c, d, 0.0, 0.0, for_direct=direct)
+        direct = render_directly(program, startx, stopx, starty, stopy, context)
+        cost_model = context.cost_model
+        if cost_model is not None and not cost_model.should_specialize(shrink, (stopx - startx) * (stopy - starty)):
+            # specializing again is not worth it, keep the program of the
+            # parent and only check the intervals
+            context.stats.specializations_skipped += 1
+            _render_unspecialized(program, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, level, context, shrink, a, b, c, d, direct)
+            return
+        newprogram, minimum, maximum = opt_program(program, a, b, c, d, 0.0, 0.0, for_direct=direct, context=context)
         if maximum < 0:
             # completely inside
             _fill_black(width, height, result, startx, stopx, starty, stopy)
@@ -587,35 +1407,64 @@ def render_image_octree_rec_optimize(program, width, height, minx, maxx, miny, m
             # completely outside, no need to change color
             return
         assert newprogram is not None
+        if context.lipschitz:
+            from pyfidget.gradient import lipschitz_sign
+            sign = lipschitz_sign(newprogram, a, b, c, d, context)
+            if sign != 0:
+                if sign < 0:
+                    _fill_black(width, height, result, startx, stopx, starty, stopy)
+                newprogram.delete()
+                return
 
         # check whether area is small enough to switch to naive evaluation
         if direct:
-            frame = DirectFrame.new(newprogram)
-            render_image_naive_fragment(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy)
-            frame.delete()
+            if context.schedule:
+                from pyfidget.schedule import schedule_leaf
+                newprogram = schedule_leaf(newprogram, width, height, minx, maxx, miny, maxy, startx, stopx, starty, stopy, context)
+            render_image_leaf_fragment(newprogram, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, context)
             newprogram.delete()
             return
+        shrink = 1.0 - newprogram.num_operations() / program.num_operations()
     else:
         newprogram = program
-    midx = (startx + stopx) // 2
-    midy = (starty + stopy) // 2
-    for new_startx, new_stopx in [(startx, midx), (midx, stopx)]:
-        for new_starty, new_stopy in [(starty, midy), (midy, stopy)]:
-            #if not objectmodel.we_are_translated():
-            #    print("====================================", level, new_startx, new_stopx, new_starty, new_stopy)
-            render_image_octree_rec_optimize(newprogram, width, height, minx, maxx, miny, maxy, result, new_startx, new_stopx, new_starty, new_stopy, level+1)
+    for new_startx, new_stopx, new_starty, new_stopy in split_tile(startx, stopx, starty, stopy, context):
+        #if not objectmodel.we_are_translated():
+        #    print("====================================", level, new_startx, new_stopx, new_starty, new_stopy)
+        render_image_octree_rec_optimize(newprogram, width, height, minx, maxx, miny, maxy, result, new_startx, new_stopx, new_starty, new_stopy, level+1, context, shrink)
     if level:
         newprogram.delete()
 
-def render_image_octree_optimize_graphviz(frame, width, height, minx, maxx, miny, maxy):
+def _render_unspecialized(program, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, level, context, shrink, a, b, c, d, direct):
+    # like render_image_octree_rec_optimize, with program for the whole tile
+    frame = context.interval_frame
+    if frame is None:
+        frame = context.interval_frame = IntervalFrame(program)
+    frame.reset(program)
+    minimum, maximum = frame.run_intervals(a, b, c, d, 0.0, 0.0)
+    if maximum < 0:
+        _fill_black(width, height, result, startx, stopx, starty, stopy)
+        return
+    elif minimum > 0:
+        return
+    if direct:
+        render_image_leaf_fragment(program, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, context)
+        return
+    for new_startx, new_stopx, new_starty, new_stopy in split_tile(startx, stopx, starty, stopy, context):
+        render_image_octree_rec_optimize(program, width, height, minx, maxx, miny, maxy, result, new_startx, new_stopx, new_starty, new_stopy, level+1, context, shrink)
+
+def render_image_octree_optimize_graphviz(frame, width, height, minx, maxx, miny, maxy, context=None):
+    if context is None:
+        context = RenderContext()
     result = ['\x00'] * (width * height)
     output = ['digraph G {', 'rankdir=LR;']
-    render_image_octree_rec_optimize_graphviz(frame, width, height, minx, maxx, miny, maxy, result, 0, width, 0, height, output)
+    render_image_octree_rec_optimize_graphviz(frame, width, height, minx, maxx, miny, maxy, result, 0, width, 0, height, output, context=context)
     output.append('}')
     return output
 
-def render_image_octree_rec_optimize_graphviz(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, output, level=0):
+def render_image_octree_rec_optimize_graphviz(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy, output, level=0, context=None):
     from pyfidget.optimize import opt_program
+    if context is None:
+        context = RenderContext()
     def node_label(a, b, c, d, prefix='l'):
         return "%s_%s_%s_%s_%s" % (prefix, a, b, c, d)
     tt1 = time.time()
@@ -625,8 +1474,8 @@ def render_image_octree_rec_optimize_graphviz(frame, width, height, minx, maxx,
     d = miny + (maxy - miny) * (stopy - 1) / (height - 1)
     before_opt = frame.program.num_operations()
     t1 = time.time()
-    direct = stopx - startx <= LIMIT or stopy - starty <= LIMIT
-    newprogram, minimum, maximum = opt_program(frame.program, a, b, c, d, 0.0, 0.0, for_direct=direct)
+    direct = render_directly(frame.program, startx, stopx, starty, stopy, context)
+    newprogram, minimum, maximum = opt_program(frame.program, a, b, c, d, 0.0, 0.0, for_direct=direct, context=context)
     t2 = time.time()
     label = node_label(startx, stopx, starty, stopy)
     descr = ['%s-%s, %s-%s' % (startx, stopx, starty, stopy),
@@ -646,7 +1495,7 @@ def render_image_octree_rec_optimize_graphviz(frame, width, height, minx, maxx,
     if direct:
         direct_label = node_label(startx, stopx, starty, stopy, 'd')
         t1 = time.time()
-        frame = DirectFrame.new(newprogram)
+        frame = DirectFrame.new(context, newprogram)
         render_image_naive_fragment(frame, width, height, minx, maxx, miny, maxy, result, startx, stopx, starty, stopy)
         frame.delete()
         t2 = time.time()
@@ -655,13 +1504,10 @@ def render_image_octree_rec_optimize_graphviz(frame, width, height, minx, maxx,
             label, '\\l'.join(descr)))
         return
     frame = IntervalFrame(newprogram)
-    midx = (startx + stopx) // 2
-    midy = (starty + stopy) // 2
-    for new_startx, new_stopx in [(startx, midx), (midx, stopx)]:
-        for new_starty, new_stopy in [(starty, midy), (midy, stopy)]:
-            sublabel = node_label(new_startx, new_stopx, new_starty, new_stopy)
-            output.append("%s -> %s" % (label, sublabel))
-            render_image_octree_rec_optimize_graphviz(frame, width, height, minx, maxx, miny, maxy, result, new_startx, new_stopx, new_starty, new_stopy, output, level+1)
+    for new_startx, new_stopx, new_starty, new_stopy in split_tile(startx, stopx, starty, stopy, context):
+        sublabel = node_label(new_startx, new_stopx, new_starty, new_stopy)
+        output.append("%s -> %s" % (label, sublabel))
+        render_image_octree_rec_optimize_graphviz(frame, width, height, minx, maxx, miny, maxy, result, new_startx, new_stopx, new_starty, new_stopy, output, level+1, context)
     tt2 = time.time()
     descr.append('total time %s' % (tt2 - tt1))
     output.append('%s [label="%s", shape=box];' % (label, '\\l'.join(descr)))